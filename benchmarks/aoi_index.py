@@ -0,0 +1,109 @@
+"""AOI hit-testing time as the number of AOIs grows.
+
+Compares the grid index used by `BrowserTabState` against testing every gaze
+sample against every AOI, on a long page of product tiles that each contain a
+nested image and title AOI. With few AOIs, the index itself falls back to testing
+every AOI:
+
+    python benchmarks/aoi_index.py --aois 10,100,1000,10000
+"""
+import time
+
+import numpy as np
+
+
+def product_page(aoi_count, columns=4, tile_size=(300, 400)):
+    # Rows of (x, y, width, height): tiles, each followed by its image and title
+    tile_width, tile_height = tile_size
+    bounds = []
+    for tile_idx in range((aoi_count + 2) // 3):
+        x = 20 + (tile_idx % columns) * (tile_width + 20)
+        y = 200 + (tile_idx // columns) * (tile_height + 20)
+        bounds.append((x, y, tile_width, tile_height))
+        bounds.append((x + 10, y + 10, tile_width - 20, tile_height * 0.6))
+        bounds.append((x + 10, y + tile_height * 0.7, tile_width - 20, 40))
+
+    return np.array(bounds[:aoi_count], dtype=np.float64)
+
+
+def gaze_batches(bounds, batch_count, batch_size, rng, viewport=(1280, 720)):
+    # Gaze on the viewport while it is scrolled from the top to the bottom of the page
+    page_height = bounds[:, 1].max() + bounds[:, 3].max()
+    scroll_positions = np.linspace(0, max(page_height - viewport[1], 0), batch_count)
+    for scroll in scroll_positions:
+        yield rng.uniform(
+            [0, scroll], [viewport[0], scroll + viewport[1]], size=(batch_size, 2)
+        )
+
+
+def brute_force(bounds, points):
+    relative = points[:, np.newaxis, :] - bounds[np.newaxis, :, :2]
+    hits = np.all((relative > 0) & (relative < bounds[np.newaxis, :, 2:]), axis=2)
+    aoi_indices, point_indices = np.nonzero(hits.T)
+
+    return point_indices, aoi_indices
+
+
+def main():
+    import argparse
+
+    from pupil_labs.web_aois.process import AoiGridIndex
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark AOI hit-testing against the number of AOIs"
+    )
+    parser.add_argument(
+        "--aois", default="10,100,1000,10000", help="comma separated AOI counts"
+    )
+    parser.add_argument(
+        "--batches", type=int, default=2000, help="gaze batches per AOI count"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=7,
+        help="gaze samples per batch, ~200 Hz gaze at 30 fps",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'AOIs':>8} {'all AOIs [us/batch]':>20} {'grid index [us/batch]':>22} "
+        f"{'speedup':>8}"
+    )
+    for aoi_count in [int(count) for count in args.aois.split(',')]:
+        bounds = product_page(aoi_count)
+        index = AoiGridIndex()
+        for aoi_idx, aoi_bounds in enumerate(bounds):
+            index.set(aoi_idx, aoi_bounds)
+
+        batches = list(
+            gaze_batches(
+                bounds, args.batches, args.batch_size, np.random.default_rng(0)
+            )
+        )
+
+        durations = {}
+        for name, query in [
+            ('brute force', lambda points, bounds=bounds: brute_force(bounds, points)),
+            ('index', index.query),
+        ]:
+            started = time.perf_counter()
+            results = [query(points) for points in batches]
+            durations[name] = (time.perf_counter() - started) / len(batches)
+            if name == 'brute force':
+                expected = results
+
+        for (points, aois), (expected_points, expected_aois) in zip(results, expected):
+            assert np.array_equal(points, expected_points) and np.array_equal(
+                aois, expected_aois
+            )
+
+        print(
+            f"{aoi_count:>8} {durations['brute force'] * 1e6:>20.1f} "
+            f"{durations['index'] * 1e6:>22.1f} "
+            f"{durations['brute force'] / durations['index']:>8.1f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
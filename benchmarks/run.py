@@ -0,0 +1,412 @@
+"""End-to-end benchmarks on synthesized recordings.
+
+Runs each case in a fresh process and reports throughput, peak memory and the
+time spent in each processing stage. Results can be saved and later compared
+against, failing on regressions:
+
+    python benchmarks/run.py --save baseline.json
+    python benchmarks/run.py --baseline baseline.json --max-regression 0.2
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import asyncio
+import json
+import multiprocessing
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+
+CASES = [
+    'process',
+    'process-batch',
+    'process-binary',
+    'process-cached',
+    'process-workers',
+    'recorder',
+    'live',
+]
+DEFAULT_CASES = [
+    'process',
+    'process-batch',
+    'process-binary',
+    'process-cached',
+    'recorder',
+    'live',
+]
+
+# Metrics ending in these are compared against a baseline. Higher throughput and
+# lower memory use are better.
+THROUGHPUT_SUFFIX = '_per_second'
+MEMORY_METRIC = 'peak_rss_mb'
+
+
+def peak_rss_mb():
+    # Of this process and any child processes it waited for; ru_maxrss is in kB on Linux
+    rss_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return rss_kb / 1024
+
+
+def run_process_case(recording_path, output_path, info, options):
+    from pupil_labs.web_aois.instrumentation import Instrumentation
+    from pupil_labs.web_aois.process import RecordingProcessor, process_in_parallel
+
+    workers = options.pop('workers', None)
+    instrumentation = Instrumentation()
+    started = time.perf_counter()
+    if workers is not None:
+        process_in_parallel(
+            recording_path,
+            output_path,
+            workers,
+            instrumentation,
+            show_progress=False,
+            **options,
+        )
+    else:
+        processor = RecordingProcessor(
+            recording_path,
+            output_path,
+            show_progress=False,
+            instrumentation=instrumentation,
+            **options,
+        )
+        processor.process()
+
+    seconds = time.perf_counter() - started
+    report = instrumentation.report()
+
+    return {
+        'seconds': seconds,
+        'frames_per_second': info['frame_count'] / seconds,
+        'gazes_per_second': info['gaze_count'] / seconds,
+        'stages': {name: stage['seconds'] for name, stage in report['stages'].items()},
+        'counters': report['counters'],
+    }
+
+
+async def run_recorder(info, tab_count, aoi_count, latency_ms):
+    # Drives the recorder's browser callbacks with a scroll event every animation
+    # frame and all AOIs moving every tenth frame, as fast as they are accepted
+    from pupil_labs.web_aois.record import BrowserRelay
+    from pupil_labs.web_aois.synthetic import FakeDevice
+
+    device = FakeDevice(latency_ms)
+    relay = BrowserRelay(None, device, {})
+    pages = [f"page-{tab_id}" for tab_id in range(tab_count)]
+    for tab_id, page in enumerate(pages):
+        relay.tab_info[page] = {'id': tab_id, 'load_count': 0}
+
+    relay.event_relay.start()
+    frame_count = info['frame_count'] * 2
+    for frame_idx in range(frame_count):
+        source = {'page': pages[frame_idx * tab_count // frame_count]}
+        capture_ms = time.time_ns() / 1e6
+        await relay.on_scroll(source, 0, frame_idx, capture_ms)
+        if frame_idx % 10 == 0:
+            changes = [
+                [f"aoi{idx}", 0, frame_idx, 100, 100] for idx in range(aoi_count)
+            ]
+            await relay.on_aoi_geometry_changed(source, changes, capture_ms)
+
+        await asyncio.sleep(0)
+
+    await relay.event_relay.close()
+
+    return relay.event_relay, frame_count
+
+
+def run_recorder_case(info, config):
+    started = time.perf_counter()
+    event_relay, frame_count = asyncio.run(
+        run_recorder(info, config['tabs'], config['aois'], config['device_latency'])
+    )
+    seconds = time.perf_counter() - started
+
+    latencies_ns = [
+        latency
+        for latencies in event_relay.latencies_ns.values()
+        for latency in latencies
+    ]
+    return {
+        'seconds': seconds,
+        'frames_per_second': frame_count / seconds,
+        'events_per_second': event_relay.counters['queued'] / seconds,
+        'counters': event_relay.counters,
+        'mean_latency_ms': (
+            sum(latencies_ns) / len(latencies_ns) / 1e6 if latencies_ns else None
+        ),
+    }
+
+
+def run_live_case(recording_path, speed):
+    from pupil_labs.web_aois.live import LiveSession, RecordingReplay
+    from pupil_labs.web_aois.process import load_calibration
+
+    published = []
+    session = LiveSession(
+        load_calibration(Path(recording_path) / 'calibration.bin'), [published.append]
+    )
+    session.start()
+    started = time.perf_counter()
+    RecordingReplay(recording_path, speed=speed or None).run(session)
+    session.close()
+    seconds = time.perf_counter() - started
+
+    # Frames are dropped in favour of newer ones when the worker falls behind, so
+    # throughput is that of the worker while it was mapping
+    mapping_seconds = sum(session.mapping_durations_ns) / 1e9
+    latencies_ns = sorted(session.latencies_ns)
+    return {
+        'seconds': seconds,
+        'frames_per_second': session.counters['mapped frames'] / mapping_seconds,
+        'gazes_per_second': len(published) / mapping_seconds,
+        'counters': session.snapshot_counters(),
+        'median_latency_ms': (
+            latencies_ns[len(latencies_ns) // 2] / 1e6 if latencies_ns else None
+        ),
+        'max_latency_ms': latencies_ns[-1] / 1e6 if latencies_ns else None,
+    }
+
+
+def run_case(case, recording_path, work_path, info, config):
+    # Runs in a fresh process, so peak memory is that of the case alone
+    output_path = Path(work_path) / f"output-{case}"
+    shutil.rmtree(output_path, ignore_errors=True)
+
+    if case == 'recorder':
+        metrics = run_recorder_case(info, config)
+
+    elif case == 'live':
+        metrics = run_live_case(recording_path, config['live_speed'])
+
+    else:
+        options = {
+            'process': {'cache_markers': False},
+            'process-batch': {'batch': True, 'cache_markers': False},
+            'process-binary': {
+                'batch': True,
+                'output_format': 'binary',
+                'cache_markers': False,
+            },
+            'process-cached': {'batch': True},
+            'process-workers': {
+                'batch': True,
+                'cache_markers': False,
+                'workers': config['workers'],
+            },
+        }[case]
+
+        if case == 'process-cached':
+            # Fill the cache first, only the second run is measured
+            run_process_case(recording_path, output_path, info, dict(options))
+            shutil.rmtree(output_path / "tab-0", ignore_errors=True)
+
+        metrics = run_process_case(recording_path, output_path, info, options)
+
+    metrics[MEMORY_METRIC] = peak_rss_mb()
+
+    return metrics
+
+
+def prepare_recording(work_path, config):
+    from pupil_labs.web_aois.synthetic import synthesize_recording
+
+    name = "recording-{seconds}s-{aois}aois-{tabs}tabs-{scroll_rate}scrolls".format(
+        **config
+    )
+    recording_path = Path(work_path) / name
+    info_file = recording_path / "benchmark-info.json"
+    if info_file.exists():
+        return recording_path, json.loads(info_file.read_text())
+
+    truth = synthesize_recording(
+        recording_path,
+        seconds=config['seconds'],
+        aoi_count=config['aois'],
+        tab_count=config['tabs'],
+        scroll_rate=config['scroll_rate'],
+    )
+    info = {
+        'frame_count': truth['frame_count'],
+        'gaze_count': len(truth['timestamps']),
+        'event_count': truth['event_count'],
+    }
+    info_file.write_text(json.dumps(info))
+
+    return recording_path, info
+
+
+def find_regressions(results, baseline, max_regression, max_memory_regression):
+    regressions = []
+    for case, metrics in results['cases'].items():
+        baseline_metrics = baseline['cases'].get(case)
+        if baseline_metrics is None:
+            continue
+
+        for name, value in metrics.items():
+            expected = baseline_metrics.get(name)
+            if not isinstance(value, (int, float)) or not isinstance(
+                expected, (int, float)
+            ):
+                continue
+
+            if name.endswith(THROUGHPUT_SUFFIX) and value < expected * (
+                1 - max_regression
+            ):
+                regressions.append(
+                    f"{case} {name}: {value:.1f}, baseline {expected:.1f}"
+                )
+
+            elif name == MEMORY_METRIC and value > expected * (
+                1 + max_memory_regression
+            ):
+                regressions.append(
+                    f"{case} {name}: {value:.1f}, baseline {expected:.1f}"
+                )
+
+    return regressions
+
+
+def print_results(results):
+    for case, metrics in results['cases'].items():
+        summary = ', '.join(
+            f"{name} {value:.1f}"
+            for name, value in metrics.items()
+            if isinstance(value, float)
+        )
+        print(f"{case}: {summary}")
+        if metrics.get('stages'):
+            stages = sorted(metrics['stages'].items(), key=lambda stage: -stage[1])
+            print(
+                '    stages: '
+                + ', '.join(f"{name} {seconds:.2f} s" for name, seconds in stages)
+            )
+
+        if metrics.get('counters'):
+            print(
+                '    '
+                + ', '.join(
+                    f"{count} {name}" for name, count in metrics['counters'].items()
+                )
+            )
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark processing, recording and live mapping on synthesized "
+        "recordings"
+    )
+    parser.add_argument(
+        "--cases",
+        default=','.join(DEFAULT_CASES),
+        help=f"comma separated, out of {','.join(CASES)}",
+    )
+    parser.add_argument(
+        "--seconds", type=float, default=30, help="length of the synthesized recording"
+    )
+    parser.add_argument("--aois", type=int, default=20, help="AOIs per tab")
+    parser.add_argument("--tabs", type=int, default=2)
+    parser.add_argument(
+        "--scroll-rate", type=float, default=5, help="scroll events per second"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="for the process-workers case"
+    )
+    parser.add_argument(
+        "--device-latency",
+        type=float,
+        default=5,
+        help="ms per event sent to the fake device",
+    )
+    parser.add_argument(
+        "--live-speed",
+        type=float,
+        default=1.0,
+        help="replay speed of the live case, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--work-dir",
+        help="keep synthesized recordings and outputs here "
+        "(default: a temporary directory)",
+    )
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument(
+        "--baseline",
+        help="compare against results saved with --save and fail on regressions",
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="allowed throughput loss, as a fraction",
+    )
+    parser.add_argument(
+        "--max-memory-regression",
+        type=float,
+        default=0.2,
+        help="allowed peak memory growth, as a fraction",
+    )
+    args = parser.parse_args()
+
+    cases = args.cases.split(',')
+    for case in cases:
+        if case not in CASES:
+            parser.error(f"unknown case {case}")
+
+    config = {
+        'seconds': args.seconds,
+        'aois': args.aois,
+        'tabs': args.tabs,
+        'scroll_rate': args.scroll_rate,
+        'workers': args.workers,
+        'device_latency': args.device_latency,
+        'live_speed': args.live_speed,
+    }
+
+    work_path = Path(args.work_dir or tempfile.mkdtemp(prefix="web-aois-benchmark-"))
+    work_path.mkdir(parents=True, exist_ok=True)
+    try:
+        recording_path, info = prepare_recording(work_path, config)
+        results = {'config': config, 'recording': info, 'cases': {}}
+        for case in cases:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                future = executor.submit(
+                    run_case, case, recording_path, work_path, info, config
+                )
+                results['cases'][case] = future.result()
+
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    print_results(results)
+    if args.save is not None:
+        Path(args.save).write_text(json.dumps(results, indent=2))
+
+    if args.baseline is not None:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline['config'] != config:
+            print("Warning: the baseline was run with a different configuration")
+
+        regressions = find_regressions(
+            results, baseline, args.max_regression, args.max_memory_regression
+        )
+        if len(regressions) > 0:
+            print(f"{len(regressions)} regressions:")
+            for regression in regressions:
+                print("   ", regression)
+
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
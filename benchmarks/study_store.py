@@ -0,0 +1,193 @@
+"""Query time of a study store against scanning all of its rows.
+
+Fills a store with synthetic gaze and AOI hits of many recordings of a site with
+several pages and AOIs each, then times typical queries with the block index and
+by reading whole tables and filtering them, which is the least any approach that
+loads every processed recording has to do:
+
+    python benchmarks/study_store.py --recordings 20 --minutes 5
+"""
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+
+def synthetic_recording(rng, minutes, url_count, aoi_count, gaze_rate=200):
+    # Page loads every 30 s on average in one tab, and hits on a random AOI of the
+    # page for a fifth of the samples
+    gaze_count = int(minutes * 60 * gaze_rate)
+    timestamps = 1_700_000_000_000_000_000 + (
+        np.arange(gaze_count) * 1e9 / gaze_rate
+    ).astype(np.uint64)
+    load_count = max(1, minutes * 2)
+    load_starts = np.sort(rng.choice(gaze_count, load_count - 1, replace=False))
+    load_ids = np.searchsorted(load_starts, np.arange(gaze_count), 'right')
+
+    gazes = {
+        'timestamp_ns': timestamps,
+        'tab_id': np.zeros(gaze_count, np.int32),
+        'load_id': load_ids,
+        'page_x_px': rng.uniform(0, 1280, gaze_count),
+        'page_y_px': rng.uniform(0, 5000, gaze_count),
+    }
+
+    hit_rows = np.sort(rng.choice(gaze_count, gaze_count // 5, replace=False))
+    aoi_hits = {
+        'timestamp_ns': timestamps[hit_rows],
+        'tab_id': np.zeros(len(hit_rows), np.int32),
+        'load_id': load_ids[hit_rows],
+        'aoi_id': rng.integers(0, aoi_count, len(hit_rows)),
+        'x_px': rng.uniform(0, 300, len(hit_rows)),
+        'y_px': rng.uniform(0, 200, len(hit_rows)),
+    }
+
+    page_loads = {
+        (0, load_id): (
+            int(timestamps[0]),
+            f"https://shop.example.com/page/{rng.integers(url_count)}",
+        )
+        for load_id in range(load_count)
+    }
+
+    return gazes, aoi_hits, [f"aoi{idx}" for idx in range(aoi_count)], page_loads
+
+
+def scan(store, table_name, filters):
+    # Reads the filtered columns of every row
+    from pupil_labs.web_aois.store import STORE_TABLES
+
+    dtypes = dict(STORE_TABLES[table_name])
+    rows = {
+        name: np.fromfile(store.path / table_name / f"{name}.bin", dtype=dtypes[name])
+        for name in {'timestamp_ns', *filters} & set(dtypes)
+    }
+    selected = np.ones(len(rows['timestamp_ns']), dtype=bool)
+    for name, values in filters.items():
+        if name == 'start_ns':
+            selected &= rows['timestamp_ns'] >= values
+        elif name == 'end_ns':
+            selected &= rows['timestamp_ns'] < values
+        else:
+            selected &= np.isin(rows[name], values)
+
+    return rows['timestamp_ns'][selected]
+
+
+def main():
+    import argparse
+
+    from pupil_labs.web_aois.store import StudyStore
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark study store queries against full scans"
+    )
+    parser.add_argument("--recordings", type=int, default=20)
+    parser.add_argument(
+        "--minutes", type=int, default=5, help="length of each recording"
+    )
+    parser.add_argument("--urls", type=int, default=20)
+    parser.add_argument("--aois", type=int, default=30, help="AOIs per page")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    store_path = tempfile.mkdtemp()
+    try:
+        rng = np.random.default_rng(0)
+        store = StudyStore(store_path)
+        started = time.perf_counter()
+        for idx in range(args.recordings):
+            store.add_recording(
+                f"participant-{idx}",
+                *synthetic_recording(rng, args.minutes, args.urls, args.aois),
+            )
+
+        duration = time.perf_counter() - started
+        row_count = len(store.gazes(columns=['timestamp_ns'])['timestamp_ns'])
+        print(
+            f"Added {args.recordings} recordings ({row_count} gaze samples) "
+            f"in {duration:.1f} s"
+        )
+
+        # The page the first participant was on after a minute
+        t0 = 1_700_000_000_000_000_000 + 60_000_000_000
+        first_gaze = store.gazes(
+            recordings=store.recordings[0],
+            start_ns=t0,
+            end_ns=t0 + 1,
+            columns=['url_id'],
+        )
+        url = store.urls[first_gaze['url_id'][0]]
+        queries = [
+            (
+                "one recording, URL and AOI, 10 s",
+                'aoi_hits',
+                {
+                    'recordings': store.recordings[0],
+                    'urls': url,
+                    'aois': 'aoi1',
+                    'start_ns': t0,
+                    'end_ns': t0 + 10**10,
+                },
+            ),
+            (
+                "one AOI on one URL, all recordings",
+                'aoi_hits',
+                {'urls': url, 'aois': 'aoi1'},
+            ),
+            ("gaze on one URL, all recordings", 'gazes', {'urls': url}),
+            ("gaze of one recording", 'gazes', {'recordings': store.recordings[-1]}),
+        ]
+
+        print(
+            f"{'query':<36} {'rows':>8} {'scan [ms]':>10} {'index [ms]':>11} "
+            f"{'blocks read':>12}"
+        )
+        for name, table_name, filters in queries:
+            scan_filters = {
+                'recording_id': store.matching_ids(
+                    'recordings', filters.get('recordings', store.recordings)
+                ),
+                'url_id': store.matching_ids('urls', filters.get('urls', store.urls)),
+                **(
+                    {'aoi_id': store.matching_ids('aois', filters['aois'])}
+                    if 'aois' in filters
+                    else {}
+                ),
+                **{
+                    key: filters[key]
+                    for key in ('start_ns', 'end_ns')
+                    if key in filters
+                },
+            }
+
+            # Timed with the files in the page cache
+            scan(store, table_name, scan_filters)
+
+            durations = {}
+            for method in ('scan', 'index'):
+                started = time.perf_counter()
+                for _ in range(args.repeats):
+                    store.blocks_read = 0
+                    if method == 'scan':
+                        expected = scan(store, table_name, scan_filters)
+                    else:
+                        result = store.query(
+                            table_name, columns=['timestamp_ns'], **filters
+                        )['timestamp_ns']
+
+                durations[method] = (time.perf_counter() - started) / args.repeats
+
+            assert np.array_equal(np.sort(result), np.sort(expected))
+            print(
+                f"{name:<36} {len(result):>8} {durations['scan'] * 1e3:>10.1f} "
+                f"{durations['index'] * 1e3:>11.1f} {store.blocks_read:>5}/"
+                f"{len(store.indices[table_name]['row_start']):<6}"
+            )
+    finally:
+        shutil.rmtree(store_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""AOI definition lookup time as the number of URL patterns grows.
+
+Compares `UrlPatternIndex` against testing the patterns of a definitions file one
+after another, for a mix of exact URLs, prefixes and globs of a large shop, and
+page URLs with query strings and fragments:
+
+    python benchmarks/url_index.py --patterns 10,100,1000,10000
+"""
+import re
+import time
+
+import numpy as np
+
+
+def shop_patterns(pattern_count):
+    # Exact product pages, category prefixes and per-user globs, in equal parts
+    patterns = []
+    for idx in range(pattern_count):
+        match idx % 3:
+            case 0:
+                patterns.append(f"https://shop.example.com/product/{idx}")
+            case 1:
+                patterns.append(f"prefix:https://shop.example.com/category/{idx}")
+            case 2:
+                patterns.append(f"https://shop.example.com/users/*/lists/{idx}")
+
+    return patterns
+
+
+def page_urls(pattern_count, url_count, rng):
+    urls = []
+    for idx in rng.integers(0, pattern_count, url_count):
+        match idx % 3:
+            case 0:
+                urls.append(
+                    f"https://shop.example.com/product/{idx}?ref=search#reviews"
+                )
+            case 1:
+                urls.append(f"https://shop.example.com/category/{idx}/page/2")
+            case 2:
+                urls.append(f"https://shop.example.com/users/u{idx}/lists/{idx}/")
+
+    return urls
+
+
+def linear_matcher(patterns):
+    # Each pattern as a regular expression, tested in turn
+    regexes = []
+    for pattern in patterns:
+        if pattern.startswith("prefix:"):
+            regex = re.escape(pattern[len("prefix:"):]) + r"(/.*)?(\?.*)?(#.*)?"
+        else:
+            regex = re.escape(pattern).replace(r"\*", "[^/]*") + r"/?(\?.*)?(#.*)?"
+
+        regexes.append((re.compile(regex), pattern))
+
+    def match(url):
+        for regex, pattern in regexes:
+            if regex.fullmatch(url):
+                return pattern
+
+    return match
+
+
+def main():
+    import argparse
+
+    from pupil_labs.web_aois.aoi_definitions import UrlPatternIndex
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark AOI definition lookup against the number of URL patterns"
+    )
+    parser.add_argument(
+        "--patterns", default="10,100,1000,10000", help="comma separated pattern counts"
+    )
+    parser.add_argument(
+        "--urls", type=int, default=2000, help="page URLs looked up per pattern count"
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'patterns':>8} {'in turn [us/url]':>18} {'index [us/url]':>16} "
+        f"{'speedup':>8}"
+    )
+    for pattern_count in [int(count) for count in args.patterns.split(',')]:
+        patterns = shop_patterns(pattern_count)
+        index = UrlPatternIndex()
+        for pattern in patterns:
+            index.add(pattern, pattern)
+
+        urls = page_urls(pattern_count, args.urls, np.random.default_rng(0))
+
+        durations = {}
+        results = {}
+        for name, match in [
+            ('in turn', linear_matcher(patterns)),
+            ('index', index.match),
+        ]:
+            started = time.perf_counter()
+            results[name] = [match(url) for url in urls]
+            durations[name] = (time.perf_counter() - started) / len(urls)
+
+        assert results['index'] == results['in turn']
+        print(
+            f"{pattern_count:>8} {durations['in turn'] * 1e6:>18.1f} "
+            f"{durations['index'] * 1e6:>16.1f} "
+            f"{durations['in turn'] / durations['index']:>8.1f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
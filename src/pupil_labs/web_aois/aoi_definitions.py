@@ -0,0 +1,241 @@
+from urllib.parse import urlsplit
+import json
+import re
+
+from .aoi_locator_helper import apply_locator_chain, compile_locator_chain
+
+
+# The keys of an AOI definitions file are URL patterns:
+#   https://example.com/page          that page, ignoring its fragment, and its query
+#                                     unless one is given
+#   prefix:https://example.com/shop   that page and every page below it
+#   https://example.com/users/*/cart  a glob, where * matches within a path segment
+#                                     and ** across them. Only a * before the query
+#                                     makes a glob, a * in a query is taken as is.
+#   glob:https://example.com/?q=*     a glob, also with a * in the query
+#   re:https://example\.com/item/\d+  a regular expression, matched from the start of
+#                                     the page URL as is
+# Exact patterns win over prefixes (the longest first), then globs and regular
+# expressions, each in the order they are defined.
+PATTERN_KINDS = ('exact', 'prefix', 'glob', 're')
+
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+
+def parse_url_pattern(pattern):
+    # Returns the kind of a pattern and the pattern without its kind prefix
+    kind, separator, rest = pattern.partition(':')
+    if separator and kind in PATTERN_KINDS:
+        return kind, rest
+
+    # A percent-encoded * (%2A) never makes a glob
+    if '*' in re.split(r'[?#]', pattern, maxsplit=1)[0]:
+        return 'glob', pattern
+
+    return 'exact', pattern
+
+
+def normalize_url(url):
+    # Returns the URL without fragment, query, default port or trailing slash, with
+    # scheme and host in lower case, and its query with the parameters sorted
+    parts = urlsplit(url.strip())
+    if parts.netloc == '':
+        return url.split('#')[0], ''
+
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    default_port = DEFAULT_PORTS.get(scheme)
+    if default_port is not None and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+
+    query = '&'.join(sorted(param for param in parts.query.split('&') if param != ''))
+
+    return f"{scheme}://{netloc}{parts.path.rstrip('/')}", query
+
+
+def path_prefixes(base):
+    # A normalized URL, then without its last path segment, and so on up to the host
+    host_end = base.find('://') + 3
+    while True:
+        yield base
+        cut = base.rfind('/', host_end)
+        if cut < 0:
+            return
+
+        base = base[:cut]
+
+
+def url_segments(base):
+    # The scheme and host of a normalized URL, followed by its path segments
+    host_end = base.find('/', base.find('://') + 3)
+    if host_end < 0:
+        return [base]
+
+    return [base[:host_end], *base[host_end + 1:].split('/')]
+
+
+def glob_to_regex(pattern):
+    parts = re.split(r'(\*\*|\*)', pattern)
+
+    return re.compile(''.join(
+        '.*' if part == '**' else '[^/]*' if part == '*' else re.escape(part)
+        for part in parts
+    ))
+
+
+class UrlPatternIndex:
+    # Finds the value of the pattern matching a URL. Exact patterns and prefixes are
+    # looked up per path segment of the URL, and globs whose wildcards are whole path
+    # segments are kept in a tree of segments, so lookups do not slow down with the
+    # number of those patterns. Other globs are bucketed by the path before their
+    # first wildcard and, like regular expressions, tested in turn.
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+        self.glob_tree = {}
+        self.globs = {}
+        self.regexes = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, pattern, value):
+        # The first of several patterns that are equal after normalization wins
+        kind, pattern = parse_url_pattern(pattern)
+        order = self.count
+        self.count += 1
+
+        if kind == 're':
+            self.regexes.append((re.compile(pattern), value))
+            return
+
+        base, query = normalize_url(pattern)
+        if kind == 'exact':
+            self.exact.setdefault(f"{base}?{query}" if query else base, value)
+
+        elif kind == 'prefix':
+            self.prefixes.setdefault(base, value)
+
+        else:
+            self.add_glob(base, query, order, value)
+
+    def add_glob(self, base, query, order, value):
+        segments = url_segments(base)
+        if query == '' and '*' not in segments[0] and all(
+            segment == '*' or '*' not in segment for segment in segments
+        ):
+            node = self.glob_tree
+            for segment in segments:
+                node = node.setdefault(segment, {})
+
+            # Values are stored under None, which no segment equals
+            node.setdefault(None, (order, value))
+            return
+
+        target = f"{base}?{query}" if query else base
+        literal = target[:target.index('*')] if '*' in target else target
+        bucket = literal[:literal.rfind('/')]
+        if literal.find('/', literal.find('://') + 3) < 0:
+            bucket = ''
+
+        self.globs.setdefault(bucket, []).append(
+            (order, glob_to_regex(target), query != '', value)
+        )
+
+    def match_glob(self, base, full, levels):
+        matches = []
+        nodes = [self.glob_tree]
+        for segment in url_segments(base):
+            nodes = [
+                child
+                for node in nodes
+                for child in (node.get(segment), node.get('*'))
+                if child is not None
+            ]
+
+        matches.extend(node[None] for node in nodes if None in node)
+
+        for level in [*levels, '']:
+            for order, regex, with_query, value in self.globs.get(level, []):
+                if regex.fullmatch(full if with_query else base):
+                    matches.append((order, value))
+                    break
+
+        if len(matches) == 0:
+            return None
+
+        return min(matches, key=lambda match: match[0])[1]
+
+    def match(self, url):
+        base, query = normalize_url(url)
+        full = f"{base}?{query}" if query else base
+        for key in (full, base):
+            if key in self.exact:
+                return self.exact[key]
+
+        levels = list(path_prefixes(base))
+        for level in levels:
+            if level in self.prefixes:
+                return self.prefixes[level]
+
+        value = self.match_glob(base, full, levels)
+        if value is not None:
+            return value
+
+        for regex, value in self.regexes:
+            if regex.match(url):
+                return value
+
+        return None
+
+
+class PageAoiDefinitions:
+    # The AOIs defined for one URL pattern, with their locator chains compiled
+    def __init__(self, pattern, aoi_definitions):
+        self.pattern = pattern
+        self.kind, self.url = parse_url_pattern(pattern)
+        self.aoi_definitions = aoi_definitions
+        self.locator_chains = {
+            aoi_name: compile_locator_chain(locator_definitions)
+            for aoi_name, locator_definitions in aoi_definitions.items()
+        }
+
+    def locators(self, page):
+        # AOIs with unrecognized locator types are left out
+        return {
+            aoi_name: apply_locator_chain(page, steps)
+            for aoi_name, steps in self.locator_chains.items()
+            if steps is not None
+        }
+
+
+class AoiDefinitionIndex:
+    # AOI definitions compiled once, looked up by page URL
+    def __init__(self, aoi_definitions_by_url):
+        self.pages = [
+            PageAoiDefinitions(pattern, aoi_definitions)
+            for pattern, aoi_definitions in aoi_definitions_by_url.items()
+        ]
+        self.url_index = UrlPatternIndex()
+        for page_definitions in self.pages:
+            self.url_index.add(page_definitions.pattern, page_definitions)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rt") as aoi_definitions_file:
+            return cls(json.load(aoi_definitions_file))
+
+    def __len__(self):
+        return len(self.pages)
+
+    def match(self, url):
+        # The PageAoiDefinitions of `url`, or None
+        return self.url_index.match(url)
+
+    def locators(self, page):
+        page_definitions = self.match(page.url)
+        if page_definitions is None:
+            return {}
+
+        return page_definitions.locators(page)
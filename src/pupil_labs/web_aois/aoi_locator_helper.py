@@ -1,5 +1,14 @@
 import re
 
+
+def first_locator(target, **args):
+    return target.first
+
+
+def last_locator(target, **args):
+    return target.last
+
+
 aoi_type_func_map = {
     "alt_text": "get_by_alt_text",
     "label": "get_by_label",
@@ -11,43 +20,57 @@ aoi_type_func_map = {
     "locator": "locator",
     "filter": "filter",
     "nth": "nth",
-    "first": lambda t,**args: t.first,
-    "last": lambda t,**args: t.last,
+    "first": first_locator,
+    "last": last_locator,
 }
 
-def get_aoi_locators_for_page(page, aoi_definitions):
-    locators = {}
-    for aoi_name,locator_definitions in aoi_definitions.items():
-        locators[aoi_name] = page
-        for locator_definition in locator_definitions:
-            locators[aoi_name] = get_sub_locator(locators[aoi_name], locator_definition)
 
-    return locators
+def compile_locator_chain(locator_definitions):
+    # Flattens the definitions of an AOI, including their "next" definitions, into
+    # (method, args) steps with "(re)" arguments compiled. Returns None if a type
+    # is not recognized.
+    steps = []
+    for locator_definition in locator_definitions:
+        while locator_definition is not None:
+            if locator_definition["type"] not in aoi_type_func_map:
+                print("Unrecognized aoi type", locator_definition["type"])
+                return None
 
-def get_sub_locator(target, locator_definition):
-    if locator_definition["type"] not in aoi_type_func_map:
-        print("Unrecognized aoi type", locator_definition["type"])
-        return
+            args = {}
+            for param, arg in locator_definition.get("args", {}).items():
+                if param.endswith("(re)"):
+                    args[param[:-4]] = re.compile(arg)
+                else:
+                    args[param] = arg
 
-    args = locator_definition.get("args", {})
-    new_args = {}
-    for param,arg in args.items():
-        if param.endswith("(re)"):
-            new_args[param[:-4]] = re.compile(arg)
+            steps.append((aoi_type_func_map[locator_definition["type"]], args))
+            locator_definition = locator_definition.get("next")
+
+    return steps
+
+
+def apply_locator_chain(target, steps):
+    for method, args in steps:
+        if isinstance(method, str):
+            target = getattr(target, method)(**args)
         else:
-            new_args[param] = arg
+            target = method(target, **args)
 
-    args = new_args
+    return target
 
-    mapped_func = aoi_type_func_map[locator_definition["type"]]
-    if isinstance(mapped_func, str):
-        locater_method = getattr(target, mapped_func)
-        locator = locater_method(**args)
-    else:
-        locator = mapped_func(target, **args)
 
-    if "next" in locator_definition:
-        locator = get_sub_locator(locator, locator_definition["next"])
+def get_aoi_locators_for_page(page, aoi_definitions):
+    locators = {}
+    for aoi_name,locator_definitions in aoi_definitions.items():
+        steps = compile_locator_chain(locator_definitions)
+        locators[aoi_name] = None if steps is None else apply_locator_chain(page, steps)
 
+    return locators
+
+
+def get_sub_locator(target, locator_definition):
+    steps = compile_locator_chain([locator_definition])
+    if steps is None:
+        return
 
-    return locator
+    return apply_locator_chain(target, steps)
@@ -0,0 +1,220 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import multiprocessing
+import os
+import shutil
+import traceback
+
+from tqdm import tqdm
+
+from .events import JOURNAL_FILE_NAME
+
+
+INPUT_FILES = [
+    "Neon Scene Camera v1 ps1.mp4",
+    "Neon Scene Camera v1 ps1.time",
+    "gaze ps1.raw",
+    "gaze ps1.time",
+    "event.txt",
+    "event.time",
+    "calibration.bin",
+]
+
+COMPLETION_MARKER = ".web-aois-complete.json"
+CACHE_DIR_NAME = ".cache"
+
+
+def find_recordings(source):
+    # `source` is either a directory that is searched for recordings or a manifest
+    # file listing one recording path per line. Recordings listed in a manifest keep
+    # their path relative to it, or only their folder name if they are outside it.
+    source = Path(source)
+    if source.is_dir():
+        recording_paths = sorted(
+            event_file.parent
+            for event_file in source.rglob("event.txt")
+            if all((event_file.parent / name).exists() for name in INPUT_FILES)
+        )
+        return [(path, path.relative_to(source)) for path in recording_paths]
+
+    recordings = []
+    listed = {}
+    for line in source.read_text().splitlines():
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+
+        recording_path = source.parent / line
+        relative_path = Path(os.path.relpath(recording_path, source.parent))
+        if relative_path.parts[0] == "..":
+            relative_path = Path(recording_path.name)
+
+        if relative_path in listed:
+            raise ValueError(
+                f"{source}: {listed[relative_path]} and {line} would be written to "
+                "the same output"
+            )
+
+        listed[relative_path] = line
+        recordings.append((recording_path, relative_path))
+
+    return recordings
+
+
+def fingerprint_inputs(recording_path, options):
+    fingerprint = {"options": options, "inputs": {}}
+    # The recorder's event journal is optional, but replaces event.txt if present
+    input_files = INPUT_FILES
+    if (recording_path / JOURNAL_FILE_NAME).exists():
+        input_files = INPUT_FILES + [JOURNAL_FILE_NAME]
+
+    for name in input_files:
+        stat = (recording_path / name).stat()
+        fingerprint["inputs"][name] = [stat.st_size, stat.st_mtime_ns]
+
+    return fingerprint
+
+
+def is_up_to_date(output_path, fingerprint):
+    marker_file = output_path / COMPLETION_MARKER
+    if not marker_file.exists():
+        return False
+
+    try:
+        return json.loads(marker_file.read_text()) == fingerprint
+    except ValueError:
+        return False
+
+
+def process_recording(recording_path, output_path, fingerprint, options):
+    # Imported here so the parent process does not pay for decord and friends
+    from .process import RecordingProcessor, get_worker_gaze_mapper
+
+    # Work in a scratch directory so an interrupted run never looks complete. It
+    # keeps the caches of the previous output, or of a failed run, so reprocessing
+    # does not decode the video again.
+    partial_path = output_path.with_name(output_path.name + ".partial")
+    cache_path = partial_path / CACHE_DIR_NAME
+    if (output_path / CACHE_DIR_NAME).is_dir():
+        shutil.rmtree(cache_path, ignore_errors=True)
+        partial_path.mkdir(exist_ok=True)
+        (output_path / CACHE_DIR_NAME).rename(cache_path)
+
+    for path in partial_path.glob("*"):
+        if path == cache_path:
+            continue
+        elif path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+    processor = RecordingProcessor(
+        recording_path,
+        partial_path,
+        show_progress=False,
+        cache_path=cache_path,
+        gaze_mapper=get_worker_gaze_mapper(recording_path),
+        **options
+    )
+    processor.process()
+
+    (partial_path / COMPLETION_MARKER).write_text(json.dumps(fingerprint))
+    shutil.rmtree(output_path, ignore_errors=True)
+    partial_path.rename(output_path)
+
+
+def process_recordings(source, output_root, workers=1, force=False, **options):
+    output_root = Path(output_root)
+
+    jobs = []
+    skipped = 0
+    failures = []
+    for recording_path, relative_path in find_recordings(source):
+        output_path = output_root / relative_path
+        try:
+            fingerprint = fingerprint_inputs(recording_path, options)
+        except FileNotFoundError as error:
+            failures.append(recording_path)
+            print(f"Failed to process {recording_path}: {error}")
+            continue
+
+        if not force and is_up_to_date(output_path, fingerprint):
+            skipped += 1
+            continue
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        jobs.append((recording_path, output_path, fingerprint))
+
+    print(f"{len(jobs)} recordings to process, {skipped} up to date")
+
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('spawn')
+    ) as executor:
+        futures = {
+            executor.submit(
+                process_recording, recording_path, output_path, fingerprint, options
+            ): recording_path
+            for recording_path, output_path, fingerprint in jobs
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except Exception:
+                failures.append(futures[future])
+                tqdm.write(f"Failed to process {futures[future]}")
+                tqdm.write(traceback.format_exc())
+
+    return failures
+
+
+def main():
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Process many recordings, skipping those already processed"
+    )
+    parser.add_argument(
+        "source",
+        help="directory containing recordings, or a manifest file listing them",
+    )
+    parser.add_argument("output_path")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument(
+        "--force", action="store_true", help="reprocess recordings that are up to date"
+    )
+    parser.add_argument("--batch", action="store_true", help="see pl-web-aois-process")
+    parser.add_argument(
+        "--frame-stride", type=int, default=1, help="see pl-web-aois-process"
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["csv", "binary"],
+        default="csv",
+        help="see pl-web-aois-process",
+    )
+    args = parser.parse_args()
+
+    try:
+        failures = process_recordings(
+            args.source,
+            args.output_path,
+            workers=args.workers,
+            force=args.force,
+            batch=args.batch,
+            frame_stride=args.frame_stride,
+            output_format=args.output_format,
+        )
+    except ValueError as error:
+        parser.error(str(error))
+    if len(failures) > 0:
+        print(f"{len(failures)} recordings failed:")
+        for recording_path in failures:
+            print("   ", recording_path)
+
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -85,28 +85,165 @@ function shimLocationEventsForSPAs(){
 	});
 }
 
-window.installEventListeners = function(){
+function captureTime(){
+	// Unix time in milliseconds, with sub-millisecond precision
+	return performance.timeOrigin + performance.now();
+}
+
+function onAnimationFrame(callback){
+	// Runs `callback` at most once per animation frame, however often the returned
+	// function is called in between
+	let pending = false;
+	return () => {
+		if(pending){
+			return;
+		}
+
+		pending = true;
+		requestAnimationFrame(() => {
+			pending = false;
+			callback();
+		});
+	};
+}
+
+function pageBounds(element){
+	let rect = element.getBoundingClientRect();
+	return [rect.x + window.scrollX, rect.y + window.scrollY, rect.width, rect.height];
+}
+
+class AoiGeometryTracker {
+	// Watches the AOI elements resolved by the recorder and reports the AOIs whose
+	// page bounds changed. Checks run at most once per `delay` ms after the page's
+	// DOM or the size of an AOI element changed. When an AOI element was removed
+	// from the page (e.g., re-rendered), the recorder locates the AOIs again.
+	constructor(delay){
+		this.delay = delay;
+		this.elements = new Map();
+		this.lastBounds = new Map();
+		this.timer = null;
+
+		this.resizeObserver = new ResizeObserver(() => this.scheduleCheck());
+		this.mutationObserver = new MutationObserver(() => this.scheduleCheck());
+		this.mutationObserver.observe(document.documentElement, {
+			childList: true,
+			subtree: true,
+			attributes: true,
+			characterData: true,
+		});
+		window.addEventListener("load", () => this.scheduleCheck());
+	}
+
+	track(name, element){
+		let previous = this.elements.get(name);
+		if(previous && previous !== element){
+			this.resizeObserver.unobserve(previous);
+		}
+
+		this.elements.set(name, element);
+		this.resizeObserver.observe(element);
+
+		let bounds = pageBounds(element);
+		this.lastBounds.set(name, bounds);
+		return bounds;
+	}
+
+	reset(){
+		// Forgets the AOIs of the previous page
+		this.resizeObserver.disconnect();
+		this.elements.clear();
+		this.lastBounds.clear();
+	}
+
+	scheduleCheck(){
+		if(this.timer === null){
+			this.timer = setTimeout(() => {
+				this.timer = null;
+				this.check();
+			}, this.delay);
+		}
+	}
+
+	check(){
+		let changes = [];
+		let detached = false;
+		for(let [name, element] of this.elements){
+			if(!element.isConnected){
+				this.resizeObserver.unobserve(element);
+				this.elements.delete(name);
+				this.lastBounds.delete(name);
+				detached = true;
+				continue;
+			}
+
+			let bounds = pageBounds(element);
+			let last = this.lastBounds.get(name);
+			if(bounds.every((v, i) => Math.abs(v - last[i]) < 0.5)){
+				continue;
+			}
+
+			this.lastBounds.set(name, bounds);
+			changes.push([name, ...bounds]);
+		}
+
+		if(changes.length > 0){
+			propagateAoiGeometry(changes, captureTime());
+		}
+
+		if(detached){
+			propagatePageElements();
+		}
+	}
+}
+
+let aoiTracker = null;
+
+window.trackAoiElement = function(name, element){
+	// Returns the element's bounds in page coordinates and reports later changes
+	if(!aoiTracker){
+		aoiTracker = new AoiGeometryTracker(100);
+	}
+
+	return aoiTracker.track(name, element);
+}
+
+window.measureAoiElement = function(name, element){
+	// Like trackAoiElement, but also returns when the bounds were measured
+	return [trackAoiElement(name, element), captureTime()];
+}
+
+window.measureMarkerElement = function(element){
+	// Returns the marker's bounds in window coordinates and when they were measured
+	let rect = element.getBoundingClientRect();
+	return [[rect.x, rect.y, rect.width, rect.height], captureTime()];
+}
+
+window.installEventListeners = function(geometryUpdateDelay=100){
 	shimLocationEventsForSPAs();
 
-	window.addEventListener("scroll", (e) => {
-		propagateScrollEvent(window.scrollX, window.scrollY);
-	});
+	if(!aoiTracker){
+		aoiTracker = new AoiGeometryTracker(geometryUpdateDelay);
+	}
 
-	window.addEventListener("resize", (e) => {
-		propagateResizeEvent(window.innerWidth, window.innerHeight);
+	window.addEventListener("scroll", onAnimationFrame(() => {
+		propagateScrollEvent(window.scrollX, window.scrollY, captureTime());
+	}));
+
+	window.addEventListener("resize", onAnimationFrame(() => {
+		propagateResizeEvent(window.innerWidth, window.innerHeight, captureTime());
 		propagatePageElements();
-	});
+	}));
 
 	window.addEventListener("focus", (e) => {
 		console.log("Focus event")
-		propagateFocusEvent(window.scrollX, window.scrollY);
+		propagateFocusEvent(window.scrollX, window.scrollY, captureTime());
 	});
 
 	document.addEventListener("visibilitychange", (event) => {
 		console.log("visibility event")
 		if (document.visibilityState == "visible") {
 			console.log("tab is active")
-			propagateFocusEvent(window.scrollX, window.scrollY);
+			propagateFocusEvent(window.scrollX, window.scrollY, captureTime());
 		} else {
 			console.log("tab is inactive")
 		}
@@ -118,14 +255,15 @@ window.installEventListeners = function(){
 	window.addEventListener("locationchange", (e) => {
 		let url = window.location.toString();
 		if(url != last_sent_url){
-			propagateLocationChangeEvent();
+			aoiTracker.reset();
+			propagateLocationChangeEvent(captureTime());
 			propagatePageElements();
 			last_sent_url = url;
 		}
 	});
 
-	propagateLocationChangeEvent();
-	propagateResizeEvent(window.innerWidth, window.innerHeight);
+	propagateLocationChangeEvent(captureTime());
+	propagateResizeEvent(window.innerWidth, window.innerHeight, captureTime());
 	propagatePageElements();
 
 	let focusedElement = document.activeElement || document.firstElementChild();
@@ -0,0 +1,275 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import re
+import struct
+import time
+
+import numpy as np
+
+
+# Bump when the compiled format changes so stale caches are ignored
+CACHE_VERSION = 2
+
+# Event kinds. Lines that aren't one of these (or are malformed) are compiled as
+# OTHER and ignored when replaying.
+OTHER = 0
+BROWSER_URL = 1
+AOI = 2
+MARKER = 3
+BROWSER_SCROLL = 4
+BROWSER_SIZE = 5
+BROWSER_CLOSED = 6
+
+# `name_id` indexes the names table, which holds the URL of browser_url events and
+# the AOI name of aoi events. `values` holds bounds, scroll positions or sizes.
+EVENT_DTYPE = np.dtype([
+    ('timestamp', '<u8'),
+    ('kind', 'u1'),
+    ('tab_id', '<i4'),
+    ('load_id', '<i4'),
+    ('marker_id', '<i4'),
+    ('name_id', '<i4'),
+    ('values', '<f8', (4,)),
+])
+
+# The recorder's event journal: a header followed by records of a timestamp, the
+# length of the event text and the UTF-8 event text
+JOURNAL_FILE_NAME = "events.journal"
+JOURNAL_HEADER = b"WAOIEVJ1"
+JOURNAL_RECORD = struct.Struct('<QI')
+
+# Written next to processed output with the URL and time of each page load
+PAGES_FILE_NAME = "pages.json"
+
+EVENT_REGEX = re.compile(r'(?P<event>[^\[=]*)(\[(?P<args>[^\]]*)\])?(=(?P<value>.*))?')
+
+
+def load_array(path, dtype):
+    # Memory maps the file, so only the parts that are accessed are ever read
+    if Path(path).stat().st_size == 0:
+        return np.empty(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def read_table(table_path):
+    # Reads a columnar table written by `pl-web-aois-process --output-format binary`
+    table_path = Path(table_path)
+    schema = json.loads((table_path / "schema.json").read_text())
+
+    return {
+        name: np.fromfile(table_path / f"{name}.bin", dtype=dtype)
+        for name, dtype in schema
+    }
+
+
+class EventLines:
+    # The lines of a memory mapped text file, decoded only when accessed
+    def __init__(self, buffer):
+        self.buffer = buffer
+        newlines = np.flatnonzero(buffer == ord('\n'))
+        self.starts = np.concatenate([[0], newlines + 1])
+        self.ends = np.concatenate([newlines, [len(buffer)]])
+
+    @staticmethod
+    def from_file(path):
+        return EventLines(load_array(path, np.uint8))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        line = bytes(self.buffer[self.starts[index]:self.ends[index]]).decode()
+        return line[:-1] if line.endswith('\r') else line
+
+
+class CompiledEvents:
+    __slots__ = ('records', 'names')
+
+    def __init__(self, records, names):
+        self.records = records
+        self.names = names
+
+
+def parse_event(event, record, intern_name):
+    # Fills in `record` for an event line as formatted by the recorder
+    event_match = EVENT_REGEX.match(event)
+
+    args = event_match.group('args')
+    args = [] if args is None else args.split(',')
+    value = event_match.group('value')
+
+    match event_match.group('event'):
+        case 'browser_url':
+            record['tab_id'], record['load_id'] = [int(v) for v in args]
+            record['name_id'] = intern_name(value)
+            kind = BROWSER_URL
+
+        case 'aoi':
+            tab_id, load_id, aoi_name = args
+            record['tab_id'], record['load_id'] = int(tab_id), int(load_id)
+            record['name_id'] = intern_name(aoi_name)
+            record['values'] = [float(v) for v in value.split(',')]
+            kind = AOI
+
+        case 'marker':
+            record['tab_id'], record['load_id'], record['marker_id'] = [
+                int(v) for v in args
+            ]
+            record['values'] = [float(v) for v in value.split(',')]
+            kind = MARKER
+
+        case 'browser_scroll':
+            record['tab_id'] = int(args[0])
+            record['values'][:2] = [float(v) for v in value.split(',')]
+            kind = BROWSER_SCROLL
+
+        case 'browser_size':
+            record['values'][:2] = [int(v) for v in value.split(',')]
+            kind = BROWSER_SIZE
+
+        case 'browser_closed':
+            kind = BROWSER_CLOSED
+
+        case _:
+            kind = OTHER
+
+    record['kind'] = kind
+
+
+class EventJournal:
+    # Append-only log of events as they are captured. Records are buffered and
+    # synced to disk at most every `sync_interval` seconds, and on close.
+    def __init__(self, path, sync_interval=0.5):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.file = path.open('ab')
+        if self.file.tell() == 0:
+            self.file.write(JOURNAL_HEADER)
+
+        self.sync_interval = sync_interval
+        self.last_sync = time.monotonic()
+
+    def append(self, event, event_timestamp_unix_ns):
+        data = event.encode()
+        self.file.write(JOURNAL_RECORD.pack(event_timestamp_unix_ns, len(data)) + data)
+
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def read_journal(journal_file):
+    # Returns the timestamps and event lines of a journal. A record that was cut off
+    # by a crash while it was written is ignored.
+    data = Path(journal_file).read_bytes()
+    if not data.startswith(JOURNAL_HEADER):
+        raise ValueError(f"{journal_file} is not an event journal")
+
+    timestamps = []
+    lines = []
+    offset = len(JOURNAL_HEADER)
+    while offset + JOURNAL_RECORD.size <= len(data):
+        timestamp, length = JOURNAL_RECORD.unpack_from(data, offset)
+        offset += JOURNAL_RECORD.size
+        if offset + length > len(data):
+            break
+
+        timestamps.append(timestamp)
+        lines.append(data[offset:offset + length].decode())
+        offset += length
+
+    return np.array(timestamps, dtype=np.uint64), lines
+
+
+def compile_events(timestamps, lines):
+    count = min(len(timestamps), len(lines))
+    records = np.zeros(count, dtype=EVENT_DTYPE)
+    records['timestamp'] = timestamps[:count]
+
+    names = {}
+
+    def intern_name(name):
+        return names.setdefault(name, len(names))
+
+    for idx in range(count):
+        try:
+            parse_event(lines[idx], records[idx], intern_name)
+        except (ValueError, TypeError, AttributeError):
+            records[idx]['kind'] = OTHER
+
+    return CompiledEvents(records, list(names))
+
+
+def find_journal(recording_path, journal_file=None):
+    # The recorder writes the journal on the PC, so it is only used if it was given
+    # explicitly or copied into the recording folder
+    if journal_file is not None:
+        return Path(journal_file)
+
+    journal_file = Path(recording_path) / JOURNAL_FILE_NAME
+    return journal_file if journal_file.exists() else None
+
+
+def load_events(recording_path, cache_path=None, journal_file=None):
+    # Compiles the events of a recording (from the recorder's journal if there is
+    # one, or else from the device's event.txt), or loads them from `cache_path` if
+    # they have been compiled from the same input files before
+    journal_file = find_journal(recording_path, journal_file)
+    if journal_file is not None:
+        input_files = [journal_file]
+
+        def compile_inputs():
+            return compile_events(*read_journal(journal_file))
+
+    else:
+        event_file = Path(recording_path) / "event.txt"
+        timestamp_file = event_file.with_suffix(".time")
+        input_files = [timestamp_file, event_file]
+
+        def compile_inputs():
+            return compile_events(
+                load_array(timestamp_file, '<u8'), EventLines.from_file(event_file)
+            )
+
+    if cache_path is None:
+        return compile_inputs()
+
+    digest = hashlib.sha1(str(CACHE_VERSION).encode())
+    for input_file in input_files:
+        digest.update(input_file.name.encode())
+        digest.update(input_file.read_bytes())
+
+    cache_path = Path(cache_path)
+    cache_file = cache_path / f"events-{digest.hexdigest()}.npz"
+    if cache_file.exists():
+        with np.load(cache_file) as cached:
+            return CompiledEvents(cached['records'], cached['names'].tolist())
+
+    events = compile_inputs()
+
+    # Written under a temporary name, so concurrent readers never see partial files
+    cache_path.mkdir(parents=True, exist_ok=True)
+    temp_file = cache_path / f".{cache_file.name}.{os.getpid()}"
+    with temp_file.open('wb') as output_file:
+        np.savez(
+            output_file, records=events.records, names=np.array(events.names, dtype=str)
+        )
+
+    for stale_file in cache_path.glob("events-*.npz"):
+        stale_file.unlink()
+
+    temp_file.replace(cache_file)
+
+    return events
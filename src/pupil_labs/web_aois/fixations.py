@@ -0,0 +1,102 @@
+import numpy as np
+
+
+# Gaze moving slower than this many page pixels per second between two samples is
+# considered part of a fixation (about 40°/s at 60 cm from a 24" full HD screen)
+DEFAULT_MAX_FIXATION_VELOCITY = 1500
+
+# Fixations shorter than this are dropped
+DEFAULT_MIN_FIXATION_DURATION_MS = 60
+
+# Samples further apart than this (e.g., while the page was out of view) end a fixation
+MAX_FIXATION_GAP_MS = 100
+
+
+class FixationDetector:
+    # Velocity-threshold (I-VT) classification of the gaze on a page, fed in chunks.
+    # A fixation is a run of samples that each moved slower than `max_velocity` from
+    # the previous one, lasting at least `min_duration_ms`. The rest are saccades.
+    #
+    # Velocities are measured in page coordinates, which include the scroll position,
+    # so gaze that follows content while the page scrolls stays in one fixation.
+    def __init__(
+        self,
+        max_velocity=DEFAULT_MAX_FIXATION_VELOCITY,
+        min_duration_ms=DEFAULT_MIN_FIXATION_DURATION_MS,
+        max_gap_ms=MAX_FIXATION_GAP_MS,
+    ):
+        self.max_velocity = max_velocity
+        self.min_duration_ns = int(min_duration_ms * 1e6)
+        self.max_gap_ns = int(max_gap_ms * 1e6)
+
+        # The last sample, and the start, end, summed position and sample count of
+        # the run it belongs to, which the next chunk may continue
+        self.last_sample = None
+        self.open_run = None
+
+    def add(self, timestamps, x, y):
+        # Returns the fixations ended by these samples as start and end timestamp and
+        # centroid arrays
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if len(timestamps) == 0:
+            return self.filter_runs([])
+
+        previous = self.last_sample or (timestamps[0], x[0], y[0])
+        intervals = np.diff(timestamps, prepend=previous[0])
+        distances = np.hypot(
+            np.diff(x, prepend=previous[1]), np.diff(y, prepend=previous[2])
+        )
+        breaks = (intervals > self.max_gap_ns) | (
+            distances * 1e9 > self.max_velocity * intervals
+        )
+        breaks[0] |= self.last_sample is None
+
+        starts = np.flatnonzero(breaks | (np.arange(len(breaks)) == 0))
+        ends = np.append(starts[1:], len(timestamps)) - 1
+        runs = [
+            timestamps[starts],
+            timestamps[ends],
+            np.add.reduceat(x, starts),
+            np.add.reduceat(y, starts),
+            np.diff(np.append(starts, len(timestamps))),
+        ]
+
+        completed = []
+        if self.open_run is not None:
+            if breaks[0]:
+                completed.append(self.open_run)
+            else:
+                # The first run continues the open one
+                for column, open_value in zip(runs[2:], self.open_run[2:]):
+                    column[0] += open_value
+
+                runs[0][0] = self.open_run[0]
+
+        completed.extend(zip(*[column[:-1].tolist() for column in runs]))
+        self.open_run = [column[-1].item() for column in runs]
+        self.last_sample = (timestamps[-1], x[-1], y[-1])
+
+        return self.filter_runs(completed)
+
+    def flush(self):
+        # Ends the open run, e.g. when the page changes
+        completed = [] if self.open_run is None else [self.open_run]
+        self.open_run = None
+        self.last_sample = None
+
+        return self.filter_runs(completed)
+
+    def filter_runs(self, runs):
+        starts = np.array([run[0] for run in runs], dtype=np.int64)
+        ends = np.array([run[1] for run in runs], dtype=np.int64)
+        sums = np.array([run[2:] for run in runs], dtype=np.float64).reshape(-1, 3)
+        keep = ends - starts >= self.min_duration_ns
+
+        return (
+            starts[keep],
+            ends[keep],
+            sums[keep, 0] / sums[keep, 2],
+            sums[keep, 1] / sums[keep, 2],
+        )
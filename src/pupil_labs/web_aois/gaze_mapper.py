@@ -0,0 +1,109 @@
+import re
+
+import numpy as np
+
+from pupil_labs.real_time_screen_gaze.gaze_mapper import GazeMapper
+
+try:
+    from importlib.metadata import PackageNotFoundError, version
+except ImportError:
+    from importlib_metadata import PackageNotFoundError, version
+
+
+# RecordingGazeMapper relies on internals of GazeMapper (and of the surface tracker
+# it uses), which are only known to be there in these versions. Keep in sync with
+# `install_requires` in setup.cfg.
+MIN_GAZE_MAPPER_VERSION = (1, 1, 2)
+MAX_GAZE_MAPPER_VERSION = (1, 2)
+
+
+def check_gaze_mapper_version():
+    try:
+        installed = version("real-time-screen-gaze")
+    except PackageNotFoundError:
+        # e.g. a source checkout, whose version is unknown
+        return
+
+    numbers = tuple(int(n) for n in re.findall(r"\d+", installed)[:3])
+    if not MIN_GAZE_MAPPER_VERSION <= numbers < MAX_GAZE_MAPPER_VERSION:
+        raise RuntimeError(
+            f"real-time-screen-gaze {installed} is not supported, install a version "
+            ">={},<{}".format(
+                ".".join(map(str, MIN_GAZE_MAPPER_VERSION)),
+                ".".join(map(str, MAX_GAZE_MAPPER_VERSION)),
+            )
+        )
+
+
+class RecordingGazeMapper(GazeMapper):
+    # Adds marker detection, batched mapping and mapping with precomputed surface
+    # locations to GazeMapper. This is the only place that touches its internals.
+    def __init__(self, calibration):
+        check_gaze_mapper_version()
+        super().__init__(calibration)
+
+    def reset(self):
+        self.clear_surfaces()
+        self._detected_markers = []
+        self._surface_locations = {}
+
+    def detector_params(self):
+        # Settings of the AprilTag detector, which determine the detected markers
+        return self._detector._detector.params
+
+    def detect_markers(self, frame):
+        return self._detector.detect_from_image(frame)
+
+    def set_detected_markers(self, markers):
+        # Equivalent to `process_scene` with markers that were detected beforehand
+        self._detected_markers = markers
+        self._surface_locations = {
+            surface.uid: self._tracker.locate_surface(
+                surface=surface,
+                markers=self._detected_markers,
+            )
+            for surface in self.surfaces
+        }
+
+    def surface_transform(self, surface, markers):
+        # Image to surface homography of `surface` located with `markers`, or None
+        location = self._tracker.locate_surface(surface=surface, markers=markers)
+        if location is None:
+            return None
+
+        return location.transform_matrix_from_image_to_surface_undistorted
+
+    def map_gazes_with_transforms(self, gazes, transforms):
+        # Maps an (N, 2) array of scene gazes with one (3, 3) homography per gaze
+        gazes_undistorted = self.camera.undistort_points_on_image_plane(gazes).reshape(
+            -1, 2
+        )
+        points = np.einsum(
+            'nij,nj->ni',
+            transforms,
+            np.column_stack([gazes_undistorted, np.ones(len(gazes_undistorted))]),
+        )
+
+        return points[:, :2] / points[:, 2:]
+
+    def map_gazes(self, gazes):
+        # Batched version of `process_gaze`: maps an (N, 2) array of scene gazes
+        # to an (N, 2) array of normalized coordinates per located surface
+        if len(self._surface_locations) == 0:
+            return None
+
+        gazes_undistorted = self.camera.undistort_points_on_image_plane(gazes).reshape(
+            -1, 2
+        )
+
+        mapped_gazes = {}
+        for surface_uid, location in self._surface_locations.items():
+            if location is None:
+                mapped_gazes[surface_uid] = None
+                continue
+
+            mapped_gazes[location.surface_uid] = location._map_from_image_to_surface(
+                gazes_undistorted.copy()
+            )
+
+        return mapped_gazes
@@ -0,0 +1,147 @@
+from pathlib import Path
+import json
+import time
+
+
+class StageTimer:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.instrumentation.enter_stage(self.name)
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.exit_stage()
+
+
+class Instrumentation:
+    # Collects the time spent in each processing stage and event counters. Stages
+    # may be nested; time is only attributed to the innermost running stage, so
+    # stage times add up to at most the wall time.
+    #
+    # With `progress_interval` (in seconds), `progress` emits a progress event at
+    # most that often, passing it as a dict to `emit`. Times are taken from `clock`.
+    def __init__(self, progress_interval=None, emit=None, clock=time.perf_counter):
+        self.progress_interval = progress_interval
+        self.emit = print_json if emit is None else emit
+        self.clock = clock
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.counters = {}
+        self.stages = []
+        self.started = self.clock()
+        self.last_switch = self.started
+        self.last_progress = self.started
+
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def _switch_stage(self):
+        now = self.clock()
+        if len(self.stages) > 0:
+            name = self.stages[-1]
+            self.stage_seconds[name] = (
+                self.stage_seconds.get(name, 0.0) + now - self.last_switch
+            )
+
+        self.last_switch = now
+
+    def enter_stage(self, name):
+        self._switch_stage()
+        self.stages.append(name)
+        self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+
+    def exit_stage(self):
+        self._switch_stage()
+        self.stages.pop()
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+    def progress(self, done, total):
+        if self.progress_interval is None:
+            return
+
+        now = self.clock()
+        if now - self.last_progress < self.progress_interval and done < total:
+            return
+
+        self.last_progress = now
+        self.emit({
+            'event': 'progress',
+            'done': done,
+            'total': total,
+            'elapsed_seconds': now - self.started,
+            'counters': dict(self.counters),
+        })
+
+    def merge(self, report):
+        # Adds the stage times and counters of another run's report, e.g. of a
+        # segment processed in another process
+        for name, stage in report['stages'].items():
+            self.stage_seconds[name] = (
+                self.stage_seconds.get(name, 0.0) + stage['seconds']
+            )
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + stage['calls']
+
+        for name, value in report['counters'].items():
+            self.count(name, value)
+
+    def report(self):
+        self._switch_stage()
+
+        return {
+            'wall_seconds': self.clock() - self.started,
+            'stages': {
+                name: {'seconds': seconds, 'calls': self.stage_calls[name]}
+                for name, seconds in sorted(
+                    self.stage_seconds.items(), key=lambda item: -item[1]
+                )
+            },
+            'counters': dict(self.counters),
+        }
+
+    def write_report(self, path):
+        Path(path).write_text(json.dumps(self.report(), indent=4))
+
+
+class NullStageTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullInstrumentation:
+    # Stands in for `Instrumentation` when it's disabled, doing nothing
+    _stage = NullStageTimer()
+
+    def stage(self, name):
+        return self._stage
+
+    def count(self, name, value=1):
+        pass
+
+    def get(self, name):
+        return 0
+
+    def progress(self, done, total):
+        pass
+
+    def merge(self, report):
+        pass
+
+    def report(self):
+        return None
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+def print_json(data):
+    print(json.dumps(data), flush=True)
@@ -0,0 +1,477 @@
+from collections import deque
+from pathlib import Path
+import asyncio
+import json
+import queue
+import socket
+import threading
+import time
+
+import numpy as np
+
+from . import events
+from .gaze_mapper import RecordingGazeMapper
+from .process import RecordingProcessor, load_calibration
+from .record import summarize_durations
+
+
+class LatestFrameMailbox:
+    # Holds only the newest scene frame. A frame that wasn't picked up before the
+    # next one arrived is dropped, so a slow mapper never builds up a backlog.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if self.item is not None:
+                self.dropped += 1
+
+            self.item = item
+            self.condition.notify()
+
+    def get(self):
+        # Blocks until there is a frame, or returns None once closed
+        with self.condition:
+            while self.item is None and not self.closed:
+                self.condition.wait()
+
+            item, self.item = self.item, None
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class LiveGazeWriter:
+    # Output writer (see `process.OUTPUT_WRITERS`) that collects mapped gaze as
+    # messages to publish instead of writing files. Gaze is written with the index
+    # of each sample in place of its timestamp, so samples that share a timestamp
+    # are kept apart.
+    def __init__(self):
+        self.aoi_names = []
+        self.messages = {}
+
+    def add_tab(self, tab_id):
+        pass
+
+    def add_aoi(self, tab_id, name):
+        self.aoi_names.append(name)
+
+        return len(self.aoi_names) - 1
+
+    def write_gazes(self, tab_id, load_id, columns):
+        samples, x_norm, y_norm, window_x, window_y, page_x, page_y = [
+            np.asarray(column).tolist() for column in columns
+        ]
+        for idx, sample in enumerate(samples):
+            self.messages[sample] = {
+                'tab_id': tab_id,
+                'load_id': load_id,
+                'norm': [x_norm[idx], y_norm[idx]],
+                'window': [window_x[idx], window_y[idx]],
+                'page': [page_x[idx], page_y[idx]],
+                'aois': {},
+            }
+
+    def write_aoi_hits(self, tab_id, load_id, aoi_id, columns):
+        samples, x_norm, y_norm, x_px, y_px = [
+            np.asarray(column).tolist() for column in columns
+        ]
+        for idx, sample in enumerate(samples):
+            self.messages[sample]['aois'][self.aoi_names[aoi_id]] = {
+                'norm': [x_norm[idx], y_norm[idx]],
+                'px': [x_px[idx], y_px[idx]],
+            }
+
+    def take_messages(self, timestamps):
+        # Messages in sample order, with the timestamps of the samples
+        messages = [
+            {'timestamp_ns': timestamps[sample], **self.messages[sample]}
+            for sample in sorted(self.messages)
+        ]
+        self.messages = {}
+
+        return messages
+
+    def close(self):
+        pass
+
+
+class LiveProcessor(RecordingProcessor):
+    # Applies browser events and maps gaze like `RecordingProcessor`, but with scene
+    # frames and gaze as they arrive rather than from a recording on disk
+    def __init__(self, calibration):
+        self.init_mapping_state(
+            RecordingGazeMapper(calibration), LiveGazeWriter(), batch=True
+        )
+        self.event_name_ids = {}
+
+    def intern_name(self, name):
+        if name not in self.event_name_ids:
+            self.event_name_ids[name] = len(self.event_names)
+            self.event_names.append(name)
+
+        return self.event_name_ids[name]
+
+    def apply_event(self, event, event_timestamp_unix_ns):
+        record = np.zeros((), dtype=events.EVENT_DTYPE)
+        record['timestamp'] = event_timestamp_unix_ns
+        try:
+            events.parse_event(event, record, self.intern_name)
+        except (ValueError, TypeError, AttributeError):
+            return
+
+        self.process_event(event_timestamp_unix_ns, record)
+
+    def map_frame(self, image, timestamps, gazes):
+        # Locates the surfaces in `image` and maps the gazes with them. Returns
+        # the messages for the gazes that landed on the page.
+        if self.active_tab is None:
+            return []
+
+        self.update_surface()
+        if self.active_tab.surface is None:
+            return []
+
+        self.gaze_mapper.set_detected_markers(self.gaze_mapper.detect_markers(image))
+        self.last_frame_position = 0
+        if len(timestamps) > 0:
+            self.process_gazes(np.arange(len(timestamps), dtype=np.uint64), gazes)
+
+        return self.writer.take_messages(np.asarray(timestamps).tolist())
+
+
+class JsonLinesPublisher:
+    # Writes each mapped gaze sample as a line of JSON
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, 'at')
+
+    def __call__(self, message):
+        self.file.write(json.dumps(message) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class UdpPublisher:
+    # Sends each mapped gaze sample as a JSON datagram
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, message):
+        self.socket.sendto(json.dumps(message).encode(), self.address)
+
+    def close(self):
+        self.socket.close()
+
+
+class LiveSession:
+    # Maps gaze onto the browser while recording. Frames, gaze and browser events
+    # are handed over from the event loop, and mapped on a worker thread:
+    #
+    # * only the newest scene frame is kept, older ones are dropped
+    # * gaze samples wait for the next frame, up to `max_queued_gazes`
+    # * frames and gazes older than `max_latency_ms` when their turn comes are
+    #   dropped rather than published late
+    # * browser events are never dropped, they are applied before the next frame
+    #
+    # Device timestamps are converted to local time with `clock_offset_ns` (device
+    # clock minus local clock). Local time is taken from `clock`, in unix ns. Latency
+    # is measured from when a gaze sample was captured until it was published.
+    def __init__(
+        self,
+        calibration,
+        publishers=(),
+        max_latency_ms=200,
+        max_queued_gazes=1024,
+        clock=time.time_ns,
+    ):
+        self.processor = LiveProcessor(calibration)
+        self.publishers = list(publishers)
+        self.max_latency_ns = int(max_latency_ms * 1e6)
+        self.clock_offset_ns = 0
+        self.clock = clock
+
+        self.frames = LatestFrameMailbox()
+        self.gazes = deque(maxlen=max_queued_gazes)
+        self.events = queue.SimpleQueue()
+        self.worker = None
+
+        # Counted from both the event loop and the worker thread
+        self.counters_lock = threading.Lock()
+        self.counters = {
+            'frames': 0,
+            'mapped frames': 0,
+            'stale frames': 0,
+            'gazes': 0,
+            'published gazes': 0,
+            'stale gazes': 0,
+            'overflowed gazes': 0,
+        }
+        self.latencies_ns = []
+        self.mapping_durations_ns = []
+
+    def start(self):
+        self.worker = threading.Thread(
+            target=self.run_worker, name='live-gaze-mapper', daemon=True
+        )
+        self.worker.start()
+
+    def close(self):
+        self.frames.close()
+        self.worker.join()
+        for publisher in self.publishers:
+            if hasattr(publisher, 'close'):
+                publisher.close()
+
+    def count(self, name, n=1):
+        with self.counters_lock:
+            self.counters[name] += n
+
+    def snapshot_counters(self):
+        with self.counters_lock:
+            return {**self.counters, 'dropped frames': self.frames.dropped}
+
+    def append(self, event, event_timestamp_unix_ns):
+        # Same interface as `events.EventJournal`, so it can be given the events
+        # the recorder captures
+        self.events.put((event, event_timestamp_unix_ns))
+
+    def add_frame(self, timestamp_unix_ns, get_image):
+        # `get_image` returns the BGR image, so dropped frames are never converted
+        self.count('frames')
+        self.frames.put((timestamp_unix_ns, get_image))
+
+    def add_gaze(self, timestamp_unix_ns, x, y):
+        self.count('gazes')
+        if len(self.gazes) == self.gazes.maxlen:
+            self.count('overflowed gazes')
+
+        self.gazes.append((timestamp_unix_ns, x, y))
+
+    def local_time_ns(self, device_timestamp_ns):
+        return device_timestamp_ns - self.clock_offset_ns
+
+    def take_gazes(self, now_ns):
+        gazes = []
+        while len(self.gazes) > 0:
+            gazes.append(self.gazes.popleft())
+
+        fresh = [
+            gaze
+            for gaze in gazes
+            if now_ns - self.local_time_ns(gaze[0]) <= self.max_latency_ns
+        ]
+        self.count('stale gazes', len(gazes) - len(fresh))
+
+        return fresh
+
+    def run_worker(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+
+            while not self.events.empty():
+                self.processor.apply_event(*self.events.get())
+
+            started_ns = self.clock()
+            frame_timestamp, get_image = item
+            if started_ns - self.local_time_ns(frame_timestamp) > self.max_latency_ns:
+                self.count('stale frames')
+                continue
+
+            gazes = self.take_gazes(started_ns)
+            messages = self.processor.map_frame(
+                get_image(),
+                np.array([gaze[0] for gaze in gazes], dtype=np.uint64),
+                np.array([gaze[1:] for gaze in gazes], dtype=np.float32).reshape(
+                    (-1, 2)
+                ),
+            )
+
+            published_ns = self.clock()
+            for message in messages:
+                for publisher in self.publishers:
+                    publisher(message)
+
+                self.latencies_ns.append(
+                    published_ns - self.local_time_ns(message['timestamp_ns'])
+                )
+
+            self.count('mapped frames')
+            self.count('published gazes', len(messages))
+            self.mapping_durations_ns.append(published_ns - started_ns)
+
+    def print_summary(self):
+        counters = self.snapshot_counters()
+        print(
+            'Live mapping:',
+            ', '.join(f'{count} {name}' for name, count in counters.items()),
+        )
+        print(f'    frame mapping: {summarize_durations(self.mapping_durations_ns)}')
+        print(f'    gaze latency: {summarize_durations(self.latencies_ns)}')
+
+
+async def stream_device(device, session):
+    # Feeds the device's scene video and gaze streams into `session`
+    from pupil_labs.realtime_api.streaming import (
+        receive_gaze_data,
+        receive_video_frames,
+    )
+    from pupil_labs.realtime_api.time_echo import TimeOffsetEstimator
+
+    status = await device.get_status()
+    if status.phone.time_echo_port is not None:
+        estimator = TimeOffsetEstimator(status.phone.ip, status.phone.time_echo_port)
+        estimates = await estimator.estimate()
+        if estimates is not None:
+            session.clock_offset_ns = int(estimates.time_offset_ms.mean * 1e6)
+
+    async def receive_frames():
+        async for frame in receive_video_frames(
+            status.direct_world_sensor().url, run_loop=True
+        ):
+            session.add_frame(frame.timestamp_unix_ns, frame.bgr_buffer)
+
+    async def receive_gazes():
+        async for gaze in receive_gaze_data(
+            status.direct_gaze_sensor().url, run_loop=True
+        ):
+            session.add_gaze(gaze.timestamp_unix_ns, gaze.x, gaze.y)
+
+    await asyncio.gather(receive_frames(), receive_gazes())
+
+
+class RecordingReplay:
+    # Stand-in for a device that replays a recorded session into a `LiveSession`:
+    # scene frames, gaze and browser events are fed in their recorded order,
+    # retimed so that the recording starts now. With `speed=None` everything is
+    # fed as fast as possible and timestamped when it is fed, which shows how the
+    # session copes with overload.
+    def __init__(self, recording_path, speed=1.0):
+        self.recording_path = Path(recording_path)
+        self.speed = speed
+
+    def load(self):
+        import decord
+
+        self.video_reader = decord.VideoReader(
+            str(self.recording_path / "Neon Scene Camera v1 ps1.mp4"), ctx=decord.cpu(0)
+        )
+        frame_timestamps = events.load_array(
+            self.recording_path / "Neon Scene Camera v1 ps1.time", '<u8'
+        )
+        frame_timestamps = frame_timestamps[:len(self.video_reader)]
+
+        gaze_timestamps = events.load_array(
+            self.recording_path / "gaze ps1.time", '<u8'
+        )
+        gazes = events.load_array(self.recording_path / "gaze ps1.raw", '<f4').reshape(
+            (-1, 2)
+        )
+
+        event_timestamps = events.load_array(self.recording_path / "event.time", '<u8')
+        event_lines = events.EventLines.from_file(self.recording_path / "event.txt")
+
+        # (timestamp, kind, index) in recorded order, events before gaze before frames
+        self.timeline = sorted(
+            [
+                (int(t), 0, idx)
+                for idx, t in enumerate(event_timestamps[:len(event_lines)].tolist())
+            ]
+            + [
+                (int(t), 1, idx)
+                for idx, t in enumerate(gaze_timestamps[:len(gazes)].tolist())
+            ]
+            + [(int(t), 2, idx) for idx, t in enumerate(frame_timestamps.tolist())]
+        )
+        self.event_lines = event_lines
+        self.gazes = gazes
+
+    def run(self, session):
+        self.load()
+        if len(self.timeline) == 0:
+            return
+
+        first_timestamp = self.timeline[0][0]
+        started_ns = time.time_ns()
+        for timestamp, kind, idx in self.timeline:
+            offset_ns = timestamp - first_timestamp
+            if self.speed is not None:
+                delay_ns = started_ns + offset_ns / self.speed - time.time_ns()
+                if delay_ns > 0:
+                    time.sleep(delay_ns / 1e9)
+
+                replay_timestamp = started_ns + offset_ns + session.clock_offset_ns
+            else:
+                replay_timestamp = time.time_ns() + session.clock_offset_ns
+
+            if kind == 0:
+                session.append(self.event_lines[idx], replay_timestamp)
+
+            elif kind == 1:
+                session.add_gaze(replay_timestamp, *self.gazes[idx].tolist())
+
+            else:
+                session.add_frame(replay_timestamp, self.frame_getter(idx))
+
+    def frame_getter(self, idx):
+        def get_image():
+            # decord decodes RGB
+            return np.ascontiguousarray(self.video_reader[idx].asnumpy()[:, :, ::-1])
+
+        return get_image
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Replay a recording through live gaze mapping"
+    )
+    parser.add_argument("recording_path")
+    parser.add_argument("--output", help="write mapped gaze to this JSON lines file")
+    parser.add_argument("--udp", help="send mapped gaze as JSON datagrams to HOST:PORT")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="replay speed, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--max-latency",
+        type=float,
+        default=200,
+        help="drop frames and gaze older than this many ms",
+    )
+    args = parser.parse_args()
+
+    publishers = []
+    if args.output is not None:
+        publishers.append(JsonLinesPublisher(args.output))
+
+    if args.udp is not None:
+        host, port = args.udp.rsplit(':', 1)
+        publishers.append(UdpPublisher(host, int(port)))
+
+    calibration = load_calibration(Path(args.recording_path) / 'calibration.bin')
+    session = LiveSession(calibration, publishers, max_latency_ms=args.max_latency)
+    session.start()
+    try:
+        RecordingReplay(args.recording_path, speed=args.speed or None).run(session)
+    finally:
+        session.close()
+
+    session.print_summary()
+
+
+if __name__ == '__main__':
+    main()
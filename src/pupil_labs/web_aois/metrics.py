@@ -0,0 +1,460 @@
+from pathlib import Path
+import csv
+import json
+import warnings
+
+import numpy as np
+
+from . import events
+from .events import load_array
+
+
+AOI_METRICS_FILE_NAME = "aoi-metrics.csv"
+
+AOI_METRICS_FIELDS = [
+    'tab id',
+    'load id',
+    'url',
+    'aoi',
+    'hits',
+    'entries',
+    'revisits',
+    'dwell time [ms]',
+    'first hit [ms]',
+    'visible time [ms]',
+]
+
+# A visit to an AOI lasts while consecutive gaze samples on the page hit it, unless
+# they are further apart than this (e.g., while the page was out of view)
+DEFAULT_MAX_VISIT_GAP_MS = 100
+
+
+class TabView:
+    # The AOI geometry and scroll position of a tab, as far as visibility is concerned.
+    # Only AOIs reported for the current page load can be visible.
+    def __init__(self):
+        self.load_id = -1
+        self.scroll_position = (0.0, 0.0)
+        self.aoi_indices = {}
+        self.aoi_names = []
+        self.aoi_bounds = np.zeros((0, 4))
+        self.aoi_loads = np.zeros(0, dtype=np.int64)
+        self.visible_ns = {}
+
+    def set_aoi(self, name, bounds, load_id):
+        if name not in self.aoi_indices:
+            self.aoi_indices[name] = len(self.aoi_names)
+            self.aoi_names.append(name)
+            if len(self.aoi_names) > len(self.aoi_bounds):
+                capacity = max(16, 2 * len(self.aoi_bounds))
+                self.aoi_bounds = np.resize(self.aoi_bounds, (capacity, 4))
+                self.aoi_loads = np.resize(self.aoi_loads, capacity)
+
+        self.aoi_bounds[self.aoi_indices[name]] = bounds
+        self.aoi_loads[self.aoi_indices[name]] = load_id
+
+    def add_visible_time(self, duration_ns, viewport_size):
+        if self.load_id < 0 or len(self.aoi_names) == 0:
+            return
+
+        x, y, width, height = self.aoi_bounds[:len(self.aoi_names)].T
+        scroll_x, scroll_y = self.scroll_position
+        visible = (
+            (x < scroll_x + viewport_size[0])
+            & (x + width > scroll_x)
+            & (y < scroll_y + viewport_size[1])
+            & (y + height > scroll_y)
+            & (self.aoi_loads[:len(self.aoi_names)] == self.load_id)
+        )
+
+        visible_ns = self.visible_ns.setdefault(
+            self.load_id, np.zeros(0, dtype=np.int64)
+        )
+        if len(visible_ns) < len(visible):
+            visible_ns = self.visible_ns[self.load_id] = np.pad(
+                visible_ns, (0, len(visible) - len(visible_ns))
+            )
+
+        visible_ns[visible] += duration_ns
+
+
+class AoiMetrics:
+    # Per tab, page load and AOI: gaze samples on the AOI (hits), visits (entries),
+    # the summed duration of visits (dwell time), the time from the page load to the
+    # first hit, and the time the AOI was within the viewport of the active tab.
+    #
+    # Gaze and AOI hits are passed on to `writer` and aggregated chunk by chunk as
+    # they are written. Visibility follows the events passed to `process_event`.
+    def __init__(self, writer=None, max_visit_gap_ms=DEFAULT_MAX_VISIT_GAP_MS):
+        self.writer = writer
+        self.max_visit_gap_ns = int(max_visit_gap_ms * 1e6)
+
+        self.aoi_keys = []
+        self.gaze_batches = {}
+        # (tab id, load id, AOI name) -> [hits, entries, dwell ns, first hit timestamp,
+        # gaze sample index and timestamp of the last hit]
+        self.hit_stats = {}
+
+        self.loads = {}
+        self.tab_views = {}
+        self.active_tab = None
+        self.viewport_size = (1, 1)
+        self.last_timestamp = None
+
+    def add_tab(self, tab_id):
+        if self.writer is not None:
+            self.writer.add_tab(tab_id)
+
+    def add_aoi(self, tab_id, name):
+        self.aoi_keys.append((tab_id, name))
+        if self.writer is not None:
+            return self.writer.add_aoi(tab_id, name)
+
+        return len(self.aoi_keys) - 1
+
+    def write_gazes(self, tab_id, load_id, columns):
+        if self.writer is not None:
+            self.writer.write_gazes(tab_id, load_id, columns)
+
+        # AOI hits are written after the gaze samples they belong to, so they are
+        # located among the latest samples of their tab
+        sample_count, timestamps = self.gaze_batches.get(tab_id, (0, []))
+        self.gaze_batches[tab_id] = (
+            sample_count + len(timestamps),
+            np.asarray(columns[0], dtype=np.int64),
+        )
+
+    def write_aoi_hits(self, tab_id, load_id, aoi_id, columns):
+        if self.writer is not None:
+            self.writer.write_aoi_hits(tab_id, load_id, aoi_id, columns)
+
+        timestamps = np.asarray(columns[0], dtype=np.int64)
+        batch_start, batch_timestamps = self.gaze_batches[tab_id]
+        sample_indices = batch_start + np.searchsorted(batch_timestamps, timestamps)
+        self.add_hits(
+            (tab_id, load_id, self.aoi_keys[aoi_id][1]), sample_indices, timestamps
+        )
+
+    def write_fixations(self, tab_id, load_id, columns, aoi_ids):
+        if self.writer is not None:
+            self.writer.write_fixations(tab_id, load_id, columns, aoi_ids)
+
+    def add_hits(self, key, sample_indices, timestamps):
+        stats = self.hit_stats.get(key)
+        if stats is None:
+            stats = self.hit_stats[key] = [0, 0, 0, int(timestamps[0]), -2, 0]
+
+        previous_indices = np.concatenate([[stats[4]], sample_indices[:-1]])
+        gaps = timestamps - np.concatenate([[stats[5]], timestamps[:-1]])
+        continued = (sample_indices == previous_indices + 1) & (
+            gaps <= self.max_visit_gap_ns
+        )
+
+        stats[0] += len(timestamps)
+        stats[1] += int(np.count_nonzero(~continued))
+        stats[2] += int(gaps[continued].sum())
+        stats[4] = int(sample_indices[-1])
+        stats[5] = int(timestamps[-1])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def get_tab_view(self, tab_id):
+        tab_id = int(tab_id)
+        if tab_id not in self.tab_views:
+            self.tab_views[tab_id] = TabView()
+
+        if self.active_tab is None:
+            self.active_tab = tab_id
+
+        return self.tab_views[tab_id]
+
+    def advance(self, timestamp):
+        # Adds the time since the last event to the AOIs visible in the active tab
+        timestamp = int(timestamp)
+        if self.last_timestamp is not None and self.active_tab is not None:
+            self.tab_views[self.active_tab].add_visible_time(
+                timestamp - self.last_timestamp, self.viewport_size
+            )
+
+        self.last_timestamp = timestamp
+
+    def process_event(self, timestamp, event, event_names):
+        # Mirrors how `RecordingProcessor.process_event` tracks tabs and pages
+        self.advance(timestamp)
+
+        kind = event['kind']
+        if kind == events.BROWSER_URL:
+            tab_view = self.get_tab_view(event['tab_id'])
+            tab_view.load_id = int(event['load_id'])
+            self.loads[(int(event['tab_id']), tab_view.load_id)] = (
+                int(timestamp),
+                event_names[event['name_id']],
+            )
+
+        elif kind == events.AOI:
+            self.get_tab_view(event['tab_id']).set_aoi(
+                event_names[event['name_id']], event['values'], int(event['load_id'])
+            )
+
+        elif kind == events.MARKER:
+            self.get_tab_view(event['tab_id'])
+
+        elif kind == events.BROWSER_SCROLL:
+            self.active_tab = int(event['tab_id'])
+            self.get_tab_view(event['tab_id']).scroll_position = tuple(
+                event['values'][:2].tolist()
+            )
+
+        elif kind == events.BROWSER_SIZE:
+            self.viewport_size = tuple(int(v) for v in event['values'][:2].tolist())
+
+        elif kind == events.BROWSER_CLOSED:
+            # Nothing is visible after the browser was closed
+            self.active_tab = None
+
+    def rows(self):
+        visible_ns = {
+            (tab_id, load_id, aoi_name): int(duration_ns)
+            for tab_id, tab_view in self.tab_views.items()
+            for load_id, durations_ns in tab_view.visible_ns.items()
+            for aoi_name, duration_ns in zip(tab_view.aoi_names, durations_ns.tolist())
+            if duration_ns > 0
+        }
+
+        rows = []
+        for key in sorted({*self.hit_stats, *visible_ns}):
+            tab_id, load_id, aoi_name = key
+            hits, entries, dwell_ns, first_timestamp, _, _ = self.hit_stats.get(
+                key, [0, 0, 0, None, 0, 0]
+            )
+            load_timestamp, url = self.loads.get((tab_id, load_id), (None, ''))
+            first_hit = ''
+            if first_timestamp is not None and load_timestamp is not None:
+                first_hit = (first_timestamp - load_timestamp) / 1e6
+
+            rows.append([
+                tab_id,
+                load_id,
+                url,
+                aoi_name,
+                hits,
+                entries,
+                max(entries - 1, 0),
+                dwell_ns / 1e6,
+                first_hit,
+                visible_ns.get(key, 0) / 1e6,
+            ])
+
+        return rows
+
+    def write(self, path):
+        with open(path, 'wt', newline='') as metrics_file:
+            writer = csv.writer(metrics_file)
+            writer.writerow(AOI_METRICS_FIELDS)
+            writer.writerows(self.rows())
+
+
+def visit_metrics(sample_timestamps, hit_groups, hit_timestamps, max_visit_gap_ns):
+    # Vectorized hits, entries, dwell time and first hit timestamp per group, for
+    # the AOI hits of one tab. Hits are located among the tab's gaze samples on the
+    # page by their timestamps. Returns the groups and an array per metric.
+    hit_timestamps = np.asarray(hit_timestamps, dtype=np.int64)
+    order = np.lexsort((hit_timestamps, hit_groups))
+    groups = np.asarray(hit_groups)[order]
+    timestamps = hit_timestamps[order]
+    sample_indices = np.searchsorted(
+        np.asarray(sample_timestamps, dtype=np.int64), timestamps
+    )
+
+    new_group = np.ones(len(groups), dtype=bool)
+    new_group[1:] = groups[1:] != groups[:-1]
+    gaps = np.zeros(len(timestamps), dtype=np.int64)
+    gaps[1:] = np.diff(timestamps)
+    continued = ~new_group
+    continued[1:] &= (np.diff(sample_indices) == 1) & (gaps[1:] <= max_visit_gap_ns)
+
+    starts = np.flatnonzero(new_group)
+    if len(starts) == 0:
+        return groups, *[np.zeros(0, dtype=np.int64)] * 4
+
+    return (
+        groups[starts],
+        np.diff(np.append(starts, len(groups))),
+        np.add.reduceat((~continued).astype(np.int64), starts),
+        np.add.reduceat(np.where(continued, gaps, 0), starts),
+        timestamps[starts],
+    )
+
+
+def read_csv_timestamps(csv_path):
+    # AOIs that were never hit have empty files
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        return np.loadtxt(
+            csv_path, delimiter=',', skiprows=1, usecols=0, dtype=np.uint64, ndmin=1
+        )
+
+
+def read_output_hits(output_path, load_timestamps):
+    # Yields the timestamps of the mapped gaze samples of each tab, and the load id,
+    # AOI name index and timestamp of its AOI hits, with the AOI names. CSV output has
+    # no load ids, so they are looked up from the page loads.
+    output_path = Path(output_path)
+    if (output_path / "gazes" / "schema.json").exists():
+        gaze_tabs = load_array(output_path / "gazes" / "tab_id.bin", '<i4')
+        gaze_timestamps = load_array(output_path / "gazes" / "timestamp_ns.bin", '<u8')
+        hits = {
+            name: load_array(output_path / "aoi_hits" / f"{name}.bin", dtype)
+            for name, dtype in [
+                ('timestamp_ns', '<u8'),
+                ('tab_id', '<i4'),
+                ('load_id', '<i4'),
+                ('aoi_id', '<i4'),
+            ]
+        }
+        aoi_names = [
+            aoi['name'] for aoi in json.loads((output_path / "aois.json").read_text())
+        ]
+        for tab_id in np.unique(gaze_tabs).tolist():
+            rows = hits['tab_id'] == tab_id
+            yield (
+                tab_id,
+                gaze_timestamps[gaze_tabs == tab_id],
+                hits['load_id'][rows],
+                hits['aoi_id'][rows],
+                aoi_names,
+                hits['timestamp_ns'][rows],
+            )
+
+        return
+
+    for tab_path in sorted(output_path.glob('tab-*')):
+        tab_id = int(tab_path.name[len('tab-'):])
+        tab_loads = sorted(
+            (timestamp, load_id)
+            for (tab, load_id), timestamp in load_timestamps.items()
+            if tab == tab_id
+        )
+        load_starts = np.array(
+            [timestamp for timestamp, _ in tab_loads], dtype=np.uint64
+        )
+        load_ids = np.array([-1] + [load_id for _, load_id in tab_loads])
+
+        aoi_paths = sorted(tab_path.glob('aoi-*.csv'))
+        aoi_timestamps = [read_csv_timestamps(aoi_path) for aoi_path in aoi_paths]
+        hit_timestamps = np.concatenate([np.zeros(0, dtype=np.uint64), *aoi_timestamps])
+        yield (
+            tab_id,
+            read_csv_timestamps(tab_path / "gazes.csv"),
+            load_ids[np.searchsorted(load_starts, hit_timestamps, 'right')],
+            np.repeat(
+                np.arange(len(aoi_paths)),
+                [len(timestamps) for timestamps in aoi_timestamps],
+            ),
+            [aoi_path.stem[len('aoi-') :] for aoi_path in aoi_paths],
+            hit_timestamps,
+        )
+
+
+def compute_aoi_metrics(
+    recording_path,
+    output_path,
+    event_journal=None,
+    cache_path=None,
+    max_visit_gap_ms=DEFAULT_MAX_VISIT_GAP_MS,
+):
+    # The metrics of `AoiMetrics`, from the output of an earlier processing run and
+    # the recording's events
+    recording_path = Path(recording_path)
+    metrics = AoiMetrics(max_visit_gap_ms=max_visit_gap_ms)
+
+    # Like the processor, replay events up to the last gaze sample. Without gaze
+    # samples, the table is empty.
+    gaze_file = recording_path / "gaze ps1.raw"
+    gaze_count = gaze_file.stat().st_size // 8
+    gaze_timestamps = load_array(gaze_file.with_suffix(".time"), '<u8')[:gaze_count]
+    if len(gaze_timestamps) == 0:
+        return metrics
+
+    compiled_events = events.load_events(recording_path, cache_path, event_journal)
+    records = compiled_events.records[
+        np.argsort(compiled_events.records['timestamp'], kind='stable')
+    ]
+    end_timestamp = int(gaze_timestamps.max())
+    for record in records[records['timestamp'] <= end_timestamp]:
+        metrics.process_event(record['timestamp'], record, compiled_events.names)
+
+    metrics.advance(end_timestamp)
+
+    load_timestamps = {key: timestamp for key, (timestamp, _) in metrics.loads.items()}
+    for (
+        tab_id,
+        sample_timestamps,
+        load_ids,
+        aoi_indices,
+        aoi_names,
+        hit_timestamps,
+    ) in read_output_hits(output_path, load_timestamps):
+        if len(hit_timestamps) == 0:
+            continue
+
+        keys, groups = np.unique(
+            np.stack([load_ids, aoi_indices], axis=1), axis=0, return_inverse=True
+        )
+        for group, hits, entries, dwell_ns, first_timestamp in zip(
+            *[
+                values.tolist()
+                for values in visit_metrics(
+                    sample_timestamps,
+                    groups.ravel(),
+                    hit_timestamps,
+                    metrics.max_visit_gap_ns,
+                )
+            ]
+        ):
+            load_id, aoi_idx = keys[group].tolist()
+            metrics.hit_stats[(tab_id, load_id, aoi_names[aoi_idx])] = [
+                hits,
+                entries,
+                dwell_ns,
+                first_timestamp,
+                -2,
+                0,
+            ]
+
+    return metrics
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=f"Compute {AOI_METRICS_FILE_NAME} for a recording that has already "
+        "been processed"
+    )
+    parser.add_argument("recording_path")
+    parser.add_argument("output_path", help="output path of pl-web-aois-process")
+    parser.add_argument("--event-journal", help="see pl-web-aois-process")
+    parser.add_argument(
+        "--max-visit-gap",
+        type=float,
+        default=DEFAULT_MAX_VISIT_GAP_MS,
+        help="end a visit to an AOI when consecutive gaze samples are further apart "
+        "than this many ms",
+    )
+    args = parser.parse_args()
+
+    metrics = compute_aoi_metrics(
+        args.recording_path,
+        args.output_path,
+        args.event_journal,
+        Path(args.output_path) / ".cache",
+        args.max_visit_gap,
+    )
+    metrics.write(Path(args.output_path) / AOI_METRICS_FILE_NAME)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,67 +1,659 @@
 from pathlib import Path
-import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import array
+import multiprocessing
 import csv
+import hashlib
+import json
+import shutil
+import uuid
+from functools import partial
 
 import numpy as np
 
 import decord
 from tqdm import tqdm
 
-from pupil_labs.real_time_screen_gaze.gaze_mapper import GazeMapper
+from surface_tracker import CornerId, Marker
+from pupil_labs.real_time_screen_gaze.gaze_mapper import create_apriltag_marker_uid
+
+from . import events
+from .aoi_definitions import AoiDefinitionIndex
+from .events import PAGES_FILE_NAME, load_array
+from .fixations import (
+    DEFAULT_MAX_FIXATION_VELOCITY,
+    DEFAULT_MIN_FIXATION_DURATION_MS,
+    FixationDetector,
+)
+from .gaze_mapper import RecordingGazeMapper
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation
+from .metrics import (
+    AOI_METRICS_FILE_NAME,
+    DEFAULT_MAX_VISIT_GAP_MS,
+    AoiMetrics,
+    compute_aoi_metrics,
+)
+
+
+CALIBRATION_DTYPE = np.dtype(
+    [
+        ("version", "u1"),
+        ("serial", "6S"),
+        ("scene_camera_matrix", "(3,3)d"),
+        ("scene_distortion_coefficients", "8d"),
+        ("scene_extrinsics_affine_matrix", "(4,4)d"),
+        ("right_camera_matrix", "(3,3)d"),
+        ("right_distortion_coefficients", "8d"),
+        ("right_extrinsics_affine_matrix", "(4,4)d"),
+        ("left_camera_matrix", "(3,3)d"),
+        ("left_distortion_coefficients", "8d"),
+        ("left_extrinsics_affine_matrix", "(4,4)d"),
+        ("crc", "u4"),
+    ]
+)
 
 
 def load_calibration(path):
-    return np.fromfile(
-        str(path),
-        np.dtype(
-            [
-                ("version", "u1"),
-                ("serial", "6a"),
-                ("scene_camera_matrix", "(3,3)d"),
-                ("scene_distortion_coefficients", "8d"),
-                ("scene_extrinsics_affine_matrix", "(4,4)d"),
-                ("right_camera_matrix", "(3,3)d"),
-                ("right_distortion_coefficients", "8d"),
-                ("right_extrinsics_affine_matrix", "(4,4)d"),
-                ("left_camera_matrix", "(3,3)d"),
-                ("left_distortion_coefficients", "8d"),
-                ("left_extrinsics_affine_matrix", "(4,4)d"),
-                ("crc", "u4"),
-            ]
-        ),
-    )
+    return np.fromfile(str(path), CALIBRATION_DTYPE)
+
+
+GAZE_FIELDS = [
+    'timestamp [ns]',
+    'x [norm]',
+    'y [norm]',
+    'window x [px]',
+    'window y [px]',
+    'page x [px]',
+    'page y [px]',
+]
+
+AOI_FIELDS = [
+    'timestamp [ns]',
+    'x [norm]',
+    'y [norm]',
+    'x [px]',
+    'y [px]',
+]
+
+# Column names of the binary tables follow the names numpy derives from the CSV headers
+GAZE_COLUMNS = [
+    ('timestamp_ns', '<u8'),
+    ('tab_id', '<i4'),
+    ('load_id', '<i4'),
+    ('x_norm', '<f8'),
+    ('y_norm', '<f8'),
+    ('window_x_px', '<f8'),
+    ('window_y_px', '<f8'),
+    ('page_x_px', '<f8'),
+    ('page_y_px', '<f8'),
+]
+
+AOI_HIT_COLUMNS = [
+    ('timestamp_ns', '<u8'),
+    ('tab_id', '<i4'),
+    ('load_id', '<i4'),
+    ('aoi_id', '<i4'),
+    ('x_norm', '<f8'),
+    ('y_norm', '<f8'),
+    ('x_px', '<f8'),
+    ('y_px', '<f8'),
+]
+
+# Fixations list the AOIs containing their centroid, separated by semicolons in
+# CSV files and as rows of the fixation_aois table in binary output
+FIXATION_FIELDS = [
+    'start timestamp [ns]',
+    'end timestamp [ns]',
+    'duration [ms]',
+    'page x [px]',
+    'page y [px]',
+    'aois',
+]
+
+FIXATION_COLUMNS = [
+    ('start_timestamp_ns', '<u8'),
+    ('tab_id', '<i4'),
+    ('load_id', '<i4'),
+    ('end_timestamp_ns', '<u8'),
+    ('duration_ms', '<f8'),
+    ('page_x_px', '<f8'),
+    ('page_y_px', '<f8'),
+]
+
+FIXATION_AOI_COLUMNS = [
+    ('start_timestamp_ns', '<u8'),
+    ('tab_id', '<i4'),
+    ('load_id', '<i4'),
+    ('aoi_id', '<i4'),
+]
+
+
+# Output is collected in memory and written in chunks of this many rows per file
+DEFAULT_CHUNK_SIZE = 4096
+
+# Sessions with many tabs and AOIs produce hundreds of files, so only this many are
+# kept open at once
+MAX_OPEN_FILES = 64
+
+# AOIs are bucketed by the square cells of this size (in page pixels) that they
+# overlap. AOIs covering more than AOI_GRID_MAX_CELLS cells (e.g., page sections)
+# are tested against every gaze sample instead, as are all AOIs of pages with up
+# to AOI_GRID_MIN_AOIS AOIs, where that's faster than looking up cells.
+AOI_GRID_CELL_SIZE = 256
+AOI_GRID_MAX_CELLS = 64
+AOI_GRID_MIN_AOIS = 150
+
+CSV_GAZE_DTYPES = [
+    dtype for name, dtype in GAZE_COLUMNS if name not in ('tab_id', 'load_id')
+]
+CSV_AOI_DTYPES = [
+    dtype
+    for name, dtype in AOI_HIT_COLUMNS
+    if name not in ('tab_id', 'load_id', 'aoi_id')
+]
+CSV_FIXATION_DTYPES = [
+    dtype for name, dtype in FIXATION_COLUMNS if name not in ('tab_id', 'load_id')
+] + [object]
+
+
+class OutputFilePool:
+    # Open output files, closing the least recently used one when there are too many.
+    # Closed files are reopened for appending when they are written to again.
+    def __init__(self, binary, max_open=MAX_OPEN_FILES):
+        self.binary = binary
+        self.max_open = max_open
+        self.open_files = OrderedDict()
+
+    def _open(self, path, mode):
+        while len(self.open_files) >= self.max_open:
+            _, output_file = self.open_files.popitem(last=False)
+            output_file.close()
+
+        if self.binary:
+            output_file = path.open(mode + 'b')
+        else:
+            output_file = path.open(mode + 't', newline='')
+
+        self.open_files[path] = output_file
+        return output_file
+
+    def create(self, path):
+        if path in self.open_files:
+            self.open_files.pop(path).close()
+
+        return self._open(path, 'w')
+
+    def get(self, path):
+        if path in self.open_files:
+            self.open_files.move_to_end(path)
+            return self.open_files[path]
+
+        return self._open(path, 'a')
+
+    def close(self):
+        for output_file in self.open_files.values():
+            output_file.close()
+
+        self.open_files.clear()
+
+
+class ColumnBuffer:
+    # Collects rows in preallocated column arrays and hands them to `flush_chunk`
+    # whenever `chunk_size` rows have accumulated
+    def __init__(self, dtypes, chunk_size, flush_chunk):
+        self.dtypes = dtypes
+        self.chunk_size = chunk_size
+        self.flush_chunk = flush_chunk
+        self.columns = None
+        self.size = 0
+
+    def append(self, values):
+        # `values` holds a sequence or a scalar (repeated for every row) per column
+        if self.columns is None:
+            self.columns = [np.empty(self.chunk_size, dtype) for dtype in self.dtypes]
+
+        row_count = len(values[0])
+        offset = 0
+        while offset < row_count:
+            count = min(row_count - offset, self.chunk_size - self.size)
+            for column, column_values in zip(self.columns, values):
+                if np.ndim(column_values) == 0:
+                    column[self.size:self.size + count] = column_values
+                else:
+                    column[self.size:self.size + count] = column_values[
+                        offset:offset + count
+                    ]
+
+            self.size += count
+            offset += count
+            if self.size == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if self.size == 0:
+            return
+
+        self.flush_chunk([column[:self.size] for column in self.columns])
+        self.size = 0
+
+
+class CsvOutputWriter:
+    # One folder per tab, containing gazes.csv and an aoi-<name>.csv file per AOI,
+    # and fixations.csv with `fixations`. Without `samples`, only fixations are written.
+    def __init__(
+        self,
+        output_path,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        max_open_files=MAX_OPEN_FILES,
+        instrumentation=NULL_INSTRUMENTATION,
+        samples=True,
+        fixations=False,
+    ):
+        self.output_path = Path(output_path)
+        self.chunk_size = chunk_size
+        self.instrumentation = instrumentation
+        self.samples = samples
+        self.fixations = fixations
+        self.files = OutputFilePool(binary=False, max_open=max_open_files)
+        self.paths = []
+        self.gaze_buffers = {}
+        self.aoi_buffers = []
+        self.aoi_names = []
+        self.fixation_buffers = {}
+
+    def _add_csv(self, path, fields, dtypes):
+        csv.writer(self.files.create(path)).writerow(fields)
+        self.paths.append(path)
+
+        return ColumnBuffer(dtypes, self.chunk_size, partial(self._write_rows, path))
+
+    def _write_rows(self, path, columns):
+        # float64 values must be converted to python floats to be written in full
+        # precision
+        with self.instrumentation.stage('write'):
+            csv.writer(self.files.get(path)).writerows(
+                zip(*[column.tolist() for column in columns])
+            )
+
+    def add_tab(self, tab_id):
+        tab_path = self.output_path / f"tab-{tab_id}"
+        tab_path.mkdir(parents=True, exist_ok=True)
+        if self.samples:
+            self.gaze_buffers[tab_id] = self._add_csv(
+                tab_path / "gazes.csv", GAZE_FIELDS, CSV_GAZE_DTYPES
+            )
+
+        if self.fixations:
+            self.fixation_buffers[tab_id] = self._add_csv(
+                tab_path / "fixations.csv", FIXATION_FIELDS, CSV_FIXATION_DTYPES
+            )
+
+    def add_aoi(self, tab_id, name):
+        self.aoi_names.append(name)
+        if self.samples:
+            aoi_path = self.output_path / f"tab-{tab_id}" / f"aoi-{name}.csv"
+            self.aoi_buffers.append(self._add_csv(aoi_path, AOI_FIELDS, CSV_AOI_DTYPES))
+
+        return len(self.aoi_names) - 1
+
+    def write_gazes(self, tab_id, load_id, columns):
+        self.instrumentation.count('gazes mapped', len(columns[0]))
+        self.gaze_buffers[tab_id].append(columns)
+
+    def write_aoi_hits(self, tab_id, load_id, aoi_id, columns):
+        self.instrumentation.count('aoi hits', len(columns[0]))
+        self.aoi_buffers[aoi_id].append(columns)
+
+    def write_fixations(self, tab_id, load_id, columns, aoi_ids):
+        # `aoi_ids` holds the list of AOIs containing each fixation's centroid
+        self.instrumentation.count('fixations', len(columns[0]))
+        aois = [
+            ';'.join(self.aoi_names[aoi_id] for aoi_id in fixation_aoi_ids)
+            for fixation_aoi_ids in aoi_ids
+        ]
+        self.fixation_buffers[tab_id].append([*columns, aois])
+
+    def close(self):
+        for buffer in [
+            *self.gaze_buffers.values(),
+            *self.aoi_buffers,
+            *self.fixation_buffers.values(),
+        ]:
+            buffer.flush()
+
+        self.files.close()
+        self.instrumentation.count(
+            'bytes written', sum(path.stat().st_size for path in self.paths)
+        )
+
+    @staticmethod
+    def merge(segment_paths, output_path):
+        merge_segment_outputs(segment_paths, output_path)
+
+
+class BinaryOutputWriter:
+    # Columnar tables with one raw little-endian array file per column, all tabs
+    # and AOIs combined:
+    #   gazes/<column>.bin, aoi_hits/<column>.bin, a schema.json per table
+    #   fixations/<column>.bin, fixation_aois/<column>.bin with `fixations`
+    #   aois.json, mapping AOI ids to tab ids and names
+    # Without `samples`, only the fixation tables are written.
+    sample_tables = {
+        'gazes': GAZE_COLUMNS,
+        'aoi_hits': AOI_HIT_COLUMNS,
+    }
+    fixation_tables = {
+        'fixations': FIXATION_COLUMNS,
+        'fixation_aois': FIXATION_AOI_COLUMNS,
+    }
+
+    def __init__(
+        self,
+        output_path,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        max_open_files=MAX_OPEN_FILES,
+        instrumentation=NULL_INSTRUMENTATION,
+        samples=True,
+        fixations=False,
+    ):
+        self.output_path = Path(output_path)
+        self.instrumentation = instrumentation
+        self.files = OutputFilePool(binary=True, max_open=max_open_files)
+        self.paths = []
+        self.aois = []
+
+        self.tables = {
+            **(self.sample_tables if samples else {}),
+            **(self.fixation_tables if fixations else {}),
+        }
+        self.buffers = {}
+        for table_name, columns in self.tables.items():
+            table_path = self.output_path / table_name
+            table_path.mkdir(parents=True, exist_ok=True)
+            (table_path / "schema.json").write_text(json.dumps(columns))
+
+            column_paths = [table_path / f"{name}.bin" for name, _ in columns]
+            for column_path in column_paths:
+                self.files.create(column_path)
+
+            self.paths.extend(column_paths)
+
+            self.buffers[table_name] = ColumnBuffer(
+                [dtype for _, dtype in columns],
+                chunk_size,
+                partial(self._write_columns, column_paths),
+            )
+
+    def _write_columns(self, column_paths, columns):
+        with self.instrumentation.stage('write'):
+            for column_path, column in zip(column_paths, columns):
+                column.tofile(self.files.get(column_path))
+
+    def add_tab(self, tab_id):
+        pass
+
+    def add_aoi(self, tab_id, name):
+        self.aois.append({'aoi_id': len(self.aois), 'tab_id': tab_id, 'name': name})
+
+        return len(self.aois) - 1
+
+    def write_gazes(self, tab_id, load_id, columns):
+        self.instrumentation.count('gazes mapped', len(columns[0]))
+        self.buffers['gazes'].append([columns[0], tab_id, load_id, *columns[1:]])
+
+    def write_aoi_hits(self, tab_id, load_id, aoi_id, columns):
+        self.instrumentation.count('aoi hits', len(columns[0]))
+        self.buffers['aoi_hits'].append(
+            [columns[0], tab_id, load_id, aoi_id, *columns[1:]]
+        )
+
+    def write_fixations(self, tab_id, load_id, columns, aoi_ids):
+        self.instrumentation.count('fixations', len(columns[0]))
+        self.buffers['fixations'].append([columns[0], tab_id, load_id, *columns[1:]])
+
+        fixation_indices = [
+            idx
+            for idx, fixation_aoi_ids in enumerate(aoi_ids)
+            for _ in fixation_aoi_ids
+        ]
+        if len(fixation_indices) > 0:
+            self.buffers['fixation_aois'].append([
+                np.asarray(columns[0])[fixation_indices],
+                tab_id,
+                load_id,
+                [aoi_id for fixation_aoi_ids in aoi_ids for aoi_id in fixation_aoi_ids],
+            ])
+
+    def close(self):
+        for buffer in self.buffers.values():
+            buffer.flush()
+
+        self.files.close()
+        self.instrumentation.count(
+            'bytes written', sum(path.stat().st_size for path in self.paths)
+        )
+        (self.output_path / "aois.json").write_text(json.dumps(self.aois, indent=4))
+
+    @classmethod
+    def merge(cls, segment_paths, output_path):
+        # Every segment replays all events before it, so AOI ids are assigned in the
+        # same order everywhere and the last segment knows about every AOI
+        for table_name, columns in {**cls.sample_tables, **cls.fixation_tables}.items():
+            if not (segment_paths[0] / table_name).exists():
+                continue
+
+            table_path = output_path / table_name
+            table_path.mkdir(parents=True, exist_ok=True)
+            shutil.copy(segment_paths[0] / table_name / "schema.json", table_path)
+
+            for name, _ in columns:
+                with (table_path / f"{name}.bin").open('wb') as destination_file:
+                    for segment_path in segment_paths:
+                        with (segment_path / table_name / f"{name}.bin").open(
+                            'rb'
+                        ) as source_file:
+                            shutil.copyfileobj(source_file, destination_file)
+
+        shutil.copy(segment_paths[-1] / "aois.json", output_path)
+
+
+OUTPUT_WRITERS = {
+    'csv': CsvOutputWriter,
+    'binary': BinaryOutputWriter,
+}
+
+
+class AoiGridIndex:
+    # AOI bounds, as rows of (x, y, width, height) in page coordinates, bucketed by
+    # the grid cells they overlap so gaze is only tested against the AOIs near it.
+    # Updating an AOI only touches the cells it moved out of and into.
+    def __init__(self, cell_size=AOI_GRID_CELL_SIZE, max_cells=AOI_GRID_MAX_CELLS):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.count = 0
+        self._bounds = np.empty((16, 4))
+        self.cells = {}
+        self.aoi_cells = []
+        self.large_aois = set()
+
+        # Sorted arrays of the AOIs in a cell and the large AOIs, rebuilt when they
+        # change
+        self.cell_candidates = {}
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def bounds(self):
+        return self._bounds[:self.count]
+
+    def _cells(self, bounds):
+        # Cells that points inside `bounds` fall into, or None if there are too many.
+        # The margin keeps points on the far edges in range despite rounding.
+        x, y, width, height = bounds
+        if not (width > 0 and height > 0):
+            return []
+
+        x0, y0 = int(np.floor((x - 1e-3) / self.cell_size)), int(
+            np.floor((y - 1e-3) / self.cell_size)
+        )
+        x1 = int(np.floor((x + width + 1e-3) / self.cell_size))
+        y1 = int(np.floor((y + height + 1e-3) / self.cell_size))
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > self.max_cells:
+            return None
+
+        return [(cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)]
+
+    def set(self, aoi_idx, bounds):
+        # Adds the AOI `aoi_idx` (the next index) or moves an existing one
+        if aoi_idx == self.count:
+            if self.count == len(self._bounds):
+                self._bounds = np.concatenate(
+                    [self._bounds, np.empty_like(self._bounds)]
+                )
+
+            self.count += 1
+            self.aoi_cells.append([])
+        else:
+            self._remove(aoi_idx)
+
+        self._bounds[aoi_idx] = bounds
+        cells = self._cells(bounds)
+        self.aoi_cells[aoi_idx] = cells
+        if cells is None:
+            self.large_aois.add(aoi_idx)
+            self.cell_candidates.clear()
+            return
+
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(aoi_idx)
+            self.cell_candidates.pop(cell, None)
+
+    def _remove(self, aoi_idx):
+        cells = self.aoi_cells[aoi_idx]
+        if cells is None:
+            self.large_aois.discard(aoi_idx)
+            self.cell_candidates.clear()
+            return
+
+        for cell in cells:
+            self.cells[cell].discard(aoi_idx)
+            self.cell_candidates.pop(cell, None)
+
+    def _cell_candidates(self, cell):
+        if cell not in self.cell_candidates:
+            candidates = sorted(self.cells.get(cell, set()) | self.large_aois)
+            self.cell_candidates[cell] = np.array(candidates, dtype=np.intp)
+
+        return self.cell_candidates[cell]
+
+    def candidates(self, point):
+        # Sorted indices of the AOIs that may contain `point`
+        cell = (
+            int(np.floor(point[0] / self.cell_size)),
+            int(np.floor(point[1] / self.cell_size)),
+        )
+
+        return self._cell_candidates(cell).tolist()
+
+    def query(self, points, min_aois=AOI_GRID_MIN_AOIS):
+        # Finds all AOIs containing each of the (N, 2) `points`. Returns arrays of
+        # point and AOI indices of the hits, sorted by AOI and then point.
+        if self.count <= min_aois:
+            relative = points[np.newaxis, :, :] - self.bounds[:, np.newaxis, :2]
+            inside = np.all(
+                (relative > 0) & (relative < self.bounds[:, np.newaxis, 2:]), axis=2
+            )
+            aoi_indices, point_indices = np.nonzero(inside)
+
+            return point_indices, aoi_indices
+
+        # (point, candidate AOI) pairs, with the candidates of each point's cell
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        keys = (cells[:, 0] << 32) ^ (cells[:, 1] & 0xffffffff)
+        _, first_indices, inverse = np.unique(
+            keys, return_index=True, return_inverse=True
+        )
+        cell_candidates = [
+            self._cell_candidates(cell)
+            for cell in map(tuple, cells[first_indices].tolist())
+        ]
+        candidate_counts = np.array([len(candidates) for candidates in cell_candidates])
+        candidate_offsets = np.cumsum(candidate_counts) - candidate_counts
+
+        pair_counts = candidate_counts[inverse.ravel()]
+        pair_count = int(pair_counts.sum())
+        if pair_count == 0:
+            return np.empty(0, np.intp), np.empty(0, np.intp)
+
+        point_indices = np.repeat(np.arange(len(points)), pair_counts)
+        pair_offsets = np.repeat(
+            candidate_offsets[inverse.ravel()] - (np.cumsum(pair_counts) - pair_counts),
+            pair_counts,
+        )
+        aoi_indices = np.concatenate(cell_candidates)[
+            pair_offsets + np.arange(pair_count)
+        ]
+
+        relative = points[point_indices] - self.bounds[aoi_indices, :2]
+        inside = np.all(
+            (relative > 0) & (relative < self.bounds[aoi_indices, 2:]), axis=1
+        )
+        point_indices, aoi_indices = point_indices[inside], aoi_indices[inside]
+        order = np.lexsort((point_indices, aoi_indices))
+
+        return point_indices[order], aoi_indices[order]
+
+    def innermost(self, point_indices, aoi_indices):
+        # Keeps only the smallest AOI hit per point, i.e., the innermost of nested
+        # AOIs. Ties go to the AOI that was added first.
+        areas = self.bounds[aoi_indices, 2] * self.bounds[aoi_indices, 3]
+        order = np.lexsort((aoi_indices, areas, point_indices))
+        first = np.ones(len(order), bool)
+        first[1:] = point_indices[order][1:] != point_indices[order][:-1]
+        keep = np.sort(order[first])
+
+        return point_indices[keep], aoi_indices[keep]
 
 
 class BrowserTabState:
-    def __init__(self, id, output_path):
+
+    def __init__(
+        self, id, writer, innermost_aoi=False, fixation_detector=None, samples=True
+    ):
         self.id = id
         self.history = []
+        self.load_id = -1
         self.marker_verts = {}
         self.markers_dirty = False
         self.surface = None
         self.scroll_position = (0, 0)
-        self.aoi_definitions = {}
 
-        self.output_path = output_path
-        self.output_path.mkdir(parents=True, exist_ok=True)
-        self.gaze_writer = csv.DictWriter(
-            (output_path/"gazes.csv").open('wt'),
-            [
-                'timestamp [ns]',
-                'x [norm]',
-                'y [norm]',
-                'window x [px]',
-                'window y [px]',
-                'page x [px]',
-                'page y [px]',
-            ]
-        )
-        self.aoi_writers = {}
+        # With `innermost_aoi`, gaze only hits the smallest of the AOIs containing it
+        self.aoi_names = []
+        self.aoi_indices = {}
+        self.aoi_ids = []
+        self.aoi_index = AoiGridIndex()
+        self.innermost_aoi = innermost_aoi
+
+        # Gaze on the page is grouped into fixations with a `FixationDetector`.
+        # Without `samples`, gaze samples and their AOI hits aren't written.
+        self.fixation_detector = fixation_detector
+        self.samples = samples
 
-        self.gaze_writer.writeheader()
+        self.writer = writer
+        self.writer.add_tab(self.id)
 
-    def add_history(self, url):
-        self.history.append(url)
+    @property
+    def aoi_bounds(self):
+        return self.aoi_index.bounds
+
+    def add_history(self, url, load_id, timestamp):
+        # Fixations don't continue onto another page
+        self.flush_fixations()
+        self.history.append((load_id, url, timestamp))
+        self.load_id = load_id
 
     def set_marker_bounds(self, marker_id, x, y, width, height):
         self.markers_dirty = True
@@ -73,24 +665,14 @@ class BrowserTabState:
         ]
 
     def set_aoi(self, name, x, y, width, height):
-        self.aoi_definitions[name] = {
-            'top_left': (x, y),
-            'width': width,
-            'height': height
-        }
-        if name not in self.aoi_writers:
-            self.aoi_writers[name] = csv.DictWriter(
-                (self.output_path/f"aoi-{name}.csv").open('wt'),
-                [
-                    'timestamp [ns]',
-                    'x [norm]',
-                    'y [norm]',
-                    'x [px]',
-                    'y [px]',
-                ]
-            )
-            self.aoi_writers[name].writeheader()
+        if name in self.aoi_indices:
+            self.aoi_index.set(self.aoi_indices[name], (x, y, width, height))
+            return
 
+        self.aoi_indices[name] = len(self.aoi_names)
+        self.aoi_names.append(name)
+        self.aoi_index.set(self.aoi_indices[name], (x, y, width, height))
+        self.aoi_ids.append(self.writer.add_aoi(self.id, name))
 
     def set_scroll_position(self, x, y):
         self.scroll_position = (x, y)
@@ -105,133 +687,1009 @@ class BrowserTabState:
         ]
         page_gaze = [window_gaze[i] + self.scroll_position[i] for i in range(2)]
 
-        self.gaze_writer.writerow({
-            "timestamp [ns]": timestamp,
-            "x [norm]": surface_gaze.x,
-            "y [norm]": surface_gaze.y,
-            "window x [px]": window_gaze[0],
-            "window y [px]": window_gaze[1],
-            "page x [px]": page_gaze[0],
-            "page y [px]": page_gaze[1],
-        })
-
-        for aoi_name, aoi_bounds in self.aoi_definitions.items():
-            aoi_gaze = [page_gaze[i] - aoi_bounds['top_left'][i] for i in range(2)]
-
-            x_ok = 0 < aoi_gaze[0] < aoi_bounds['width']
-            y_ok = 0 < aoi_gaze[1] < aoi_bounds['height']
+        if self.fixation_detector is not None:
+            self.write_fixations(
+                *self.fixation_detector.add([timestamp], [page_gaze[0]], [page_gaze[1]])
+            )
+
+        if not self.samples:
+            return
+
+        self.writer.write_gazes(self.id, self.load_id, [
+            [timestamp],
+            [surface_gaze.x],
+            [surface_gaze.y],
+            [window_gaze[0]],
+            [window_gaze[1]],
+            [page_gaze[0]],
+            [page_gaze[1]],
+        ])
+
+        hits = []
+        for aoi_idx in self.aoi_index.candidates(page_gaze):
+            x, y, width, height = self.aoi_bounds[aoi_idx].tolist()
+            aoi_gaze = [page_gaze[0] - x, page_gaze[1] - y]
+
+            x_ok = 0 < aoi_gaze[0] < width
+            y_ok = 0 < aoi_gaze[1] < height
             if x_ok and y_ok:
-                self.aoi_writers[aoi_name].writerow({
-                    'timestamp [ns]': timestamp,
-                    'x [px]': aoi_gaze[0],
-                    'y [px]': aoi_gaze[1],
-                    'x [norm]': aoi_gaze[0] / aoi_bounds['width'],
-                    'y [norm]': aoi_gaze[1] / aoi_bounds['height'],
-                })
-
-class MatchedIterator:
-    def __init__(self, *iterables):
-        self.iterators = [iter(itr) for itr in iterables]
-
-    def __next__(self):
-        return [next(itr) for itr in self.iterators]
-
-class ExpirationGenerator:
-    def __init__(self, timed_data_collection):
-        self.itr = iter(timed_data_collection)
-        self.buffer = None
-        self.reached_end_of_iterator = False
-
-    def until(self, timestamp):
-        if self.reached_end_of_iterator:
+                hits.append((width * height, aoi_idx, aoi_gaze, width, height))
+
+        if self.innermost_aoi and len(hits) > 0:
+            hits = [min(hits, key=lambda hit: hit[:2])]
+
+        for _, aoi_idx, aoi_gaze, width, height in hits:
+            self.writer.write_aoi_hits(self.id, self.load_id, self.aoi_ids[aoi_idx], [
+                [timestamp],
+                [aoi_gaze[0] / width],
+                [aoi_gaze[1] / height],
+                [aoi_gaze[0]],
+                [aoi_gaze[1]],
+            ])
+
+    def process_gazes(self, timestamps, surface_gazes, browser_size):
+        # Vectorized equivalent of calling `process_gaze` for each sample
+        surface_gazes = np.asarray(surface_gazes, dtype=np.float64)
+        on_surface = np.all((surface_gazes >= 0.0) & (surface_gazes <= 1.0), axis=1)
+        if not np.any(on_surface):
             return
 
-        if self.buffer is not None:
-            if timestamp is not None and self.buffer[0] > timestamp:
-                return
+        timestamps = np.asarray(timestamps)[on_surface]
+        surface_gazes = surface_gazes[on_surface]
 
-            yield self.buffer
+        window_gazes = np.empty_like(surface_gazes)
+        window_gazes[:, 0] = surface_gazes[:, 0] * browser_size[0]
+        window_gazes[:, 1] = browser_size[1] - surface_gazes[:, 1] * browser_size[1]
+        page_gazes = window_gazes + self.scroll_position
 
-        try:
-            self.buffer = next(self.itr)
-            while timestamp is None or self.buffer[0] <= timestamp:
-                yield self.buffer
-                self.buffer = next(self.itr)
-        except StopIteration:
-            self.reached_end_of_iterator = True
+        if self.fixation_detector is not None:
+            self.write_fixations(*self.fixation_detector.add(timestamps, *page_gazes.T))
+
+        if not self.samples:
+            return
+
+        self.writer.write_gazes(self.id, self.load_id, [
+            timestamps,
+            *surface_gazes.T,
+            *window_gazes.T,
+            *page_gazes.T,
+        ])
+
+        if len(self.aoi_names) == 0:
+            return
+
+        point_indices, aoi_indices = self.aoi_index.query(page_gazes)
+        if self.innermost_aoi:
+            point_indices, aoi_indices = self.aoi_index.innermost(
+                point_indices, aoi_indices
+            )
+
+        # Gaze positions relative to each hit AOI's top-left corner
+        aoi_px = page_gazes[point_indices] - self.aoi_bounds[aoi_indices, :2]
+        aoi_norm = aoi_px / self.aoi_bounds[aoi_indices, 2:]
+
+        boundaries = np.flatnonzero(np.diff(aoi_indices)) + 1
+        for rows in np.split(np.arange(len(aoi_indices)), boundaries):
+            if len(rows) == 0:
+                continue
+
+            self.writer.write_aoi_hits(
+                self.id,
+                self.load_id,
+                self.aoi_ids[aoi_indices[rows[0]]],
+                [
+                    timestamps[point_indices[rows]],
+                    *aoi_norm[rows].T,
+                    *aoi_px[rows].T,
+                ],
+            )
+
+    def write_fixations(self, starts, ends, x, y):
+        # Fixations hit the AOIs containing their centroid, with the AOI bounds of
+        # the time the fixation ended
+        if len(starts) == 0:
             return
 
+        aoi_ids = [[] for _ in range(len(starts))]
+        if len(self.aoi_names) > 0:
+            point_indices, aoi_indices = self.aoi_index.query(np.column_stack([x, y]))
+            if self.innermost_aoi:
+                point_indices, aoi_indices = self.aoi_index.innermost(
+                    point_indices, aoi_indices
+                )
+
+            for point_idx, aoi_idx in sorted(
+                zip(point_indices.tolist(), aoi_indices.tolist())
+            ):
+                aoi_ids[point_idx].append(self.aoi_ids[aoi_idx])
+
+        self.writer.write_fixations(
+            self.id, self.load_id, [starts, ends, (ends - starts) / 1e6, x, y], aoi_ids
+        )
+
+    def flush_fixations(self):
+        if self.fixation_detector is not None:
+            self.write_fixations(*self.fixation_detector.flush())
+
+
+def decode_frames(video_reader, frame_indices, max_skip=32):
+    # Decodes only the requested frames, skipping or seeking over the others
+    position = 0
+    for frame_index in frame_indices:
+        gap = frame_index - position
+        if 0 < gap <= max_skip:
+            video_reader.skip_frames(gap)
+        elif gap != 0:
+            video_reader.seek_accurate(frame_index)
+
+        yield frame_index, video_reader.next()
+        position = frame_index + 1
+
+
+def interpolate_markers(markers_a, markers_b, alpha):
+    corner_order = CornerId.all_corners()
+    markers_b_by_uid = {marker.uid: marker for marker in markers_b}
+
+    interpolated = []
+    for marker_a in markers_a:
+        marker_b = markers_b_by_uid.get(marker_a.uid)
+        if marker_b is None:
+            continue
+
+        verts_a = np.array(marker_a._vertices_in_order(order=corner_order))
+        verts_b = np.array(marker_b._vertices_in_order(order=corner_order))
+        interpolated.append(
+            Marker.from_vertices(
+                uid=marker_a.uid,
+                undistorted_image_space_vertices=(
+                    verts_a + (verts_b - verts_a) * alpha
+                ).tolist(),
+                starting_with=corner_order[0],
+                clockwise=True,
+            )
+        )
+
+    if len(interpolated) == 0:
+        return markers_a if alpha < 0.5 else markers_b
+
+    return interpolated
+
+
+def schedule_scene_frames(
+    frame_timestamps, gaze_timestamps, start_timestamp, end_timestamp=None
+):
+    # A scene frame is only worth decoding while the browser is open, i.e. once
+    # surfaces can exist and until the browser was closed, and if any gaze samples
+    # will be mapped with it, i.e. samples before the following frame
+    if start_timestamp is None:
+        return np.zeros(len(frame_timestamps), dtype=bool)
+
+    next_frame_timestamps = np.append(frame_timestamps[1:], np.iinfo(np.uint64).max)
+    gaze_counts = (
+        np.searchsorted(gaze_timestamps, next_frame_timestamps, side='right')
+        - np.searchsorted(gaze_timestamps, frame_timestamps, side='right')
+    )
+
+    scheduled = (gaze_counts > 0) & (frame_timestamps >= start_timestamp)
+    if end_timestamp is not None:
+        scheduled &= frame_timestamps < end_timestamp
+
+    return scheduled
+
+
+def marker_cache_key(video_file, calibration, detector_params):
+    # Videos are large, so only their size and their first and last MiB are hashed
+    digest = hashlib.sha1()
+    video_size = Path(video_file).stat().st_size
+    digest.update(str(video_size).encode())
+    with Path(video_file).open('rb') as input_file:
+        digest.update(input_file.read(1 << 20))
+        input_file.seek(max(0, video_size - (1 << 20)))
+        digest.update(input_file.read())
+
+    # Detected vertices are undistorted with the scene camera's intrinsics
+    digest.update(calibration['scene_camera_matrix'].tobytes())
+    digest.update(calibration['scene_distortion_coefficients'].tobytes())
+
+    params = {
+        k: v for k, v in detector_params.items() if k not in ('nthreads', 'debug')
+    }
+    digest.update(json.dumps(params, sort_keys=True).encode())
+
+    return digest.hexdigest()
+
+
+class MarkerDetectionCache:
+    # Marker detections per video frame, stored as arrays of frame indices, offsets
+    # into the marker rows of each frame, tag ids and undistorted corners. Parallel
+    # segments each add a part file, which are consolidated into one file later.
+    # New detections are appended to flat arrays in the same layout rather than kept
+    # as marker objects until they are saved.
+    corner_order = CornerId.all_corners()
+
+    def __init__(self, cache_path, key):
+        self.cache_path = Path(cache_path)
+        self.key = key
+        self.frame_count = None
+        self.frame_indices = np.empty(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.tag_ids = np.empty(0, dtype=np.int32)
+        self.corners = np.empty((0, 4, 2))
+        self.new_frames = {}
+        self.new_offsets = array.array('q', [0])
+        self.new_tag_ids = array.array('i')
+        self.new_corners = array.array('d')
+
+        part_files = sorted(self.cache_path.glob(f"markers-{key}*.npz"))
+        if len(part_files) > 0:
+            self._set_arrays(
+                self._merge_arrays(
+                    [self._load_arrays(part_file) for part_file in part_files]
+                )
+            )
+
+    @staticmethod
+    def _load_arrays(cache_file):
+        with np.load(cache_file) as cached:
+            return {name: cached[name] for name in cached.files}
+
+    @staticmethod
+    def _merge_arrays(parts):
+        frame_indices, offsets, tag_ids, corners = [], [], [], []
+        marker_count = 0
+        for part in parts:
+            frame_indices.append(part['frame_indices'])
+            offsets.append(part['offsets'][:-1] + marker_count)
+            tag_ids.append(part['tag_ids'])
+            corners.append(part['corners'])
+            marker_count += len(part['tag_ids'])
+
+        frame_indices = np.concatenate(frame_indices)
+        offsets = np.concatenate(offsets + [[marker_count]])
+        frame_counts = [
+            part['frame_count'] for part in parts if part['frame_count'] >= 0
+        ]
+
+        # Frames may be in several parts, keep the first detection of each
+        _, first = np.unique(frame_indices, return_index=True)
+        rows = np.concatenate(
+            [np.arange(offsets[idx], offsets[idx + 1]) for idx in first] + [[]]
+        ).astype(np.int64)
+        counts = offsets[first + 1] - offsets[first]
+
+        return {
+            'frame_count': frame_counts[0] if len(frame_counts) > 0 else -1,
+            'frame_indices': frame_indices[first],
+            'offsets': np.concatenate([[0], np.cumsum(counts)]),
+            'tag_ids': np.concatenate(tag_ids)[rows],
+            'corners': np.concatenate(corners)[rows].reshape((-1, 4, 2)),
+        }
+
+    def _set_arrays(self, arrays):
+        self.frame_count = (
+            None if arrays['frame_count'] < 0 else int(arrays['frame_count'])
+        )
+        self.frame_indices = arrays['frame_indices']
+        self.offsets = arrays['offsets']
+        self.tag_ids = arrays['tag_ids']
+        self.corners = arrays['corners']
+
+    def _find(self, frame_index):
+        idx = np.searchsorted(self.frame_indices, frame_index)
+        if idx < len(self.frame_indices) and self.frame_indices[idx] == frame_index:
+            return idx
+
+        return None
+
+    def __contains__(self, frame_index):
+        return frame_index in self.new_frames or self._find(frame_index) is not None
+
+    def _markers(self, tag_ids, corners):
+        return [
+            Marker.from_vertices(
+                uid=create_apriltag_marker_uid('tag36h11', tag_id),
+                undistorted_image_space_vertices=marker_corners,
+                starting_with=self.corner_order[0],
+                clockwise=True,
+            )
+            for tag_id, marker_corners in zip(tag_ids.tolist(), corners.tolist())
+        ]
+
+    def get(self, frame_index):
+        if frame_index in self.new_frames:
+            idx = self.new_frames[frame_index]
+            start, end = self.new_offsets[idx], self.new_offsets[idx + 1]
+            return self._markers(
+                np.frombuffer(self.new_tag_ids, dtype=np.int32)[start:end],
+                np.frombuffer(self.new_corners, dtype=np.float64).reshape((-1, 4, 2))[
+                    start:end
+                ],
+            )
+
+        idx = self._find(frame_index)
+        rows = slice(self.offsets[idx], self.offsets[idx + 1])
+        return self._markers(self.tag_ids[rows], self.corners[rows])
+
+    def add(self, frame_index, markers):
+        if frame_index in self.new_frames:
+            return
+
+        self.new_frames[frame_index] = len(self.new_frames)
+        for marker in markers:
+            self.new_tag_ids.append(int(marker.uid.split(':')[-1]))
+            for corner in marker._vertices_in_order(order=self.corner_order):
+                self.new_corners.extend(corner)
+
+        self.new_offsets.append(len(self.new_tag_ids))
+
+    def _new_arrays(self):
+        # Merging sorts the frames
+        return self._merge_arrays(
+            [
+                {
+                    'frame_count': -1 if self.frame_count is None else self.frame_count,
+                    'frame_indices': np.fromiter(
+                        self.new_frames, dtype=np.int64, count=len(self.new_frames)
+                    ),
+                    'offsets': np.array(self.new_offsets, dtype=np.int64),
+                    'tag_ids': np.array(self.new_tag_ids, dtype=np.int32),
+                    'corners': np.array(self.new_corners, dtype=np.float64).reshape(
+                        (-1, 4, 2)
+                    ),
+                }
+            ]
+        )
+
+    def _write(self, cache_file, arrays):
+        temp_file = cache_file.with_name(f".{cache_file.name}.{uuid.uuid4().hex}")
+        with temp_file.open('wb') as output_file:
+            np.savez(output_file, **arrays)
+
+        temp_file.replace(cache_file)
+
+    def save_part(self):
+        # Only writes the new detections, next to the files of other segments
+        if len(self.new_frames) > 0:
+            self.cache_path.mkdir(parents=True, exist_ok=True)
+            self._write(
+                self.cache_path / f"markers-{self.key}-{uuid.uuid4().hex}.npz",
+                self._new_arrays(),
+            )
+
+    def save(self):
+        # Consolidates everything into a single file and removes stale caches
+        arrays = self._merge_arrays([
+            {
+                'frame_count': -1 if self.frame_count is None else self.frame_count,
+                'frame_indices': self.frame_indices,
+                'offsets': self.offsets,
+                'tag_ids': self.tag_ids,
+                'corners': self.corners,
+            },
+            self._new_arrays(),
+        ])
+        stale_files = list(self.cache_path.glob("markers-*.npz"))
+
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        cache_file = self.cache_path / f"markers-{self.key}.npz"
+        self._write(cache_file, arrays)
+        for stale_file in stale_files:
+            if stale_file != cache_file:
+                stale_file.unlink()
+
+
+class SceneMarkerSource:
+    # Provides marker detections for scheduled scene frames. Only every `stride`-th
+    # scheduled frame is detected, markers on the frames in between are interpolated
+    # from the surrounding detected frames. Frames are only decoded if their markers
+    # aren't in `detection_cache`.
+    def __init__(
+        self,
+        gaze_mapper,
+        open_video,
+        frame_indices,
+        frame_timestamps,
+        scheduled,
+        stride=1,
+        detection_cache=None,
+        instrumentation=NULL_INSTRUMENTATION,
+    ):
+        self.gaze_mapper = gaze_mapper
+        self.frame_indices = frame_indices
+        self.frame_timestamps = frame_timestamps
+        self.open_video = open_video
+        self.detection_cache = detection_cache
+        self.instrumentation = instrumentation
+
+        scheduled_positions = np.flatnonzero(scheduled)
+        keyframes = scheduled_positions[::stride]
+        if len(scheduled_positions) > 0 and keyframes[-1] != scheduled_positions[-1]:
+            keyframes = np.append(keyframes, scheduled_positions[-1])
+
+        self.keyframes = keyframes
+        self.keyframe_timestamps = frame_timestamps[keyframes]
+        self.frames = None
+        self.detections = {}
+        self.detected_keyframes = 0
+
+    def detect_markers(self, keyframe):
+        frame_index = int(self.frame_indices[keyframe])
+        if self.detection_cache is not None and frame_index in self.detection_cache:
+            self.instrumentation.count('frames from cache')
+            return self.detection_cache.get(frame_index)
+
+        if self.frames is None:
+            uncached_frame_indices = [
+                frame_index
+                for frame_index in self.frame_indices[
+                    self.keyframes[self.detected_keyframes :]
+                ].tolist()
+                if self.detection_cache is None
+                or frame_index not in self.detection_cache
+            ]
+            self.frames = decode_frames(self.open_video(), uncached_frame_indices)
+
+        with self.instrumentation.stage('decode'):
+            _, frame = next(self.frames)
+
+        with self.instrumentation.stage('copy frames'):
+            image = frame.asnumpy()
+
+        with self.instrumentation.stage('detect markers'):
+            markers = self.gaze_mapper.detect_markers(image)
+
+        self.instrumentation.count('frames decoded')
+        if self.detection_cache is not None:
+            self.detection_cache.add(frame_index, markers)
+
+        return markers
+
+    def keyframe_markers(self, keyframe_idx):
+        # Keyframes are requested in order, and frames in between are interpolated
+        # from the previous keyframe, so detections before that aren't needed again
+        while self.detected_keyframes <= keyframe_idx:
+            keyframe = self.keyframes[self.detected_keyframes]
+            self.detections[keyframe] = self.detect_markers(keyframe)
+            self.detected_keyframes += 1
+
+        self.forget_before(self.keyframes[max(keyframe_idx - 1, 0)])
+
+        return self.detections[self.keyframes[keyframe_idx]]
+
+    def forget_before(self, keyframe):
+        for detected_keyframe in list(self.detections):
+            if detected_keyframe < keyframe:
+                del self.detections[detected_keyframe]
+
+    def markers(self, position):
+        next_keyframe_idx = np.searchsorted(self.keyframes, position)
+        next_markers = self.keyframe_markers(next_keyframe_idx)
+
+        next_keyframe = self.keyframes[next_keyframe_idx]
+        if next_keyframe == position:
+            return next_markers
+
+        previous_keyframe = self.keyframes[next_keyframe_idx - 1]
+        self.instrumentation.count('frames interpolated')
+
+        t0, t, t1 = self.frame_timestamps[
+            [previous_keyframe, position, next_keyframe]
+        ].astype(np.float64)
+        return interpolate_markers(
+            self.detections[previous_keyframe],
+            next_markers,
+            (t - t0) / (t1 - t0),
+        )
+
+
+def split_scheduled_frames(scheduled_frames, count, stride=1):
+    # Splits the frame positions into up to `count` contiguous ranges with roughly
+    # equal numbers of scheduled (i.e., decoded) frames. Ranges start on keyframes
+    # (every `stride`-th scheduled frame), so segments detect the same keyframes as
+    # a single run.
+    keyframes = np.flatnonzero(scheduled_frames)[::stride]
+    boundaries = keyframes[np.linspace(0, len(keyframes), count + 1).astype(int)[1:-1]]
+    boundaries = np.unique(np.concatenate([[0], boundaries, [len(scheduled_frames)]]))
+
+    return list(zip(boundaries[:-1].tolist(), boundaries[1:].tolist()))
+
+
+def merge_segment_outputs(segment_paths, output_path):
+    # Segments cover consecutive time ranges, so concatenating their files in
+    # segment order keeps every output file sorted by timestamp
+    relative_paths = {
+        data_file.relative_to(segment_path)
+        for segment_path in segment_paths
+        for data_file in segment_path.glob('tab-*/*.csv')
+    }
+
+    for relative_path in sorted(relative_paths):
+        destination = output_path / relative_path
+        destination.parent.mkdir(parents=True, exist_ok=True)
+
+        with destination.open('wb') as destination_file:
+            header_written = False
+            for segment_path in segment_paths:
+                source = segment_path / relative_path
+                if not source.exists():
+                    continue
+
+                with source.open('rb') as source_file:
+                    header = source_file.readline()
+                    if not header_written:
+                        destination_file.write(header)
+                        header_written = True
+
+                    shutil.copyfileobj(source_file, destination_file)
+
+
+def interpolate_surface_transforms(
+    timestamps, keyframe_timestamps, keyframe_transform, linear, max_age_ns=None
+):
+    # Surface homographies per sample, from the keyframes before and after it:
+    # interpolated linearly by timestamp, or holding the previous one. Keyframes
+    # more than `max_age_ns` away from a sample aren't used for it, and samples
+    # without a usable keyframe get NaN. `keyframe_transform(idx)` returns the
+    # normalized homography of a keyframe, or None if the surface wasn't located.
+    # Also returns the index of each sample's previous keyframe.
+    keyframe_timestamps = np.asarray(keyframe_timestamps).astype(np.int64)
+    timestamps = np.asarray(timestamps).astype(np.int64)
+    max_age_ns = np.inf if max_age_ns is None else max_age_ns
+
+    # Like scene frames when replaying, a keyframe only applies to later samples
+    previous_idx = np.searchsorted(keyframe_timestamps, timestamps, 'left') - 1
+    next_idx = previous_idx + 1
+    if not linear:
+        next_idx[:] = len(keyframe_timestamps)
+
+    # Homographies of the keyframes in use, NaN where the surface wasn't located
+    keyframe_indices = np.unique(
+        np.clip(
+            np.concatenate([previous_idx, next_idx]), 0, len(keyframe_timestamps) - 1
+        )
+    )
+    keyframe_transforms = np.full((len(keyframe_indices), 3, 3), np.nan)
+    for local_idx, keyframe_idx in enumerate(keyframe_indices.tolist()):
+        transform = keyframe_transform(keyframe_idx)
+        if transform is not None:
+            keyframe_transforms[local_idx] = transform
+
+    def pose(keyframe_idx):
+        # Homographies and whether they may be used, per sample
+        in_range = (keyframe_idx >= 0) & (keyframe_idx < len(keyframe_timestamps))
+        clipped_idx = np.clip(keyframe_idx, 0, len(keyframe_timestamps) - 1)
+        transforms = keyframe_transforms[np.searchsorted(keyframe_indices, clipped_idx)]
+        valid = in_range & ~np.isnan(transforms[:, 2, 2])
+        valid &= np.abs(timestamps - keyframe_timestamps[clipped_idx]) <= max_age_ns
+        transforms[~valid] = 0
+
+        return transforms, valid, keyframe_timestamps[clipped_idx]
+
+    previous_transforms, previous_valid, previous_timestamps = pose(previous_idx)
+    next_transforms, next_valid, next_timestamps = pose(next_idx)
+
+    both_valid = previous_valid & next_valid
+    alpha = np.where(next_valid, 1.0, 0.0)
+    alpha[both_valid] = (
+        (timestamps[both_valid] - previous_timestamps[both_valid])
+        / (next_timestamps[both_valid] - previous_timestamps[both_valid])
+    )
+
+    transforms = (1 - alpha)[:, np.newaxis, np.newaxis] * previous_transforms
+    transforms += alpha[:, np.newaxis, np.newaxis] * next_transforms
+    transforms[~(previous_valid | next_valid)] = np.nan
+
+    return transforms, previous_idx
+
 
-class TimedDataCollection:
+def merge_timelines(frame_timestamps, event_timestamps, gaze_timestamps):
+    # Orders frames and events by the gaze sample index they are processed at.
+    # Gazes are processed before a frame if they aren't newer than it, and an event
+    # just before the first gaze that isn't older than it. Events after the last
+    # gaze are dropped. Returns (gaze index, is event, frame or event index) arrays.
+    frame_gaze_indices = np.searchsorted(gaze_timestamps, frame_timestamps, 'right')
+    event_gaze_indices = np.searchsorted(gaze_timestamps, event_timestamps, 'left')
+    event_indices = np.flatnonzero(event_gaze_indices < len(gaze_timestamps))
+
+    gaze_indices = np.concatenate(
+        [frame_gaze_indices, event_gaze_indices[event_indices]]
+    )
+    is_event = np.concatenate([
+        np.zeros(len(frame_gaze_indices), dtype=bool),
+        np.ones(len(event_indices), dtype=bool),
+    ])
+    indices = np.concatenate([np.arange(len(frame_gaze_indices)), event_indices])
+
+    # At the same gaze index, frames go before events, each in their own order
+    order = np.lexsort((indices, is_event, gaze_indices))
+
+    return gaze_indices[order], is_event[order], indices[order]
+
+
+class Timeline:
+    # Timestamps paired with per-sample data, sorted by
+    # timestamp. Memory mapped inputs stay on disk unless they need sorting.
     def __init__(self, timestamps, data):
-        paired = zip(timestamps, data)
+        count = min(len(timestamps), len(data))
+        timestamps = timestamps[:count]
+        data = data[:count]
 
         if not np.all(timestamps[:-1] <= timestamps[1:]):
-            paired = list(sorted(paired, key=lambda p: p[0]))
+            order = np.argsort(timestamps, kind='stable')
+            timestamps = timestamps[order]
+            data = data[order]
+
+        self.timestamps = timestamps
+        self.data = data
 
-        self.timestamps, self.data = list(zip(*paired))
+    def __len__(self):
+        return len(self.timestamps)
 
     def __iter__(self):
-        return MatchedIterator(self.timestamps, self.data)
+        return zip(self.timestamps, self.data)
+
+    def index_range(self, start_timestamp, end_timestamp):
+        # Indices of the samples with start_timestamp <= timestamp <= end_timestamp
+        return (
+            int(np.searchsorted(self.timestamps, start_timestamp, 'left')),
+            int(np.searchsorted(self.timestamps, end_timestamp, 'right')),
+        )
 
 
 class RecordingProcessor:
-    def __init__(self, recording_path, output_path):
+    def __init__(
+        self,
+        recording_path,
+        output_path,
+        batch=False,
+        frame_stride=1,
+        frame_range=None,
+        show_progress=True,
+        gaze_mapper=None,
+        output_format='csv',
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        cache_path=None,
+        event_journal=None,
+        cache_markers=True,
+        surface_interpolation=None,
+        max_surface_age_ms=None,
+        instrumentation=None,
+        innermost_aoi=False,
+        aoi_definitions=None,
+        aoi_metrics=False,
+        max_visit_gap_ms=DEFAULT_MAX_VISIT_GAP_MS,
+        fixations=False,
+        fixations_only=False,
+        max_fixation_velocity=DEFAULT_MAX_FIXATION_VELOCITY,
+        min_fixation_duration_ms=DEFAULT_MIN_FIXATION_DURATION_MS,
+    ):
+        # AOI metrics are computed from the gaze samples and AOI hits
+        if aoi_metrics and fixations_only:
+            raise ValueError("AOI metrics can't be computed with fixations_only")
+
+        if gaze_mapper is None:
+            calibration = load_calibration(Path(recording_path) / 'calibration.bin')
+            gaze_mapper = RecordingGazeMapper(calibration)
+        else:
+            gaze_mapper.reset()
+
+        self.init_mapping_state(
+            gaze_mapper,
+            batch=batch,
+            surface_interpolation=surface_interpolation,
+            innermost_aoi=innermost_aoi,
+            fixations=fixations,
+            fixations_only=fixations_only,
+            max_fixation_velocity=max_fixation_velocity,
+            min_fixation_duration_ms=min_fixation_duration_ms,
+            instrumentation=instrumentation,
+        )
+
         self.recording_path = Path(recording_path)
         self.output_path = Path(output_path)
+        self.frame_stride = frame_stride
+        self.frame_range = frame_range
+        self.show_progress = show_progress
+        self.output_format = output_format
+        self.chunk_size = chunk_size
+        self.cache_path = (
+            self.output_path / ".cache" if cache_path is None else Path(cache_path)
+        )
+        self.event_journal = event_journal
+        self.cache_markers = cache_markers
+        self.max_surface_age_ms = max_surface_age_ms
+        self.aoi_definitions = aoi_definitions
+        self.aoi_metrics = aoi_metrics
+        self.max_visit_gap_ms = max_visit_gap_ms
+        self.surface_transforms = {}
+        self.video_reader = None
+
+    def init_mapping_state(
+        self,
+        gaze_mapper,
+        writer=None,
+        batch=False,
+        surface_interpolation=None,
+        innermost_aoi=False,
+        fixations=False,
+        fixations_only=False,
+        max_fixation_velocity=DEFAULT_MAX_FIXATION_VELOCITY,
+        min_fixation_duration_ms=DEFAULT_MIN_FIXATION_DURATION_MS,
+        instrumentation=None,
+    ):
+        # The options, browser tabs and events that mapping gaze depends on, shared
+        # with processors that are fed live data
+        self.gaze_mapper = gaze_mapper
+        self.writer = writer
+        self.batch = batch
+        self.surface_interpolation = surface_interpolation
+        self.innermost_aoi = innermost_aoi
+        # With `fixations_only`, fixations are written instead of gaze samples
+        self.fixations = fixations or fixations_only
+        self.fixations_only = fixations_only
+        self.max_fixation_velocity = max_fixation_velocity
+        self.min_fixation_duration_ms = min_fixation_duration_ms
+        self.metrics = None
+        self.instrumentation = (
+            NULL_INSTRUMENTATION if instrumentation is None else instrumentation
+        )
 
-        self.event_regex = re.compile(r'(?P<event>[^\[=]*)(\[(?P<args>[^\]]*)\])?(=(?P<value>.*))?')
-
-        calibration = load_calibration(self.recording_path / 'calibration.bin')
-        self.gaze_mapper = GazeMapper(calibration)
+        self.event_names = []
         self.browser_client_size = (1, 1)
-
         self.tab_states = []
         self.active_tab = None
-        self.last_frame = None
+        self.last_frame_position = None
+        self.replaying = False
 
-    def process(self):
-        video_file = self.recording_path / "Neon Scene Camera v1 ps1.mp4"
-        video_reader = decord.VideoReader(str(video_file), ctx=decord.cpu(0))
-        video_timestamps = np.fromfile(video_file.with_suffix(".time"), dtype="<u8")
+    def open_video(self):
+        if self.video_reader is None:
+            self.video_reader = decord.VideoReader(
+                str(self.video_file), ctx=decord.cpu(0)
+            )
+
+        return self.video_reader
 
-        frames_with_timestamps = TimedDataCollection(video_timestamps, video_reader)
+    def load_timelines(self):
+        self.video_file = self.recording_path / "Neon Scene Camera v1 ps1.mp4"
 
-        event_file = self.recording_path / "event.txt"
-        event_data = event_file.read_text().split("\n")
-        event_timestamps = np.fromfile(event_file.with_suffix(".time"), dtype="<u8")
+        # With all detections cached, the video isn't even opened
+        self.marker_cache = None
+        if self.cache_markers:
+            self.marker_cache = MarkerDetectionCache(self.cache_path, marker_cache_key(
+                self.video_file,
+                load_calibration(self.recording_path / 'calibration.bin'),
+                self.gaze_mapper.detector_params(),
+            ))
 
-        events_with_timestamps = TimedDataCollection(event_timestamps, event_data)
+        if self.marker_cache is not None and self.marker_cache.frame_count is not None:
+            frame_count = self.marker_cache.frame_count
+        else:
+            frame_count = len(self.open_video())
+            if self.marker_cache is not None:
+                self.marker_cache.frame_count = frame_count
+
+        video_timestamps = load_array(self.video_file.with_suffix(".time"), "<u8")
+        video_timestamps = video_timestamps[:frame_count]
+
+        self.frames_with_timestamps = Timeline(
+            video_timestamps, np.arange(len(video_timestamps))
+        )
+
+        with self.instrumentation.stage('load events'):
+            compiled_events = events.load_events(
+                self.recording_path, self.cache_path, self.event_journal
+            )
+        self.event_names = compiled_events.names
+        self.events_with_timestamps = Timeline(
+            compiled_events.records['timestamp'], compiled_events.records
+        )
 
         gaze_file = self.recording_path / "gaze ps1.raw"
-        gaze_data = np.fromfile(gaze_file, dtype="<f4").reshape((-1, 2))
-        gaze_timestamps = np.fromfile(gaze_file.with_suffix(".time"), dtype="<u8")
+        self.gazes_with_timestamps = Timeline(
+            load_array(gaze_file.with_suffix(".time"), "<u8"),
+            load_array(gaze_file, "<f4").reshape((-1, 2)),
+        )
 
-        gazes_with_timestamps = TimedDataCollection(gaze_timestamps, gaze_data)
+        # Surfaces can only be located after the first marker event and before the
+        # browser was closed (recorded by newer recorders only), and only frames
+        # followed by gaze samples affect the output
+        event_timestamps = self.events_with_timestamps.timestamps
+        event_kinds = self.events_with_timestamps.data['kind']
+        marker_event_timestamps = event_timestamps[event_kinds == events.MARKER]
+        closed_event_timestamps = event_timestamps[
+            event_kinds == events.BROWSER_CLOSED
+        ]
+        self.frame_timestamps = self.frames_with_timestamps.timestamps
+        self.scheduled_frames = schedule_scene_frames(
+            self.frame_timestamps,
+            self.gazes_with_timestamps.timestamps,
+            marker_event_timestamps.min() if len(marker_event_timestamps) > 0 else None,
+            closed_event_timestamps.max() if len(closed_event_timestamps) > 0 else None,
+        )
 
-        self.event_generator = ExpirationGenerator(events_with_timestamps)
-        self.gaze_generator = ExpirationGenerator(gazes_with_timestamps)
+    def process(self):
+        with self.instrumentation.stage('load'):
+            self.load_timelines()
+
+        self.writer = OUTPUT_WRITERS[self.output_format](
+            self.output_path,
+            chunk_size=self.chunk_size,
+            instrumentation=self.instrumentation,
+            samples=not self.fixations_only,
+            fixations=self.fixations,
+        )
+        # Metrics of segments are computed from the merged output by
+        # `process_in_parallel`
+        if self.aoi_metrics and self.frame_range is None:
+            self.metrics = self.writer = AoiMetrics(self.writer, self.max_visit_gap_ms)
+
+        try:
+            self.process_timelines()
+            for tab_state in self.tab_states:
+                tab_state.flush_fixations()
+        finally:
+            with self.instrumentation.stage('write'):
+                self.writer.close()
+                self.write_pages()
+
+        # Without gaze samples, no events were replayed and the table is empty
+        if self.metrics is not None:
+            with self.instrumentation.stage('write'):
+                if len(self.gazes_with_timestamps) > 0:
+                    self.metrics.advance(self.gazes_with_timestamps.timestamps[-1])
+
+                self.metrics.write(self.output_path / AOI_METRICS_FILE_NAME)
+
+        # Segments of a parallel run are consolidated by `process_in_parallel`
+        if self.marker_cache is not None:
+            with self.instrumentation.stage('save cache'):
+                if self.frame_range is None:
+                    self.marker_cache.save()
+                else:
+                    self.marker_cache.save_part()
+
+        # Gaze that wasn't mapped onto a page, including gaze while no page was located.
+        # Mapped gaze is counted as it's written, which it isn't with `fixations_only`.
+        if self.fixations_only:
+            return
+
+        self.instrumentation.count(
+            'gazes off surface',
+            self.instrumentation.get('gazes')
+            - self.instrumentation.get('gazes mapped'),
+        )
+
+    def write_pages(self):
+        # The URL and time of every page load, and the AOI definitions pattern it
+        # matched if AOI definitions were given
+        pages = []
+        for tab_state in self.tab_states:
+            for load_id, url, timestamp in tab_state.history:
+                page_definitions = (
+                    None
+                    if self.aoi_definitions is None
+                    else self.aoi_definitions.match(url)
+                )
+                pages.append(
+                    {
+                        'tab_id': tab_state.id,
+                        'load_id': load_id,
+                        'timestamp_ns': timestamp,
+                        'url': url,
+                        'aoi_definitions': (
+                            None
+                            if page_definitions is None
+                            else page_definitions.pattern
+                        ),
+                    }
+                )
+
+        (self.output_path / PAGES_FILE_NAME).write_text(json.dumps(pages, indent=4))
+
+    def process_timelines(self):
+        # When processing a segment, everything before it is only replayed to restore
+        # the tab state. Gazes up to the first frame of the segment belong to the
+        # previous segment, and the gazes following the last frame to this one.
+        start, stop = self.frame_range or (0, len(self.frame_timestamps))
+        scheduled_frames = self.scheduled_frames.copy()
+        scheduled_frames[:start] = False
+        scheduled_frames[stop:] = False
+        self.replaying = start > 0
+
+        # Frames at the end of a segment are interpolated towards the keyframes that
+        # follow it, like without segments
+        keyframe_candidates = self.scheduled_frames.copy()
+        keyframe_candidates[:start] = False
+        self.marker_source = SceneMarkerSource(
+            self.gaze_mapper,
+            self.open_video,
+            self.frames_with_timestamps.data,
+            self.frame_timestamps,
+            keyframe_candidates,
+            self.frame_stride,
+            self.marker_cache,
+            self.instrumentation,
+        )
+
+        event_timestamps = self.events_with_timestamps.timestamps
+        event_data = self.events_with_timestamps.data
+        steps = merge_timelines(
+            self.frame_timestamps,
+            event_timestamps,
+            self.gazes_with_timestamps.timestamps,
+        )
 
-        with tqdm(total=len(video_timestamps)) as pbar:
-            for frame_timestamp, frame in frames_with_timestamps:
-                self.iterate_until(frame_timestamp)
-                self.process_frame(frame_timestamp, frame)
+        instrumentation = self.instrumentation
+        gaze_position = 0
+        with tqdm(total=stop - start, disable=not self.show_progress) as pbar:
+            for gaze_index, is_event, index in zip(*[step.tolist() for step in steps]):
+                with instrumentation.stage('map gaze'):
+                    self.process_gaze_range(gaze_position, gaze_index)
 
-                pbar.update(1)
+                gaze_position = gaze_index
 
-            self.iterate_until(None)
+                if is_event:
+                    with instrumentation.stage('events'):
+                        self.process_event(event_timestamps[index], event_data[index])
+
+                    continue
+
+                if index == stop:
+                    break
+
+                with instrumentation.stage('frames'):
+                    self.process_frame(
+                        self.frame_timestamps[index],
+                        index if scheduled_frames[index] else None,
+                    )
 
-    def iterate_until(self, timestamp):
-        for gaze_timestamp, gaze in self.gaze_generator.until(timestamp):
-            for event_timestamp, event in self.event_generator.until(gaze_timestamp):
-                self.process_event(event_timestamp, event)
+                if index == start:
+                    self.replaying = False
 
-            self.process_gaze(gaze_timestamp, gaze)
+                if index >= start:
+                    pbar.update(1)
+                    instrumentation.count('frames')
+                    if not scheduled_frames[index]:
+                        instrumentation.count('frames skipped')
 
-    def process_frame(self, timestamp, frame):
+                    instrumentation.progress(index + 1 - start, stop - start)
+
+            else:
+                with instrumentation.stage('map gaze'):
+                    self.process_gaze_range(
+                        gaze_position, len(self.gazes_with_timestamps)
+                    )
+
+    def process_gaze_range(self, start, end):
+        # Gazes within a range share the same scene frame and event state
+        if self.replaying or start == end:
+            return
+
+        self.instrumentation.count('gazes', end - start)
+        timestamps = np.asarray(self.gazes_with_timestamps.timestamps[start:end])
+        gazes = np.asarray(self.gazes_with_timestamps.data[start:end])
+        if self.batch or self.surface_interpolation is not None:
+            self.process_gazes(timestamps, gazes)
+        else:
+            for timestamp, gaze in zip(timestamps, gazes):
+                self.process_gaze(timestamp, gaze)
+
+    def process_frame(self, timestamp, position):
         if self.active_tab is None:
             return
 
+        self.update_surface()
+        if position is None:
+            return
+
+        # Interpolated surfaces are located on keyframes only, when gaze is mapped
+        if self.surface_interpolation is None:
+            self.gaze_mapper.set_detected_markers(self.marker_source.markers(position))
+
+        self.last_frame_position = position
+
+    def update_surface(self):
+        # Surfaces follow the marker bounds that were sent by the browser
         if self.active_tab.markers_dirty:
             if self.active_tab.surface is None:
                 self.active_tab.surface = self.gaze_mapper.add_surface(
@@ -247,11 +1705,11 @@ class RecordingProcessor:
 
             self.active_tab.markers_dirty = False
 
-        self.last_frame = frame.asnumpy()
-        self.gaze_mapper.process_scene(self.last_frame)
-
     def process_gaze(self, timestamp, gaze):
-        if self.last_frame is None:
+        if self.last_frame_position is None:
+            return
+
+        if self.active_tab.surface is None:
             return
 
         result = self.gaze_mapper.process_gaze(gaze)
@@ -267,39 +1725,101 @@ class RecordingProcessor:
                         self.browser_client_size
                     )
 
-    def process_event(self, timestamp, event):
-        event_match = self.event_regex.match(event)
-        if event_match is None:
+    def process_gazes(self, timestamps, gazes):
+        if self.last_frame_position is None or self.active_tab.surface is None:
+            return
+
+        if self.surface_interpolation is not None:
+            surface_gazes = self.map_gazes_interpolated(timestamps, gazes)
+            self.active_tab.process_gazes(
+                timestamps, surface_gazes, self.browser_client_size
+            )
+            return
+
+        mapped_gazes = self.gaze_mapper.map_gazes(gazes)
+        if mapped_gazes is None:
+            return
+
+        surface_gazes = mapped_gazes.get(self.active_tab.surface.uid)
+        if surface_gazes is None:
             return
 
-        args = event_match.group('args')
-        if args is not None:
-            args = args.split(',')
+        self.active_tab.process_gazes(
+            timestamps, surface_gazes, self.browser_client_size
+        )
+
+    def keyframe_surface_transform(self, keyframe_idx):
+        # Normalized homography of the active surface on a keyframe, or None
+        key = (self.active_tab.surface.uid, keyframe_idx)
+        if key not in self.surface_transforms:
+            markers = self.marker_source.keyframe_markers(keyframe_idx)
+            transform = self.gaze_mapper.surface_transform(
+                self.active_tab.surface, markers
+            )
+            if transform is not None:
+                transform = transform / transform[2, 2]
+
+            self.surface_transforms[key] = transform
+
+        return self.surface_transforms[key]
+
+    def map_gazes_interpolated(self, timestamps, gazes):
+        max_age_ns = (
+            None if self.max_surface_age_ms is None else self.max_surface_age_ms * 1e6
+        )
+        transforms, previous_idx = interpolate_surface_transforms(
+            timestamps,
+            self.marker_source.keyframe_timestamps,
+            self.keyframe_surface_transform,
+            self.surface_interpolation == 'linear',
+            max_age_ns,
+        )
+
+        # Keyframes before the earliest one in use won't be needed again
+        earliest_idx = max(int(previous_idx.min()), 0)
+        self.marker_source.forget_before(self.marker_source.keyframes[earliest_idx])
+        for key in [key for key in self.surface_transforms if key[1] < earliest_idx]:
+            del self.surface_transforms[key]
+
+        return self.gaze_mapper.map_gazes_with_transforms(gazes, transforms)
+
+    def process_event(self, timestamp, event):
+        # `event` is a record compiled by `events.compile_events`
+        if self.metrics is not None:
+            self.metrics.process_event(timestamp, event, self.event_names)
+
+        kind = event['kind']
+        if kind == events.BROWSER_URL:
+            url = self.event_names[event['name_id']]
+            self.get_tab_state(event['tab_id']).add_history(
+                url, int(event['load_id']), int(timestamp)
+            )
 
-        match event_match.group('event'):
-            case 'browser_url':
-                tab_id = int(args[0])
-                self.get_tab_state(tab_id).add_history(event_match.group('value'))
+        elif kind == events.AOI:
+            aoi_name = self.event_names[event['name_id']]
+            self.get_tab_state(event['tab_id']).set_aoi(
+                aoi_name, *event['values'].tolist()
+            )
 
-            case 'aoi':
-                tab_id, _, aoi_name = args
-                bounds = [float(v) for v in event_match.group('value').split(',')]
-                self.get_tab_state(tab_id).set_aoi(aoi_name, *bounds)
+        elif kind == events.MARKER:
+            self.set_marker_bounds(
+                event['tab_id'], int(event['marker_id']), *event['values'].tolist()
+            )
 
-            case 'marker':
-                tab_id, _, marker_id = [int(v) for v in args]
-                bounds = [float(v) for v in event_match.group('value').split(',')]
-                self.set_marker_bounds(tab_id, marker_id, *bounds)
+        elif kind == events.BROWSER_SCROLL:
+            tab_state = self.get_tab_state(event['tab_id'])
+            if tab_state is not self.active_tab:
+                self.active_tab.flush_fixations()
 
-            case 'browser_scroll':
-                tag_id = int(args[0])
-                self.active_tab = self.get_tab_state(tag_id)
+            self.active_tab = tab_state
+            self.active_tab.set_scroll_position(*event['values'][:2].tolist())
 
-                scroll_value = [float(v) for v in event_match.group('value').split(',')]
-                self.active_tab.set_scroll_position(*scroll_value)
+        elif kind == events.BROWSER_SIZE:
+            self.browser_client_size = [int(v) for v in event['values'][:2].tolist()]
 
-            case 'browser_size':
-                self.browser_client_size = [int(v) for v in event_match.group('value').split(',')]
+        elif kind == events.BROWSER_CLOSED:
+            # Gaze after the browser was closed is not on the page
+            self.last_frame_position = None
 
     def set_marker_bounds(self, tab_id, marker_id, x, y, width, height):
         tab_state = self.get_tab_state(tab_id)
@@ -308,7 +1828,19 @@ class RecordingProcessor:
     def get_tab_state(self, tab_id):
         tab_id = int(tab_id)
         while tab_id >= len(self.tab_states):
-            self.tab_states.append(BrowserTabState(tab_id, self.output_path / f"tab-{tab_id}"))
+            fixation_detector = None
+            if self.fixations:
+                fixation_detector = FixationDetector(
+                    self.max_fixation_velocity, self.min_fixation_duration_ms
+                )
+
+            self.tab_states.append(BrowserTabState(
+                len(self.tab_states),
+                self.writer,
+                self.innermost_aoi,
+                fixation_detector,
+                samples=not self.fixations_only,
+            ))
 
         tab = self.tab_states[tab_id]
         if self.active_tab is None:
@@ -317,11 +1849,270 @@ class RecordingProcessor:
         return tab
 
 
-def main():
-    import sys
-    processor = RecordingProcessor(sys.argv[1], sys.argv[2])
+# pupil_apriltags detectors occasionally crash when they are destroyed, so worker
+# processes keep one gaze mapper per calibration alive and reuse it between tasks
+_worker_gaze_mappers = {}
+
+
+def get_worker_gaze_mapper(recording_path):
+    calibration_data = (Path(recording_path) / 'calibration.bin').read_bytes()
+    if calibration_data not in _worker_gaze_mappers:
+        calibration = load_calibration(Path(recording_path) / 'calibration.bin')
+        _worker_gaze_mappers[calibration_data] = RecordingGazeMapper(calibration)
+
+    return _worker_gaze_mappers[calibration_data]
+
+
+def process_segment(
+    recording_path, output_path, frame_range, options, instrumented=False
+):
+    # Returns the instrumentation report of the segment, if `instrumented`
+    processor = RecordingProcessor(
+        recording_path,
+        output_path,
+        frame_range=frame_range,
+        show_progress=False,
+        gaze_mapper=get_worker_gaze_mapper(recording_path),
+        instrumentation=Instrumentation() if instrumented else None,
+        **options
+    )
     processor.process()
 
+    return processor.instrumentation.report()
+
+
+def process_in_parallel(
+    recording_path, output_path, workers, instrumentation=None, **options
+):
+    # Stage times of the segments are summed over all workers
+    output_path = Path(output_path)
+    instrumentation = (
+        NULL_INSTRUMENTATION if instrumentation is None else instrumentation
+    )
+
+    processor = RecordingProcessor(
+        recording_path, output_path, instrumentation=instrumentation, **options
+    )
+    with instrumentation.stage('load'):
+        processor.load_timelines()
+
+    # Use more segments than workers to even out the load
+    frame_ranges = split_scheduled_frames(
+        processor.scheduled_frames, workers * 4, processor.frame_stride
+    )
+    options = {**options, 'cache_path': processor.cache_path}
+    segment_paths = [
+        output_path / ".segments" / str(idx) for idx in range(len(frame_ranges))
+    ]
+    shutil.rmtree(output_path / ".segments", ignore_errors=True)
+
+    # Forking is unsafe once decord's decoder threads are running
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('spawn')
+    ) as executor:
+        instrumented = instrumentation is not NULL_INSTRUMENTATION
+        futures = [
+            executor.submit(
+                process_segment,
+                recording_path,
+                segment_path,
+                frame_range,
+                options,
+                instrumented,
+            )
+            for segment_path, frame_range in zip(segment_paths, frame_ranges)
+        ]
+        for done, future in enumerate(
+            tqdm(as_completed(futures), total=len(futures)), 1
+        ):
+            report = future.result()
+            if report is not None:
+                instrumentation.merge(report)
+
+            instrumentation.progress(done, len(futures))
+
+    with instrumentation.stage('merge segments'):
+        OUTPUT_WRITERS[processor.output_format].merge(segment_paths, output_path)
+        # The last segment has replayed every page load
+        shutil.copy(segment_paths[-1] / PAGES_FILE_NAME, output_path)
+
+        if processor.aoi_metrics:
+            metrics = compute_aoi_metrics(
+                recording_path,
+                output_path,
+                processor.event_journal,
+                processor.cache_path,
+                processor.max_visit_gap_ms,
+            )
+            metrics.write(output_path / AOI_METRICS_FILE_NAME)
+        shutil.rmtree(output_path / ".segments")
+
+    if processor.marker_cache is not None:
+        with instrumentation.stage('save cache'):
+            MarkerDetectionCache(
+                processor.cache_path, processor.marker_cache.key
+            ).save()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Map recorded gaze onto web pages and AOIs"
+    )
+    parser.add_argument("recording_path")
+    parser.add_argument("output_path")
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="map gaze samples in vectorized batches instead of one at a time"
+    )
+    parser.add_argument(
+        "--frame-stride", type=int, default=1,
+        help="only detect markers on every Nth scene frame and interpolate in between"
+    )
+    parser.add_argument(
+        "--output-format", choices=OUTPUT_WRITERS, default='csv',
+        help="write CSV files per tab and AOI, or columnar binary tables (see README)"
+    )
+    parser.add_argument(
+        "--event-journal",
+        help="read events from the recorder's journal instead of event.txt "
+        f"(default: {events.JOURNAL_FILE_NAME} in the recording folder, if it exists)",
+    )
+    parser.add_argument(
+        "--surface-interpolation",
+        choices=['hold', 'linear'],
+        help="map each gaze sample with the surface pose of the previous detected "
+        "frame (hold) or interpolated between the detected frames around it (linear)",
+    )
+    parser.add_argument(
+        "--max-surface-age",
+        type=float,
+        default=None,
+        help="with --surface-interpolation, only use surface poses detected within "
+        "this many ms of a gaze sample",
+    )
+    parser.add_argument(
+        "--innermost-aoi",
+        action="store_true",
+        help="where AOIs are nested or overlap, only record a gaze hit on the smallest "
+        "AOI containing it",
+    )
+    parser.add_argument(
+        "--aoi-definitions",
+        help=f"list the pattern of this AOI definitions file that each page load in "
+        f"{PAGES_FILE_NAME} matches",
+    )
+    parser.add_argument(
+        "--aoi-metrics",
+        action="store_true",
+        help=f"write {AOI_METRICS_FILE_NAME}, with hits, entries, dwell time, time to "
+        "the first hit and visible time per tab, page load and AOI",
+    )
+    parser.add_argument(
+        "--max-visit-gap",
+        type=float,
+        default=DEFAULT_MAX_VISIT_GAP_MS,
+        help="with --aoi-metrics, end a visit to an AOI when consecutive gaze samples "
+        "are further apart than this many ms",
+    )
+    parser.add_argument(
+        "--fixations", action="store_true",
+        help="also detect fixations on the pages and write them with the AOIs they hit"
+    )
+    parser.add_argument(
+        "--fixations-only", action="store_true",
+        help="write fixations instead of gaze samples and their AOI hits"
+    )
+    parser.add_argument(
+        "--fixation-velocity",
+        type=float,
+        default=DEFAULT_MAX_FIXATION_VELOCITY,
+        help="with --fixations, gaze moving faster than this many page pixels per "
+        "second is a saccade",
+    )
+    parser.add_argument(
+        "--min-fixation-duration", type=float, default=DEFAULT_MIN_FIXATION_DURATION_MS,
+        help="with --fixations, drop fixations shorter than this many ms"
+    )
+    parser.add_argument(
+        "--no-marker-cache",
+        action="store_true",
+        help="detect markers on every run instead of reusing detections cached in the "
+        "output folder",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+        help="number of rows buffered per output file before writing them"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="split the recording into time segments and process them in N processes"
+    )
+    parser.add_argument(
+        "--report",
+        help="write the time spent per processing stage and event counts to this "
+        "JSON file",
+    )
+    parser.add_argument(
+        "--progress-interval", type=float, default=None,
+        help="print a progress event as a line of JSON at most every this many seconds"
+    )
+    args = parser.parse_args()
+    if args.aoi_metrics and args.fixations_only:
+        parser.error(
+            "--aoi-metrics needs the gaze samples, which --fixations-only doesn't write"
+        )
+
+    if args.max_surface_age is not None and args.surface_interpolation is None:
+        parser.error("--max-surface-age only applies with --surface-interpolation")
+
+    options = {
+        'batch': args.batch,
+        'frame_stride': args.frame_stride,
+        'output_format': args.output_format,
+        'chunk_size': args.chunk_size,
+        'event_journal': args.event_journal,
+        'cache_markers': not args.no_marker_cache,
+        'surface_interpolation': args.surface_interpolation,
+        'max_surface_age_ms': args.max_surface_age,
+        'innermost_aoi': args.innermost_aoi,
+        'aoi_definitions': (
+            None
+            if args.aoi_definitions is None
+            else AoiDefinitionIndex.load(args.aoi_definitions)
+        ),
+        'aoi_metrics': args.aoi_metrics,
+        'max_visit_gap_ms': args.max_visit_gap,
+        'fixations': args.fixations,
+        'fixations_only': args.fixations_only,
+        'max_fixation_velocity': args.fixation_velocity,
+        'min_fixation_duration_ms': args.min_fixation_duration,
+    }
+    instrumentation = None
+    if args.report is not None or args.progress_interval is not None:
+        instrumentation = Instrumentation(args.progress_interval)
+
+    if args.workers > 1:
+        process_in_parallel(
+            args.recording_path,
+            args.output_path,
+            args.workers,
+            instrumentation,
+            **options,
+        )
+    else:
+        processor = RecordingProcessor(
+            args.recording_path,
+            args.output_path,
+            instrumentation=instrumentation,
+            **options,
+        )
+        processor.process()
+
+    if args.report is not None:
+        instrumentation.write_report(args.report)
+
 
 if __name__ == '__main__':
     main()
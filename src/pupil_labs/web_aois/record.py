@@ -1,19 +1,228 @@
-import sys
 import json
 import asyncio
+import re
 import time
 from importlib.resources import files
+from pathlib import Path
 
 from playwright.async_api import async_playwright
 from pupil_labs.realtime_api import Device, Network
 
-from .aoi_locator_helper import get_aoi_locators_for_page
+from .aoi_definitions import AoiDefinitionIndex
+from .events import JOURNAL_FILE_NAME, EventJournal
+
+
+def capture_time_ns(t_ms):
+    # Converts a capture time from the browser (unix time in ms) to nanoseconds
+    if t_ms is None:
+        return time.time_ns()
+
+    return int(t_ms * 1e6)
+
+
+def summarize_durations(durations_ns):
+    if len(durations_ns) == 0:
+        return 'none'
+
+    mean_ms = sum(durations_ns) / len(durations_ns) / 1e6
+    max_ms = max(durations_ns) / 1e6
+    return f'{len(durations_ns)}x, mean {mean_ms:.1f} ms, max {max_ms:.1f} ms'
+
+
+class EventRelay:
+    # Sends events to the device from a single task, so slow sends never hold up the
+    # browser. Events keep the timestamp of when they were captured, and the time
+    # from capture until the device received them is tracked per event type.
+    #
+    # If a journal is set, every event is also appended to it when it is captured,
+    # so the recording's events survive problems with the connection to the device.
+    # Listeners (like the journal, objects with an `append(event, timestamp)`
+    # method) are handed every event as it is captured, too.
+    #
+    # Scroll events are coalesced: while a scroll event of a tab is waiting to be
+    # sent, newer positions of that tab replace it. With `max_scroll_rate`, scroll
+    # events of a tab are additionally sent at most that many times per second.
+    # Scroll positions that don't fit in the queue stay pending, and are queued once
+    # the sender makes room or the tab scrolls again.
+    def __init__(self, device, max_queued=256, batch_size=16, max_scroll_rate=None):
+        self.device = device
+        self.batch_size = batch_size
+        self.scroll_interval_ns = (
+            0 if max_scroll_rate is None else int(1e9 / max_scroll_rate)
+        )
+
+        self.queue = asyncio.Queue(max_queued)
+        self.pending_scrolls = {}
+        self.unqueued_scrolls = set()
+        self.last_scroll_sent = {}
+        self.sender_task = None
+
+        self.counters = {
+            'queued': 0,
+            'sent': 0,
+            'coalesced': 0,
+            'deferred': 0,
+            'failed': 0,
+        }
+        self.latencies_ns = {}
+        self.journal = None
+        self.listeners = []
+
+    def start(self):
+        self.sender_task = asyncio.create_task(self.run_sender())
+
+    async def close(self):
+        # Sends everything that is still queued, then stops the sender
+        for scroll_key, scroll in list(self.pending_scrolls.items()):
+            if scroll is not None:
+                await self.queue.put(scroll_key)
+
+        self.unqueued_scrolls.clear()
+        await self.queue.put(None)
+        await self.sender_task
+
+        if self.journal is not None:
+            self.journal.close()
+
+    async def send_event(self, event, event_timestamp_unix_ns=None):
+        await self.send_events([event], event_timestamp_unix_ns)
+
+    def capture(self, event, event_timestamp_unix_ns):
+        if self.journal is not None:
+            self.journal.append(event, event_timestamp_unix_ns)
+
+        for listener in self.listeners:
+            listener.append(event, event_timestamp_unix_ns)
+
+    async def send_events(self, events, event_timestamp_unix_ns=None):
+        # Events sent together are queued as one item and sent at once
+        if event_timestamp_unix_ns is None:
+            event_timestamp_unix_ns = time.time_ns()
+
+        for event in events:
+            self.capture(event, event_timestamp_unix_ns)
+
+        # Waits for room in the queue rather than losing events
+        await self.queue.put([(event, event_timestamp_unix_ns) for event in events])
+        self.counters['queued'] += len(events)
+
+    def send_scroll(self, tab_id, event, event_timestamp_unix_ns):
+        # Coalesced scroll events are only left out of what is sent to the device,
+        # the journal and listeners get all of them
+        self.capture(event, event_timestamp_unix_ns)
+
+        self.counters['queued'] += 1
+        if self.pending_scrolls.get(tab_id) is not None:
+            self.pending_scrolls[tab_id] = (event, event_timestamp_unix_ns)
+            self.counters['coalesced'] += 1
+            if tab_id in self.unqueued_scrolls:
+                self.enqueue_scroll(tab_id)
+
+            return
+
+        self.pending_scrolls[tab_id] = (event, event_timestamp_unix_ns)
+
+        delay_ns = (
+            self.last_scroll_sent.get(tab_id, 0)
+            + self.scroll_interval_ns
+            - time.time_ns()
+        )
+        if delay_ns > 0:
+            asyncio.get_running_loop().call_later(
+                delay_ns / 1e9, self.enqueue_scroll, tab_id
+            )
+        else:
+            self.enqueue_scroll(tab_id)
+
+    def enqueue_scroll(self, tab_id):
+        try:
+            self.queue.put_nowait(tab_id)
+        except asyncio.QueueFull:
+            if tab_id not in self.unqueued_scrolls:
+                self.unqueued_scrolls.add(tab_id)
+                self.counters['deferred'] += 1
+
+            return
+
+        self.unqueued_scrolls.discard(tab_id)
+
+    def take_events(self, item):
+        # Queued items are lists of events, or tab ids standing in for a tab's
+        # latest scroll
+        if isinstance(item, list):
+            return item
+
+        scroll = self.pending_scrolls.get(item)
+        if scroll is None:
+            return []
+
+        self.pending_scrolls[item] = None
+        self.last_scroll_sent[item] = time.time_ns()
+
+        return [scroll]
+
+    async def run_sender(self):
+        closing = False
+        while not closing:
+            items = [await self.queue.get()]
+            while len(items) < self.batch_size and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+
+            if None in items:
+                closing = True
+                items = items[:items.index(None)]
+            else:
+                # The items just taken made room for scrolls that didn't fit
+                for tab_id in list(self.unqueued_scrolls):
+                    self.enqueue_scroll(tab_id)
+
+            batch = [event for item in items for event in self.take_events(item)]
+            results = await asyncio.gather(
+                *[
+                    self.device.send_event(event, event_timestamp_unix_ns=t_ns)
+                    for event, t_ns in batch
+                ],
+                return_exceptions=True
+            )
+
+            sent_ns = time.time_ns()
+            for (event, t_ns), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self.counters['failed'] += 1
+                    print(f'Failed to send event: {result}')
+                    continue
+
+                self.counters['sent'] += 1
+                event_type = re.match(r'[^\[=]*', event).group()
+                self.latencies_ns.setdefault(event_type, []).append(sent_ns - t_ns)
+
+    def print_summary(self):
+        print(
+            'Events:',
+            ', '.join(f'{count} {name}' for name, count in self.counters.items()),
+        )
+        for event_type, latencies_ns in self.latencies_ns.items():
+            print(f'    {event_type} latency: {summarize_durations(latencies_ns)}')
+
 
 class BrowserRelay:
-    def __init__(self, pw, device, aoi_definitions_by_url):
+    def __init__(
+        self,
+        pw,
+        device,
+        aoi_definitions_by_url,
+        max_scroll_rate=None,
+        geometry_update_delay_ms=100,
+        live_session=None,
+    ):
         self.pw = pw
         self.device = device
-        self.aoi_definitions_by_url = aoi_definitions_by_url
+        self.aoi_definitions = AoiDefinitionIndex(aoi_definitions_by_url)
+        self.event_relay = EventRelay(device, max_scroll_rate=max_scroll_rate)
+        self.geometry_refresh_durations_ns = []
+        self.geometry_update_delay_ms = geometry_update_delay_ms
+        self.geometry_updates = 0
+        self.live_session = live_session
 
         self.browser = None
         self.context = None
@@ -38,16 +247,22 @@ class BrowserRelay:
         await self.context.expose_binding('propagateResizeEvent', self.on_resized)
         await self.context.expose_binding('propagateFocusEvent', self.on_tab_switched)
         await self.context.expose_binding('propagatePageVisible', self.on_tab_switched)
-        await self.context.expose_binding('propagateLocationChangeEvent', self.on_tab_location_changed)
-        await self.context.expose_binding('propagatePageElements', self.on_elements_changed)
+        await self.context.expose_binding(
+            'propagateLocationChangeEvent', self.on_tab_location_changed
+        )
+        await self.context.expose_binding(
+            'propagatePageElements', self.on_elements_changed
+        )
+        await self.context.expose_binding(
+            'propagateAoiGeometry', self.on_aoi_geometry_changed
+        )
 
         self.context.on("page", self.on_new_page)
 
-    async def on_scroll(self, source, x, y):
-        t_ns = time.time_ns()
-        await self.send_scroll(source['page'], x, y, t_ns)
+    async def on_scroll(self, source, x, y, t_ms=None):
+        await self.send_scroll(source['page'], x, y, capture_time_ns(t_ms))
 
-    async def on_resized(self, source, width, height):
+    async def on_resized(self, source, width, height, t_ms=None):
         if self.last_size == (width, height):
             return
 
@@ -56,7 +271,7 @@ class BrowserRelay:
         # @todo - this scheme assumes all tabs are in the same window
         await self.send_event(
             f"browser_size={width},{height}",
-            event_timestamp_unix_ns=time.time_ns()
+            event_timestamp_unix_ns=capture_time_ns(t_ms)
         )
 
     async def on_new_page(self, page):
@@ -72,10 +287,10 @@ class BrowserRelay:
 
         await asyncio.sleep(1.0)
         await page.evaluate(f'embedTags({self.marker_size}, {self.marker_brightness})')
-        await page.evaluate('installEventListeners()')
+        await page.evaluate(f'installEventListeners({self.geometry_update_delay_ms})')
 
-    async def on_tab_switched(self, source, scroll_x, scroll_y):
-        t_ns = time.time_ns()
+    async def on_tab_switched(self, source, scroll_x, scroll_y, t_ms=None):
+        t_ns = capture_time_ns(t_ms)
         tab_id = self.tab_info[source['page']]['id']
 
         await self.send_event(
@@ -83,62 +298,141 @@ class BrowserRelay:
         )
         await self.send_scroll(source['page'], scroll_x, scroll_y, t_ns)
 
-    async def on_tab_location_changed(self, source):
-        await self.on_new_url(source['page'])
+    async def on_tab_location_changed(self, source, t_ms=None):
+        await self.on_new_url(source['page'], capture_time_ns(t_ms))
 
     async def on_elements_changed(self, source):
         await self.send_elements(source['page'])
 
+    async def on_aoi_geometry_changed(self, source, changes, t_ms=None):
+        # `changes` only lists AOIs that moved or changed size since they were last sent
+        tab_info = self.tab_info[source['page']]
+        tab_load_id = f"{tab_info['id']},{tab_info['load_count']}"
+
+        events = []
+        for aoi_name, *bounds in changes:
+            bounds_str = ','.join([str(v) for v in bounds])
+            events.append(f"aoi[{tab_load_id},{aoi_name}]={bounds_str}")
+
+        self.geometry_updates += len(events)
+        await self.event_relay.send_events(events, capture_time_ns(t_ms))
+
     async def send_scroll(self, page, x, y, t_ns):
         tab_info = self.tab_info[page]
-        await self.send_event(
-            f"browser_scroll[{tab_info['id']},{tab_info['load_count']}]={x},{y}", event_timestamp_unix_ns=time.time_ns()
+        self.event_relay.send_scroll(
+            tab_info['id'],
+            f"browser_scroll[{tab_info['id']},{tab_info['load_count']}]={x},{y}",
+            t_ns
         )
 
-    async def on_new_url(self, page):
+    async def on_new_url(self, page, t_ns):
         tab_info = self.tab_info[page]
         tab_info['load_count'] += 1
 
         await self.send_event(
             f"browser_url[{tab_info['id']},{tab_info['load_count']}]={page.url}",
-            event_timestamp_unix_ns=time.time_ns()
+            event_timestamp_unix_ns=t_ns
         )
 
     async def send_elements(self, page):
+        started_ns = time.time_ns()
         tab_info = self.tab_info[page]
         tab_load_id = f"{tab_info['id']},{tab_info['load_count']}"
 
-        if page.url in self.aoi_definitions_by_url:
-            aoi_locators = get_aoi_locators_for_page(page, self.aoi_definitions_by_url[page.url])
-            for aoi_name, locator in aoi_locators.items():
-                bounds = await locator.bounding_box()
-                bounds = [bounds['x'], bounds['y'], bounds['width'], bounds['height']]
-                bounds_str = ','.join([str(v) for v in bounds])
-
-                await self.send_event(f"aoi[{tab_load_id},{aoi_name}]={bounds_str}")
+        aoi_locators = self.aoi_definitions.locators(page)
 
         # @TODO: make marker ids configurable
-        for marker_id in range(4):
-            locator = page.locator(f"#pupil-apriltag-marker-{marker_id}")
-            bounds = await locator.bounding_box()
+        marker_locators = [
+            page.locator(f"#pupil-apriltag-marker-{marker_id}")
+            for marker_id in range(4)
+        ]
+
+        # Query all elements at once rather than waiting for each in turn. AOI elements
+        # are handed to the page's geometry tracker, which reports their page bounds.
+        # Every query also returns when it was measured, in the page's clock that
+        # stamps scroll and resize events, too.
+        all_measurements = await asyncio.gather(
+            *[
+                locator.evaluate(
+                    '(element, name) => measureAoiElement(name, element)', aoi_name
+                )
+                for aoi_name, locator in aoi_locators.items()
+            ],
+            *[
+                locator.evaluate('element => measureMarkerElement(element)')
+                for locator in marker_locators
+            ],
+            return_exceptions=True,
+        )
+        finished_ns = time.time_ns()
+
+        measurement_times_ms = []
+        all_bounds = []
+        for measurement in all_measurements:
+            if measurement is None or isinstance(measurement, Exception):
+                all_bounds.append(None)
+                continue
+
+            bounds, t_ms = measurement
+            all_bounds.append(bounds)
+            measurement_times_ms.append(t_ms)
+
+        events = []
+        for aoi_name, bounds in zip(aoi_locators, all_bounds):
+            if bounds is None:
+                print(f'Could not locate AOI {aoi_name!r} on {page.url}')
+                continue
+
+            bounds_str = ','.join([str(v) for v in bounds])
 
-            margin = bounds['width'] / 10, bounds['height'] / 10
+            events.append(f"aoi[{tab_load_id},{aoi_name}]={bounds_str}")
+
+        for marker_id, bounds in enumerate(all_bounds[len(aoi_locators):]):
+            if bounds is None:
+                print(f'Could not locate marker {marker_id} on {page.url}')
+                continue
+
+            x, y, width, height = bounds
+            margin = width / 10, height / 10
             real_bounds = [
-                bounds['x'] + margin[0],
-                bounds['y'] + margin[1],
-                bounds['width'] - margin[0]*2,
-                bounds['height'] - margin[1]*2
+                x + margin[0],
+                y + margin[1],
+                width - margin[0] * 2,
+                height - margin[1] * 2,
             ]
 
             bounds_str = ','.join([str(v) for v in real_bounds])
 
-            await self.send_event(f"marker[{tab_load_id},{marker_id}]={bounds_str}")
+            events.append(f"marker[{tab_load_id},{marker_id}]={bounds_str}")
+
+        # All bounds share the time of the last measurement, so they are applied
+        # together when processing
+        measured_ns = capture_time_ns(
+            max(measurement_times_ms) if len(measurement_times_ms) > 0 else None
+        )
+        await self.event_relay.send_events(events, measured_ns)
+        self.geometry_refresh_durations_ns.append(finished_ns - started_ns)
 
     async def send_event(self, event, event_timestamp_unix_ns=None):
-        await self.device.send_event(event, event_timestamp_unix_ns=time.time_ns())
+        await self.event_relay.send_event(event, event_timestamp_unix_ns)
 
     async def record_page(self, url):
         self.recording_id = await self.device.recording_start()
+        self.event_relay.journal = EventJournal(
+            Path(f"data/{self.recording_id}") / JOURNAL_FILE_NAME
+        )
+        self.event_relay.start()
+
+        # Live mapping gets the browser geometry from the same events the device gets
+        stream_task = None
+        if self.live_session is not None:
+            from .live import stream_device
+
+            self.event_relay.listeners.append(self.live_session)
+            self.live_session.start()
+            stream_task = asyncio.create_task(
+                stream_device(self.device, self.live_session)
+            )
 
         if self.browser is None:
             await self.playwright_init()
@@ -151,11 +445,29 @@ class BrowserRelay:
             async with self.context.pages[0].expect_event("close", timeout=0) as _:
                 pass
 
+        # Lets processing skip the rest of the scene video
+        await self.send_event("browser_closed")
+        await self.event_relay.close()
+        if stream_task is not None:
+            stream_task.cancel()
+            try:
+                await stream_task
+            except asyncio.CancelledError:
+                pass
+
+            self.live_session.close()
+            self.live_session.print_summary()
+
+        self.event_relay.print_summary()
+        refresh_summary = summarize_durations(self.geometry_refresh_durations_ns)
+        print(f'Geometry refreshes: {refresh_summary}')
+        print(f'AOI geometry updates: {self.geometry_updates}')
+
         await self.device.recording_stop_and_save()
         await self.context.close()
 
 
-async def async_main():
+async def async_main(args):
     async with Network() as network:
         dev_info = await network.wait_for_new_device(timeout_seconds=5)
 
@@ -163,21 +475,92 @@ async def async_main():
         print('Starting recording!')
 
         async with async_playwright() as playwright:
-            with open(sys.argv[1], "rt") as aoi_definitions_file:
+            with open(args.aoi_definitions, "rt") as aoi_definitions_file:
                 aoi_definitions = json.load(aoi_definitions_file)
 
-            relay = BrowserRelay(playwright, device, aoi_definitions_by_url=aoi_definitions)
-
-            if len(sys.argv) > 2:
-                url = sys.argv[2]
+            live_session = None
+            if args.live or args.live_udp is not None:
+                # Imported here so recording without live mapping does not pay for
+                # decord and friends
+                from .live import JsonLinesPublisher, LiveSession, UdpPublisher
+
+                publishers = []
+                if args.live:
+                    publishers.append(JsonLinesPublisher(args.live))
+
+                if args.live_udp is not None:
+                    host, port = args.live_udp.rsplit(':', 1)
+                    publishers.append(UdpPublisher(host, int(port)))
+
+                live_session = LiveSession(
+                    await device.get_calibration(),
+                    publishers,
+                    max_latency_ms=args.live_max_latency,
+                )
+
+            relay = BrowserRelay(
+                playwright,
+                device,
+                aoi_definitions_by_url=aoi_definitions,
+                max_scroll_rate=args.max_scroll_rate,
+                live_session=live_session,
+            )
+
+            if args.url is not None:
+                url = args.url
             else:
-                url = next(iter(aoi_definitions))
+                urls = [
+                    page.url
+                    for page in relay.aoi_definitions.pages
+                    if page.kind == 'exact'
+                ]
+                if len(urls) == 0:
+                    print(
+                        'The AOI definitions only contain URL patterns, '
+                        'pass the URL to start at'
+                    )
+                    return
+
+                url = urls[0]
 
             await relay.record_page(url=url)
 
 
 def main():
-    asyncio.run(async_main())
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Record a browsing session with a Neon Companion device"
+    )
+    parser.add_argument("aoi_definitions")
+    parser.add_argument("url", nargs="?")
+    parser.add_argument(
+        "--max-scroll-rate",
+        type=float,
+        default=None,
+        help="send scroll positions of a tab at most this many times per second "
+        "(default: once per frame)",
+    )
+    parser.add_argument(
+        "--live", metavar="PATH",
+        help="map gaze to the page while recording and write it to this JSON lines file"
+    )
+    parser.add_argument(
+        "--live-udp",
+        metavar="HOST:PORT",
+        help="map gaze to the page while recording and send it as JSON datagrams to "
+        "HOST:PORT",
+    )
+    parser.add_argument(
+        "--live-max-latency",
+        type=float,
+        default=200,
+        help="with live mapping, drop scene frames and gaze that are older than this "
+        "many ms",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(async_main(args))
 
 
 if __name__ == '__main__':
@@ -1,35 +1,274 @@
-import sys
-import json
-import asyncio
 from pathlib import Path
+import asyncio
+import hashlib
+import io
+import json
+import re
+import time
 
+import numpy as np
+
+from PIL import Image
 from playwright.async_api import async_playwright
 
-from .aoi_locator_helper import get_aoi_locators_for_page
+from .aoi_definitions import AoiDefinitionIndex
 
 
-async def async_main():
-    async with async_playwright() as playwright:
-        with open(sys.argv[1], "rt") as aoi_definitions_file:
-            aoi_definitions = json.load(aoi_definitions_file)
+CAPTURE_FILE_NAME = "capture.json"
+
+DEFAULT_VIEWPORT = "1920x1080"
+
+# Bounds of an element in page coordinates
+PAGE_BOUNDS_SCRIPT = """element => {
+    const rect = element.getBoundingClientRect()
+    return [rect.x + window.scrollX, rect.y + window.scrollY, rect.width, rect.height]
+}"""
+
+
+def url_directory_name(url):
+    # A readable folder name that is unique per URL
+    readable = re.sub(
+        r'[^A-Za-z0-9._-]+', '_', re.sub(r'^[a-zA-Z]+://', '', url)
+    ).strip('_')[:80]
+
+    return f"{readable}-{hashlib.sha1(url.encode()).hexdigest()[:8]}"
+
+
+def capture_path(output_path, url, viewport):
+    return Path(output_path) / url_directory_name(url) / f"{viewport[0]}x{viewport[1]}"
+
+
+def definitions_fingerprint(aoi_definitions):
+    return hashlib.sha1(
+        json.dumps(aoi_definitions, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def is_capture_fresh(path, url, aoi_definitions, max_age_s=None):
+    # Whether `path` holds screenshots of `url` taken with the same AOI definitions,
+    # at most `max_age_s` seconds ago
+    try:
+        capture = json.loads((Path(path) / CAPTURE_FILE_NAME).read_text())
+    except (OSError, ValueError):
+        return False
+
+    if capture['url'] != url or capture['definitions'] != definitions_fingerprint(
+        aoi_definitions
+    ):
+        return False
+
+    if max_age_s is not None and time.time() - capture['captured_at'] > max_age_s:
+        return False
+
+    return all((Path(path) / name).exists() for name in capture['files'])
+
+
+def plan_captures(aoi_definitions, output_path, viewports, max_age_s=None, force=False):
+    # Returns the (url, viewport, path) captures to make and how many are up to date.
+    # Only exact URL patterns name a page that can be captured.
+    captures = []
+    fresh = 0
+    for page_definitions in aoi_definitions.pages:
+        if page_definitions.kind != 'exact':
+            continue
+
+        url = page_definitions.url
+        for viewport in viewports:
+            path = capture_path(output_path, url, viewport)
+            if not force and is_capture_fresh(
+                path, url, page_definitions.aoi_definitions, max_age_s
+            ):
+                fresh += 1
+            else:
+                captures.append((url, viewport, path))
+
+    return captures, fresh
+
+
+def read_png(file):
+    # PNGs are read and written with Pillow, as OpenCV's PNG codec breaks when decord
+    # was imported before it. `file` is a path or a file object.
+    return np.array(Image.open(file).convert('RGB'))
+
 
-        output_path = Path(sys.argv[2])
+def write_png(path, image):
+    Image.fromarray(image).save(path)
 
-        browser = await playwright.chromium.launch(headless=False, args=['--start-maximized'])
-        context = await browser.new_context(no_viewport=True)
 
-        page = await context.new_page()
-        for url, aoi_definitions in aoi_definitions.items():
-            await page.goto(url)
-            await page.screenshot(path=output_path / "full-page.png", full_page=True)
+def crop_aoi(image, bounds):
+    # The part of `image` within `bounds`, or None if that's empty
+    x, y, width, height = bounds
+    x0, y0 = max(int(round(x)), 0), max(int(round(y)), 0)
+    x1, y1 = min(int(round(x + width)), image.shape[1]), min(
+        int(round(y + height)), image.shape[0]
+    )
+    if x1 <= x0 or y1 <= y0:
+        return None
 
-            aoi_locators = get_aoi_locators_for_page(page, aoi_definitions)
-            for aoi_name, locator in aoi_locators.items():
-                await locator.screenshot(path=output_path / f"aoi-{aoi_name}.png")
+    return image[y0:y1, x0:x1]
+
+
+async def capture_page(page, url, page_definitions, path, locator_timeout_ms=5000):
+    # Takes a single full-page screenshot and crops the AOIs out of it
+    await page.goto(url)
+    image_data = await page.screenshot(full_page=True)
+
+    aoi_locators = page_definitions.locators(page)
+    all_bounds = await asyncio.gather(
+        *[
+            locator.evaluate(PAGE_BOUNDS_SCRIPT, timeout=locator_timeout_ms)
+            for locator in aoi_locators.values()
+        ],
+        return_exceptions=True,
+    )
+
+    path.mkdir(parents=True, exist_ok=True)
+    (path / "full-page.png").write_bytes(image_data)
+    image = read_png(io.BytesIO(image_data))
+
+    files = ["full-page.png"]
+    aoi_bounds = {}
+    for aoi_name, bounds in zip(aoi_locators, all_bounds):
+        aoi_image = None if isinstance(bounds, Exception) else crop_aoi(image, bounds)
+        if aoi_image is None:
+            print(f'Could not locate AOI {aoi_name!r} on {url}')
+            continue
+
+        write_png(path / f"aoi-{aoi_name}.png", aoi_image)
+        files.append(f"aoi-{aoi_name}.png")
+        aoi_bounds[aoi_name] = bounds
+
+    (path / CAPTURE_FILE_NAME).write_text(json.dumps({
+        'url': url,
+        'viewport': list(image.shape[1::-1]),
+        'definitions': definitions_fingerprint(page_definitions.aoi_definitions),
+        'captured_at': time.time(),
+        'files': files,
+        'aois': aoi_bounds,
+    }, indent=4))
+
+
+async def capture_all(
+    browser, captures, aoi_definitions, pages=4, locator_timeout_ms=5000
+):
+    # Captures on `pages` pages at once. Each worker keeps a browser context per
+    # viewport size. Returns the URLs that failed.
+    queue = asyncio.Queue()
+    for capture in captures:
+        queue.put_nowait(capture)
+
+    failures = []
+
+    async def work():
+        pages_by_viewport = {}
+        while not queue.empty():
+            url, viewport, path = queue.get_nowait()
+            if viewport not in pages_by_viewport:
+                context = await browser.new_context(
+                    viewport={'width': viewport[0], 'height': viewport[1]}
+                )
+                pages_by_viewport[viewport] = await context.new_page()
+
+            try:
+                await capture_page(
+                    pages_by_viewport[viewport],
+                    url,
+                    aoi_definitions.match(url),
+                    path,
+                    locator_timeout_ms,
+                )
+                print('Saved', path)
+            except Exception as exc:
+                print(f'Failed to capture {url} at {viewport[0]}x{viewport[1]}: {exc}')
+                failures.append(url)
+
+        for page in pages_by_viewport.values():
+            await page.context.close()
+
+    await asyncio.gather(*[work() for _ in range(min(pages, len(captures)))])
+
+    return failures
+
+
+def parse_viewport(value):
+    width, height = value.lower().split('x')
+
+    return int(width), int(height)
+
+
+async def async_main(args):
+    aoi_definitions = AoiDefinitionIndex.load(args.aoi_definitions)
+    for page_definitions in aoi_definitions.pages:
+        if page_definitions.kind != 'exact':
+            print(
+                f"Skipping {page_definitions.pattern}, it does not name a single page"
+            )
+
+    viewports = [
+        parse_viewport(viewport) for viewport in args.viewport or [DEFAULT_VIEWPORT]
+    ]
+    max_age_s = None if args.max_age is None else args.max_age * 3600
+    captures, fresh = plan_captures(
+        aoi_definitions, args.output_path, viewports, max_age_s, args.force
+    )
+    print(f"{len(captures)} pages to capture, {fresh} up to date")
+    if len(captures) == 0:
+        return []
+
+    async with async_playwright() as playwright:
+        browser = await playwright.chromium.launch(headless=not args.headed)
+        failures = await capture_all(
+            browser, captures, aoi_definitions, args.pages, args.locator_timeout
+        )
+        await browser.close()
+
+    return failures
 
 
 def main():
-    asyncio.run(async_main())
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Screenshot the pages and AOIs of an AOI definitions file"
+    )
+    parser.add_argument("aoi_definitions")
+    parser.add_argument(
+        "output_path",
+        help="screenshots are written to <output_path>/<url>/<width>x<height>/",
+    )
+    parser.add_argument(
+        "--pages", type=int, default=4, help="number of pages captured at once"
+    )
+    parser.add_argument(
+        "--viewport",
+        action="append",
+        help="browser viewport size as WIDTHxHEIGHT, can be given several times "
+        f"(default: {DEFAULT_VIEWPORT})",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=None,
+        help="recapture screenshots older than this many hours "
+        "(default: keep them until the AOI definitions change)",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="recapture all screenshots"
+    )
+    parser.add_argument(
+        "--headed", action="store_true", help="show the browser windows"
+    )
+    parser.add_argument(
+        "--locator-timeout", type=float, default=5000,
+        help="ms to wait for an AOI element to appear"
+    )
+    args = parser.parse_args()
+
+    failures = asyncio.run(async_main(args))
+    if len(failures) > 0:
+        print(f"{len(failures)} pages failed")
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,546 @@
+from pathlib import Path
+import json
+import shutil
+import warnings
+
+import numpy as np
+
+from . import events
+from .aoi_definitions import UrlPatternIndex
+from .batch import find_recordings
+
+
+# Tables of a study store, with the columns that rows are sorted by first. Every
+# block of rows records the range of each sort column in the block index.
+STORE_TABLES = {
+    'gazes': [
+        ('recording_id', '<i4'),
+        ('url_id', '<i4'),
+        ('timestamp_ns', '<u8'),
+        ('tab_id', '<i4'),
+        ('load_id', '<i4'),
+        ('page_x_px', '<f8'),
+        ('page_y_px', '<f8'),
+    ],
+    'aoi_hits': [
+        ('recording_id', '<i4'),
+        ('url_id', '<i4'),
+        ('aoi_id', '<i4'),
+        ('timestamp_ns', '<u8'),
+        ('tab_id', '<i4'),
+        ('load_id', '<i4'),
+        ('x_px', '<f8'),
+        ('y_px', '<f8'),
+    ],
+}
+STORE_SORT_COLUMNS = {
+    'gazes': ['recording_id', 'url_id', 'timestamp_ns'],
+    'aoi_hits': ['recording_id', 'url_id', 'aoi_id', 'timestamp_ns'],
+}
+
+# Rows are indexed in blocks of at most this many rows, which never span recordings
+DEFAULT_BLOCK_SIZE = 4096
+
+
+def block_index_columns(table_name):
+    columns = [('row_start', '<u8'), ('row_count', '<u8')]
+    dtypes = dict(STORE_TABLES[table_name])
+    for name in STORE_SORT_COLUMNS[table_name]:
+        columns.extend([(f"{name}_min", dtypes[name]), (f"{name}_max", dtypes[name])])
+
+    return columns
+
+
+def read_csv_columns(csv_path, columns):
+    # Reads the given (index, dtype) columns of a CSV file written by
+    # `pl-web-aois-process`. Files of AOIs that were never hit are empty.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        return [
+            np.loadtxt(
+                csv_path, delimiter=',', skiprows=1, usecols=idx, dtype=dtype, ndmin=1
+            )
+            for idx, dtype in columns
+        ]
+
+
+def read_page_loads(recording_path, cache_path=None):
+    # (tab id, load id) -> (timestamp, URL) of every page load of a recording
+    compiled_events = events.load_events(recording_path, cache_path)
+    records = compiled_events.records
+    return {
+        (int(record['tab_id']), int(record['load_id'])): (
+            int(record['timestamp']),
+            compiled_events.names[record['name_id']],
+        )
+        for record in records[records['kind'] == events.BROWSER_URL]
+    }
+
+
+def read_processed_output(output_path, page_loads):
+    # The gaze and AOI hits of a processed recording, as dicts of arrays named like
+    # the binary table columns, and the AOI names that `aoi_id` refers to. CSV
+    # output has no load ids, so they are looked up from the page loads.
+    output_path = Path(output_path)
+    if (output_path / "gazes" / "schema.json").exists():
+        aoi_names = [
+            aoi['name'] for aoi in json.loads((output_path / "aois.json").read_text())
+        ]
+        return (
+            events.read_table(output_path / "gazes"),
+            events.read_table(output_path / "aoi_hits"),
+            aoi_names,
+        )
+
+    gaze_parts = []
+    hit_parts = []
+    aoi_names = []
+    for tab_path in sorted(output_path.glob('tab-*')):
+        tab_id = int(tab_path.name[len('tab-'):])
+        tab_loads = sorted(
+            (timestamp, load_id)
+            for (tab, load_id), (timestamp, _) in page_loads.items()
+            if tab == tab_id
+        )
+        load_starts = np.array(
+            [timestamp for timestamp, _ in tab_loads], dtype=np.uint64
+        )
+        load_ids = np.array([-1] + [load_id for _, load_id in tab_loads])
+
+        timestamps, x, y = read_csv_columns(
+            tab_path / "gazes.csv", [(0, np.uint64), (5, np.float64), (6, np.float64)]
+        )
+        gaze_parts.append({
+            'timestamp_ns': timestamps,
+            'tab_id': np.full(len(timestamps), tab_id),
+            'load_id': load_ids[np.searchsorted(load_starts, timestamps, 'right')],
+            'page_x_px': x,
+            'page_y_px': y,
+        })
+
+        for aoi_path in sorted(tab_path.glob('aoi-*.csv')):
+            timestamps, x, y = read_csv_columns(
+                aoi_path, [(0, np.uint64), (3, np.float64), (4, np.float64)]
+            )
+            hit_parts.append({
+                'timestamp_ns': timestamps,
+                'tab_id': np.full(len(timestamps), tab_id),
+                'load_id': load_ids[np.searchsorted(load_starts, timestamps, 'right')],
+                'aoi_id': np.full(len(timestamps), len(aoi_names)),
+                'x_px': x,
+                'y_px': y,
+            })
+            aoi_names.append(aoi_path.stem[len('aoi-'):])
+
+    def concatenate(parts, names):
+        return {
+            name: (
+                np.concatenate([part[name] for part in parts])
+                if len(parts) > 0
+                else np.zeros(0)
+            )
+            for name in names
+        }
+
+    return (
+        concatenate(
+            gaze_parts, ['timestamp_ns', 'tab_id', 'load_id', 'page_x_px', 'page_y_px']
+        ),
+        concatenate(
+            hit_parts, ['timestamp_ns', 'tab_id', 'load_id', 'aoi_id', 'x_px', 'y_px']
+        ),
+        aoi_names,
+    )
+
+
+class StudyStore:
+    # The gaze and AOI hits of many processed recordings in one directory:
+    #   gazes/ and aoi_hits/, columnar tables like those of `--output-format binary`,
+    #     sorted by recording, URL, AOI (for hits) and timestamp
+    #   gazes/index/ and aoi_hits/index/, the first row, row count and the range of
+    #     each sort column of every block of rows
+    #   recordings.json, urls.json and aois.json, the names that ids refer to
+    #
+    # Queries only read the blocks whose ranges overlap the filters. Recordings are
+    # appended, so adding one doesn't rewrite the others.
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE):
+        self.path = Path(path)
+        self.block_size = block_size
+        self.blocks_read = 0
+
+        self.names = {}
+        for name in ('recordings', 'urls', 'aois'):
+            names_file = self.path / f"{name}.json"
+            self.names[name] = (
+                json.loads(names_file.read_text()) if names_file.exists() else []
+            )
+
+        self.indices = {
+            table_name: self.read_index(table_name) for table_name in STORE_TABLES
+        }
+
+    @property
+    def recordings(self):
+        return self.names['recordings']
+
+    @property
+    def urls(self):
+        return self.names['urls']
+
+    @property
+    def aoi_names(self):
+        return self.names['aois']
+
+    def __contains__(self, recording_name):
+        return recording_name in self.recordings
+
+    def read_index(self, table_name):
+        # Blocks of recordings that weren't completely added (see `add_recording`)
+        # are left out. Index columns are appended one after the other, so after an
+        # interruption only the blocks that are in every column are read.
+        index_path = self.path / table_name / "index"
+        if not (index_path / "schema.json").exists():
+            return {
+                name: np.zeros(0, dtype)
+                for name, dtype in block_index_columns(table_name)
+            }
+
+        index = {
+            name: np.fromfile(index_path / f"{name}.bin", dtype=dtype)
+            for name, dtype in json.loads((index_path / "schema.json").read_text())
+        }
+        block_count = min(len(column) for column in index.values())
+        complete = index['recording_id_max'][:block_count] < len(self.recordings)
+
+        return {name: column[:block_count][complete] for name, column in index.items()}
+
+    def name_ids(self, kind, name):
+        ids = self.names[kind]
+        if name not in ids:
+            ids.append(name)
+
+        return ids.index(name)
+
+    def add_recording(self, name, gazes, aoi_hits, aoi_names, page_loads):
+        # `gazes` and `aoi_hits` are dicts of arrays, as returned by
+        # `read_processed_output`, and `page_loads` the URLs of the recording's page
+        # loads by tab and load id. Rows are written first, then their blocks, and
+        # the recording is only listed once both are complete.
+        recording_id = len(self.recordings)
+        load_url_ids = {
+            key: self.name_ids('urls', url) for key, (_, url) in page_loads.items()
+        }
+        aoi_ids = np.array(
+            [self.name_ids('aois', aoi_name) for aoi_name in aoi_names] + [-1],
+            dtype=np.int32,
+        )
+
+        for table_name, rows in [('gazes', gazes), ('aoi_hits', aoi_hits)]:
+            rows = dict(rows)
+            row_count = len(rows['timestamp_ns'])
+            rows['recording_id'] = np.full(row_count, recording_id)
+            rows['url_id'] = np.array(
+                [
+                    load_url_ids.get(key, -1)
+                    for key in zip(
+                        np.asarray(rows['tab_id']).tolist(),
+                        np.asarray(rows['load_id']).tolist(),
+                    )
+                ],
+                dtype=np.int32,
+            )
+            if table_name == 'aoi_hits':
+                rows['aoi_id'] = aoi_ids[np.asarray(rows['aoi_id'], dtype=np.int64)]
+
+            rows = {
+                name: np.asarray(rows[name]).astype(dtype)
+                for name, dtype in STORE_TABLES[table_name]
+            }
+            order = np.lexsort(
+                [rows[name] for name in reversed(STORE_SORT_COLUMNS[table_name])]
+            )
+            self.append_rows(
+                table_name, {name: column[order] for name, column in rows.items()}
+            )
+
+        self.recordings.append(name)
+        for kind in ('urls', 'aois', 'recordings'):
+            (self.path / f"{kind}.json").write_text(
+                json.dumps(self.names[kind], indent=4)
+            )
+
+    def create_table(self, table_path, columns):
+        table_path.mkdir(parents=True, exist_ok=True)
+        (table_path / "schema.json").write_text(json.dumps(columns))
+        for name, _ in columns:
+            (table_path / f"{name}.bin").touch()
+
+    def append_rows(self, table_name, rows):
+        table_path = self.path / table_name
+        index_path = table_path / "index"
+        if not (index_path / "schema.json").exists():
+            self.create_table(table_path, STORE_TABLES[table_name])
+            self.create_table(index_path, block_index_columns(table_name))
+
+        # Rows and blocks past the indexed ones are left over from an interrupted run
+        index = self.indices[table_name]
+        table_rows = (
+            int(index['row_start'][-1] + index['row_count'][-1])
+            if len(index['row_start']) > 0
+            else 0
+        )
+        for name, dtype in STORE_TABLES[table_name]:
+            with (table_path / f"{name}.bin").open('r+b') as column_file:
+                column_file.truncate(table_rows * np.dtype(dtype).itemsize)
+                column_file.seek(0, 2)
+                rows[name].tofile(column_file)
+
+        row_count = len(rows['timestamp_ns'])
+        starts = np.arange(0, row_count, self.block_size)
+        ends = np.append(starts[1:], row_count)
+        blocks = {
+            'row_start': table_rows + starts,
+            'row_count': ends - starts,
+        }
+        for name in STORE_SORT_COLUMNS[table_name]:
+            blocks[f"{name}_min"] = (
+                np.minimum.reduceat(rows[name], starts) if row_count > 0 else rows[name]
+            )
+            blocks[f"{name}_max"] = (
+                np.maximum.reduceat(rows[name], starts) if row_count > 0 else rows[name]
+            )
+
+        block_count = len(index['row_start'])
+        for name, dtype in block_index_columns(table_name):
+            blocks[name] = blocks[name].astype(dtype)
+            with (index_path / f"{name}.bin").open('r+b') as column_file:
+                column_file.truncate(block_count * np.dtype(dtype).itemsize)
+                column_file.seek(0, 2)
+                blocks[name].tofile(column_file)
+
+        self.indices[table_name] = {
+            name: np.concatenate([index[name], blocks[name]]) for name in index
+        }
+
+    def matching_ids(self, kind, values):
+        # Ids of the names matching `values`, a name or a list of them. URLs may be
+        # given as URL patterns, like the keys of AOI definitions.
+        if isinstance(values, str):
+            values = [values]
+
+        if kind != 'urls':
+            return np.array(
+                sorted(
+                    self.names[kind].index(value)
+                    for value in values
+                    if value in self.names[kind]
+                ),
+                dtype=np.int64,
+            )
+
+        patterns = UrlPatternIndex()
+        for pattern in values:
+            patterns.add(pattern, pattern)
+
+        return np.array(
+            [
+                url_id
+                for url_id, url in enumerate(self.urls)
+                if patterns.match(url) is not None
+            ],
+            dtype=np.int64,
+        )
+
+    def select_blocks(self, table_name, filters, start_ns, end_ns):
+        # Blocks whose column ranges overlap every filter
+        index = self.indices[table_name]
+        selected = np.ones(len(index['row_start']), dtype=bool)
+        for name, ids in filters.items():
+            ids = np.sort(ids)
+            first_candidate = np.searchsorted(ids, index[f"{name}_min"])
+            in_range = first_candidate < len(ids)
+            selected &= in_range
+            selected[in_range] &= (
+                ids[first_candidate[in_range]] <= index[f"{name}_max"][in_range]
+            )
+
+        if start_ns is not None:
+            selected &= index['timestamp_ns_max'] >= start_ns
+
+        if end_ns is not None:
+            selected &= index['timestamp_ns_min'] < end_ns
+
+        return np.flatnonzero(selected)
+
+    def read_blocks(self, table_name, blocks, names):
+        # Reads the rows of the given blocks, reading runs of consecutive blocks at once
+        table_path = self.path / table_name
+        dtypes = dict(STORE_TABLES[table_name])
+        index = self.indices[table_name]
+        run_starts = np.flatnonzero(np.diff(blocks, prepend=-2) != 1)
+        run_ends = np.flatnonzero(np.diff(blocks, append=-2) != 1)
+
+        parts = {name: [np.zeros(0, dtypes[name])] for name in names}
+        for first, last in zip(blocks[run_starts].tolist(), blocks[run_ends].tolist()):
+            row_start = int(index['row_start'][first])
+            row_count = (
+                int(index['row_start'][last] + index['row_count'][last]) - row_start
+            )
+            for name in names:
+                dtype = np.dtype(dtypes[name])
+                parts[name].append(
+                    np.fromfile(
+                        table_path / f"{name}.bin",
+                        dtype=dtype,
+                        count=row_count,
+                        offset=row_start * dtype.itemsize,
+                    )
+                )
+
+        self.blocks_read += len(blocks)
+
+        return {
+            name: np.concatenate(column_parts) for name, column_parts in parts.items()
+        }
+
+    def query(
+        self,
+        table_name,
+        recordings=None,
+        urls=None,
+        aois=None,
+        start_ns=None,
+        end_ns=None,
+        columns=None,
+    ):
+        # Rows of a table as a dict of arrays, filtered by recording names, URLs (or
+        # URL patterns), AOI names and a range of UTC timestamps in nanoseconds. Each
+        # filter may be a single value or a list, and None matches everything.
+        filters = {}
+        for name, kind, values in [
+            ('recording_id', 'recordings', recordings),
+            ('url_id', 'urls', urls),
+            ('aoi_id', 'aois', aois),
+        ]:
+            if values is not None:
+                filters[name] = self.matching_ids(kind, values)
+
+        if 'aoi_id' in filters and table_name != 'aoi_hits':
+            raise ValueError(f"{table_name} can't be filtered by AOI")
+
+        columns = (
+            [name for name, _ in STORE_TABLES[table_name]]
+            if columns is None
+            else list(columns)
+        )
+        names = list(dict.fromkeys([*filters, 'timestamp_ns', *columns]))
+        rows = self.read_blocks(
+            table_name, self.select_blocks(table_name, filters, start_ns, end_ns), names
+        )
+
+        selected = np.ones(len(rows['timestamp_ns']), dtype=bool)
+        for name, ids in filters.items():
+            selected &= np.isin(rows[name], ids)
+
+        if start_ns is not None:
+            selected &= rows['timestamp_ns'] >= start_ns
+
+        if end_ns is not None:
+            selected &= rows['timestamp_ns'] < end_ns
+
+        return {name: rows[name][selected] for name in columns}
+
+    def gazes(
+        self, recordings=None, urls=None, start_ns=None, end_ns=None, columns=None
+    ):
+        return self.query('gazes', recordings, urls, None, start_ns, end_ns, columns)
+
+    def aoi_hits(
+        self,
+        recordings=None,
+        urls=None,
+        aois=None,
+        start_ns=None,
+        end_ns=None,
+        columns=None,
+    ):
+        return self.query('aoi_hits', recordings, urls, aois, start_ns, end_ns, columns)
+
+
+def ingest_recordings(
+    source, processed_path, store_path, rebuild=False, block_size=DEFAULT_BLOCK_SIZE
+):
+    # Adds the output of every recording in `source` (see `pl-web-aois-batch`) found
+    # under `processed_path` to the store, skipping recordings it already contains.
+    # Returns the names of the recordings that were added.
+    processed_path = Path(processed_path)
+    if rebuild:
+        shutil.rmtree(store_path, ignore_errors=True)
+
+    store = StudyStore(store_path, block_size)
+    added = []
+    for recording_path, relative_path in find_recordings(source):
+        # A single recording is found as its own folder
+        name = (
+            recording_path.name
+            if relative_path == Path('.')
+            else relative_path.as_posix()
+        )
+        output_path = processed_path / relative_path
+        if name in store:
+            continue
+
+        if not (output_path / "gazes" / "schema.json").exists() and not any(
+            output_path.glob('tab-*/gazes.csv')
+        ):
+            print(f"Skipping {name}, which has no processed gaze samples")
+            continue
+
+        page_loads = read_page_loads(recording_path, output_path / ".cache")
+        store.add_recording(
+            name, *read_processed_output(output_path, page_loads), page_loads
+        )
+        added.append(name)
+
+    return added
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Add processed recordings to a study store that can be queried by "
+        "recording, URL, AOI and time"
+    )
+    parser.add_argument(
+        "source",
+        help="directory containing recordings, or a manifest file listing them",
+    )
+    parser.add_argument(
+        "processed_path",
+        help="output path of pl-web-aois-batch, or of pl-web-aois-process for a single "
+        "recording",
+    )
+    parser.add_argument("store_path")
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="replace the store instead of adding new recordings to it",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=DEFAULT_BLOCK_SIZE,
+        help="number of rows per block of the index; smaller blocks make narrow "
+        "queries read less",
+    )
+    args = parser.parse_args()
+
+    added = ingest_recordings(
+        args.source, args.processed_path, args.store_path, args.rebuild, args.block_size
+    )
+    print(f"Added {len(added)} recordings to {args.store_path}")
+
+
+if __name__ == '__main__':
+    main()
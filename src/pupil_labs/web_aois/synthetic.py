@@ -0,0 +1,286 @@
+from pathlib import Path
+import asyncio
+import time
+
+import cv2
+import numpy as np
+
+from pupil_labs.real_time_screen_gaze.marker_generator import generate_marker
+
+from .process import CALIBRATION_DTYPE
+
+
+# Recordings start at this time, so synthesized recordings are reproducible
+START_TIMESTAMP = 1_700_000_000_000_000_000
+
+
+def render_browser_window(browser_size, marker_size=250):
+    # The browser window as the recorder shows it: white, with a marker in each
+    # corner (see `embedTags` in record.js). Returns the image and the marker bounds.
+    width, height = browser_size
+    screen = np.full((height, width), 255, np.uint8)
+
+    # The tag is drawn with a white border of a tenth of the marker size, which
+    # isn't part of the marker bounds (see `createMarkerElement` in record.js)
+    inner = int(marker_size * 0.8)
+    margin = (marker_size - inner) // 2
+    corners = [
+        (0, 0),
+        (width - marker_size, 0),
+        (0, height - marker_size),
+        (width - marker_size, height - marker_size),
+    ]
+
+    marker_bounds = []
+    for marker_id, (x, y) in enumerate(corners):
+        # Rotated to match the orientation of the tag images the recorder embeds
+        marker = generate_marker(marker_id, flip_x=True, flip_y=True)
+        marker = cv2.resize(marker, (inner, inner), interpolation=cv2.INTER_NEAREST)
+        screen[y + margin:y + margin + inner, x + margin:x + margin + inner] = marker
+        marker_bounds.append((x + margin, y + margin, inner, inner))
+
+    return screen, marker_bounds
+
+
+def synthesize_recording(
+    path,
+    seconds=10,
+    aoi_count=5,
+    tab_count=1,
+    scroll_rate=5,
+    fps=30,
+    gaze_rate=200,
+    scene_size=(800, 600),
+    browser_size=(1280, 720),
+    seed=0,
+    scanpath=False,
+):
+    # Writes a recording with the files `pl-web-aois-process` reads: a scene video
+    # of a browser window that sways in front of the camera, gaze samples on and
+    # around the window, and browser events. Tabs are switched through evenly, and
+    # the active tab is scrolled `scroll_rate` times per second on average.
+    #
+    # Gaze is spread randomly, or with `scanpath`, fixates points on the page for
+    # 100 to 400 ms each, following them as the page scrolls, with saccades of two
+    # samples in between.
+    #
+    # Returns the ground truth of each gaze sample: its timestamp, the active tab,
+    # its window and page coordinates and, with `scanpath`, the fixation it belongs
+    # to (-1 for saccades).
+    rng = np.random.default_rng(seed)
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    scene_width, scene_height = scene_size
+    browser_width, browser_height = browser_size
+
+    calibration = np.zeros(1, CALIBRATION_DTYPE)
+    calibration['version'] = 1
+    calibration['scene_camera_matrix'] = [
+        [600.0, 0, scene_width / 2],
+        [0, 600.0, scene_height / 2],
+        [0, 0, 1],
+    ]
+    calibration.tofile(path / "calibration.bin")
+
+    screen, marker_bounds = render_browser_window(browser_size)
+
+    # Scene video, with the window corners moving slowly within the image
+    frame_count = int(seconds * fps)
+    frame_timestamps = (
+        START_TIMESTAMP
+        + 500_000_000
+        + (np.arange(frame_count) * 1e9 / fps).astype(np.uint64)
+    )
+    window_corners = np.float32(
+        [
+            [0, 0],
+            [browser_width, 0],
+            [browser_width, browser_height],
+            [0, browser_height],
+        ]
+    )
+    scene_corners = np.float32(
+        [[100, 100], [700, 110], [690, 460], [110, 450]]
+    ) * np.float32([scene_width / 800, scene_height / 600])
+
+    homographies = np.empty((frame_count, 3, 3))
+    video_writer = cv2.VideoWriter(
+        str(path / "Neon Scene Camera v1 ps1.mp4"),
+        cv2.VideoWriter_fourcc(*"mp4v"),
+        fps,
+        scene_size,
+    )
+    for frame_idx in range(frame_count):
+        offset = np.float32([20 * np.sin(frame_idx / 15), 10 * np.cos(frame_idx / 20)])
+        homographies[frame_idx] = cv2.getPerspectiveTransform(
+            window_corners, scene_corners + offset
+        )
+        image = cv2.warpPerspective(
+            screen, homographies[frame_idx], scene_size, borderValue=90
+        )
+        video_writer.write(cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+
+    video_writer.release()
+    frame_timestamps.tofile(path / "Neon Scene Camera v1 ps1.time")
+
+    # Browser events. Every tab loads a page and sends its markers and AOIs up front.
+    events = [(START_TIMESTAMP, "recording.begin")]
+    event_time = START_TIMESTAMP + 900_000_000
+    events.append((event_time, f"browser_size={browser_width},{browser_height}"))
+    for tab_id in range(tab_count):
+        event_time += 1
+        events.append(
+            (event_time, f"browser_url[{tab_id},0]=https://example.com/{tab_id}")
+        )
+        for marker_id, bounds in enumerate(marker_bounds):
+            events.append(
+                (
+                    event_time,
+                    f"marker[{tab_id},0,{marker_id}]="
+                    + ",".join(str(float(v)) for v in bounds),
+                )
+            )
+
+        for aoi_idx in range(aoi_count):
+            x = rng.uniform(0, browser_width - 200)
+            y = rng.uniform(0, 3 * browser_height)
+            width, height = rng.uniform(50, 400), rng.uniform(50, 300)
+            events.append(
+                (event_time, f"aoi[{tab_id},0,aoi{aoi_idx}]={x},{y},{width},{height}")
+            )
+
+    # Scrolling and tab switches, as (timestamp, tab, scroll position) changes of
+    # the active tab
+    end_time = START_TIMESTAMP + int(seconds * 1e9)
+    scroll_positions = [0.0] * tab_count
+    active_tab = 0
+    changes = [(event_time, active_tab, 0.0)]
+    events.append((event_time, f"browser_scroll[{active_tab},0]=0,0.0"))
+
+    switch_interval = int(seconds * 1e9 / tab_count)
+    next_switch = START_TIMESTAMP + switch_interval
+    event_time += 100
+    while event_time < end_time:
+        if event_time >= next_switch and tab_count > 1:
+            active_tab = (active_tab + 1) % tab_count
+            next_switch += switch_interval
+            events.append((event_time, f"browser_tab={active_tab}"))
+        else:
+            scroll_positions[active_tab] = max(
+                0.0, scroll_positions[active_tab] + rng.uniform(-40, 80)
+            )
+
+        scroll = scroll_positions[active_tab]
+        events.append((event_time, f"browser_scroll[{active_tab},0]=0,{scroll}"))
+        changes.append((event_time, active_tab, scroll))
+        event_time += (
+            max(1, int(rng.exponential(1e9 / scroll_rate)))
+            if scroll_rate > 0
+            else end_time
+        )
+
+    events.append((end_time, "recording.end"))
+    (path / "event.txt").write_text("\n".join(event for _, event in events) + "\n")
+    np.array([timestamp for timestamp, _ in events], np.uint64).tofile(
+        path / "event.time"
+    )
+
+    # Gaze on and around the window. Like the processor, a sample is seen through
+    # the last frame before it, and with the browser state of its time.
+    gaze_count = int(seconds * gaze_rate)
+    gaze_timestamps = (
+        START_TIMESTAMP
+        + 400_000_000
+        + (np.arange(gaze_count) * 1e9 / gaze_rate).astype(np.uint64)
+    )
+
+    change_timestamps = np.array([timestamp for timestamp, _, _ in changes], np.uint64)
+    change_indices = np.searchsorted(change_timestamps, gaze_timestamps, 'right') - 1
+    tab_ids = np.array([tab_id for _, tab_id, _ in changes])[
+        np.maximum(change_indices, 0)
+    ]
+    scrolls = np.array([scroll for _, _, scroll in changes])[
+        np.maximum(change_indices, 0)
+    ]
+
+    fixation_ids = np.full(gaze_count, -1)
+    if scanpath:
+        page_gazes = np.empty((gaze_count, 2))
+        target = np.array([browser_width / 2, browser_height / 2])
+        start = 0
+        while start < gaze_count:
+            previous_target = target
+            target = np.array(
+                [
+                    rng.uniform(0, browser_width),
+                    scrolls[start] + rng.uniform(0, browser_height),
+                ]
+            )
+            saccade_end = min(start + 2, gaze_count)
+            steps = np.array([[1 / 3], [2 / 3]])[:saccade_end - start]
+            page_gazes[start:saccade_end] = (
+                previous_target + (target - previous_target) * steps
+            )
+
+            end = min(saccade_end + int(rng.uniform(0.1, 0.4) * gaze_rate), gaze_count)
+            page_gazes[saccade_end:end] = target + rng.normal(
+                0, 1, (end - saccade_end, 2)
+            )
+            fixation_ids[saccade_end:end] = fixation_ids.max() + 1
+            start = end
+
+        window_gazes = page_gazes - np.column_stack([np.zeros(gaze_count), scrolls])
+    else:
+        window_gazes = np.column_stack([
+            rng.uniform(-100, browser_width + 100, gaze_count),
+            rng.uniform(-100, browser_height + 100, gaze_count),
+        ])
+
+    frame_indices = np.clip(
+        np.searchsorted(frame_timestamps, gaze_timestamps, 'left') - 1,
+        0,
+        frame_count - 1,
+    )
+    points = np.einsum(
+        'nij,nj->ni',
+        homographies[frame_indices],
+        np.column_stack([window_gazes, np.ones(gaze_count)]),
+    )
+    (points[:, :2] / points[:, 2:]).astype(np.float32).tofile(path / "gaze ps1.raw")
+    gaze_timestamps.tofile(path / "gaze ps1.time")
+
+    return {
+        'timestamps': gaze_timestamps,
+        'tab_ids': np.where(change_indices >= 0, tab_ids, -1),
+        'window': window_gazes,
+        'page': window_gazes + np.column_stack([np.zeros(gaze_count), scrolls]),
+        'fixation_ids': fixation_ids,
+        'frame_count': frame_count,
+        'event_count': len(events),
+    }
+
+
+class FakeDevice:
+    # Stands in for `pupil_labs.realtime_api.Device` in the recorder. Events are
+    # kept in `events`, and each send takes `latency_ms`.
+    def __init__(self, latency_ms=5, calibration=None):
+        self.latency_ms = latency_ms
+        self.calibration = calibration
+        self.events = []
+        self.recording = False
+
+    async def recording_start(self):
+        self.recording = True
+
+        return f"fake-{time.time_ns()}"
+
+    async def recording_stop_and_save(self):
+        self.recording = False
+
+    async def send_event(self, event, event_timestamp_unix_ns=None):
+        await asyncio.sleep(self.latency_ms / 1e3)
+        self.events.append((event, event_timestamp_unix_ns))
+
+    async def get_calibration(self):
+        return self.calibration
@@ -1,4 +1,6 @@
 from pathlib import Path
+import itertools
+import json
 
 import cv2
 import numpy as np
@@ -6,91 +8,480 @@ import matplotlib.pyplot as plt
 
 from scipy.ndimage import gaussian_filter
 
+from .events import PAGES_FILE_NAME
 from .image_tools import add_overlay
+from .screenshots import (
+    CAPTURE_FILE_NAME,
+    DEFAULT_VIEWPORT,
+    capture_path,
+    parse_viewport,
+    read_png,
+    url_directory_name,
+    write_png,
+)
+
+
+def read_csv(csv_path):
+    data = np.atleast_1d(np.genfromtxt(csv_path, delimiter=',', names=True))
+
+    return {name: data[name] for name in data.dtype.names}
+
+
+def is_binary_output(data_path):
+    return (Path(data_path) / "gazes" / "schema.json").exists()
+
+
+# Gaze is read from processed recordings in chunks of this many rows
+READ_CHUNK_SIZE = 65536
+
+# Heatmaps count gaze in square cells of this many page pixels, and are blurred
+# with a gaussian of this standard deviation in page pixels
+DEFAULT_HEATMAP_CELL_SIZE = 4
+DEFAULT_HEATMAP_SIGMA = 15
+
+# Heatmaps are overlaid on screenshots in horizontal strips of this many pixels
+OVERLAY_STRIP_HEIGHT = 1024
+
+
+def iter_table_chunks(table_path, names, chunk_size=READ_CHUNK_SIZE):
+    # Reads columns of a binary table in chunks, as dicts of arrays
+    table_path = Path(table_path)
+    dtypes = dict(json.loads((table_path / "schema.json").read_text()))
+    dtypes = {name: np.dtype(dtypes[name]) for name in names}
+    row_count = (table_path / f"{names[0]}.bin").stat().st_size // dtypes[
+        names[0]
+    ].itemsize
+
+    for start in range(0, row_count, chunk_size):
+        yield {
+            name: np.fromfile(
+                table_path / f"{name}.bin",
+                dtype=dtype,
+                count=min(chunk_size, row_count - start),
+                offset=start * dtype.itemsize,
+            )
+            for name, dtype in dtypes.items()
+        }
+
+
+def iter_csv_chunks(csv_path, chunk_size=READ_CHUNK_SIZE):
+    # Reads a CSV file written by `pl-web-aois-process` in chunks, as dicts of arrays
+    # named like the binary table columns
+    with open(csv_path, 'rt') as csv_file:
+        names = np.genfromtxt(
+            [csv_file.readline()], delimiter=',', names=True
+        ).dtype.names
+        while True:
+            lines = list(itertools.islice(csv_file, chunk_size))
+            if len(lines) == 0:
+                return
+
+            rows = np.loadtxt(lines, delimiter=',', ndmin=2)
+            yield {name: rows[:, idx] for idx, name in enumerate(names)}
+
+
+def read_pages(data_path):
+    # The page loads listed in the pages.json of a processed recording, by tab and
+    # load id, or None for output written without it
+    pages_file = Path(data_path) / PAGES_FILE_NAME
+    if not pages_file.exists():
+        return None
+
+    pages = json.loads(pages_file.read_text())
+    return {(page['tab_id'], page['load_id']): page for page in pages}
+
+
+def group_rows(*columns):
+    # Yields the distinct combinations of values in `columns` with a mask of the rows
+    # they appear in
+    keys, inverse = np.unique(np.column_stack(columns), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    for idx, key in enumerate(keys.tolist()):
+        yield tuple(key), inverse == idx
+
+
+def load_ids_at(pages, tab_id, timestamps):
+    # Load ids of the pages shown in a tab at `timestamps`, from their start times.
+    # CSV output has no load ids, so they are looked up like this.
+    tab_loads = sorted(
+        (page['timestamp_ns'], load_id)
+        for (tab, load_id), page in pages.items()
+        if tab == tab_id
+    )
+    load_starts = np.array([timestamp for timestamp, _ in tab_loads], dtype=np.uint64)
+    load_ids = np.array([-1] + [load_id for _, load_id in tab_loads])
+
+    return load_ids[
+        np.searchsorted(load_starts, timestamps.astype(np.uint64), 'right')
+    ]
+
+
+def iter_heatmap_gaze(data_path, chunk_size=READ_CHUNK_SIZE):
+    # Yields chunks of gaze of a processed recording as (name, tab id, URL, x, y),
+    # where `name` is "gazes" for gaze on the page and "aoi-<AOI name>" for AOI hits.
+    # The URL is None if the recording was processed without writing pages.json.
+    data_path = Path(data_path)
+    pages = read_pages(data_path)
+
+    def url(tab_id, load_id):
+        page = None if pages is None else pages.get((tab_id, load_id))
+        return None if page is None else page['url']
+
+    if is_binary_output(data_path):
+        for chunk in iter_table_chunks(
+            data_path / "gazes",
+            ['tab_id', 'load_id', 'page_x_px', 'page_y_px'],
+            chunk_size,
+        ):
+            for (tab_id, load_id), rows in group_rows(
+                chunk['tab_id'], chunk['load_id']
+            ):
+                yield (
+                    'gazes',
+                    tab_id,
+                    url(tab_id, load_id),
+                    chunk['page_x_px'][rows],
+                    chunk['page_y_px'][rows],
+                )
+
+        aois = json.loads((data_path / "aois.json").read_text())
+        for chunk in iter_table_chunks(
+            data_path / "aoi_hits", ['aoi_id', 'load_id', 'x_px', 'y_px'], chunk_size
+        ):
+            for (aoi_id, load_id), rows in group_rows(
+                chunk['aoi_id'], chunk['load_id']
+            ):
+                aoi = aois[aoi_id]
+                yield (
+                    f"aoi-{aoi['name']}",
+                    aoi['tab_id'],
+                    url(aoi['tab_id'], load_id),
+                    chunk['x_px'][rows],
+                    chunk['y_px'][rows],
+                )
+
+        return
+
+    for csv_path in sorted(data_path.glob('tab-*/*.csv')):
+        tab_id = int(csv_path.parent.name[len('tab-'):])
+        x_name, y_name = (
+            ('page_x_px', 'page_y_px') if csv_path.stem == 'gazes' else ('x_px', 'y_px')
+        )
+        for chunk in iter_csv_chunks(csv_path, chunk_size):
+            if pages is None:
+                yield csv_path.stem, tab_id, None, chunk[x_name], chunk[y_name]
+                continue
+
+            load_ids = load_ids_at(pages, tab_id, chunk['timestamp_ns'])
+            for (load_id,), rows in group_rows(load_ids):
+                yield (
+                    csv_path.stem,
+                    tab_id,
+                    url(tab_id, load_id),
+                    chunk[x_name][rows],
+                    chunk[y_name][rows],
+                )
+
+
+def find_processed_recordings(path):
+    # Output folders of `pl-web-aois-process` within `path`, e.g. as written by
+    # `pl-web-aois-batch`
+    path = Path(path)
+    data_paths = {
+        gaze_file.parent.parent for gaze_file in path.rglob('tab-*/gazes.csv')
+    }
+    data_paths |= {
+        schema_file.parent.parent for schema_file in path.rglob('gazes/schema.json')
+    }
+
+    return sorted(
+        data_path
+        for data_path in data_paths
+        if not any(
+            part.endswith('.partial') or part == '.segments' for part in data_path.parts
+        )
+    )
+
+
+class HeatmapAccumulator:
+    # Counts gaze in square cells of `cell_size` pixels. Gaze can be added in any
+    # number of chunks, e.g. from many recordings, and the grid grows to fit it.
+    def __init__(self, cell_size=DEFAULT_HEATMAP_CELL_SIZE):
+        self.cell_size = cell_size
+        self.counts = np.zeros((0, 0), np.int64)
+        self.total = 0
+
+    def _grow(self, rows, columns):
+        old_rows, old_columns = self.counts.shape
+        if rows <= old_rows and columns <= old_columns:
+            return
+
+        # Pages grow downwards, so rows are added generously
+        if rows > old_rows:
+            rows = max(rows, old_rows * 2)
+
+        counts = np.zeros((rows, max(columns, old_columns)), np.int64)
+        counts[:self.counts.shape[0], :self.counts.shape[1]] = self.counts
+        self.counts = counts
+
+    def add(self, x, y):
+        # Gaze at negative coordinates is outside of the page and ignored
+        x = np.asarray(x, np.float64)
+        y = np.asarray(y, np.float64)
+        valid = (x >= 0) & (y >= 0)
+        columns = (x[valid] // self.cell_size).astype(np.intp)
+        rows = (y[valid] // self.cell_size).astype(np.intp)
+        if len(rows) == 0:
+            return
+
+        self._grow(int(rows.max()) + 1, int(columns.max()) + 1)
+        cell_indices = rows * self.counts.shape[1] + columns
+
+        # Only the range of cells that was hit is counted and added
+        first, last = int(cell_indices.min()), int(cell_indices.max())
+        self.counts.reshape(-1)[first:last + 1] += np.bincount(
+            cell_indices - first, minlength=last + 1 - first
+        )
+        self.total += len(rows)
+
+    def merge(self, other):
+        self._grow(*other.counts.shape)
+        self.counts[:other.counts.shape[0], :other.counts.shape[1]] += other.counts
+        self.total += other.total
+
+    def heatmap(self, size, sigma=DEFAULT_HEATMAP_SIGMA):
+        # Blurred counts of an area of `size` (width, height) pixels, normalized to
+        # a maximum of 1, at the resolution of the cells
+        rows = -(-size[1] // self.cell_size)
+        columns = -(-size[0] // self.cell_size)
+        counts = np.zeros((rows, columns), np.float32)
+        visible = self.counts[:rows, :columns]
+        counts[:visible.shape[0], :visible.shape[1]] = visible
+
+        heatmap = gaussian_filter(counts, sigma=sigma / self.cell_size, order=0)
+        if heatmap.max() > 0:
+            heatmap /= heatmap.max()
+
+        return heatmap
+
+    def render(self, size, sigma=DEFAULT_HEATMAP_SIGMA, colormap='jet'):
+        # Colored heatmap image of `size` (width, height) pixels, with the heatmap
+        # values as alpha channel. Colors are looked up after scaling up the blurred
+        # cells to the image size.
+        heatmap = (self.heatmap(size, sigma) * 255).astype(np.uint8)
+        heatmap = cv2.resize(heatmap, size, interpolation=cv2.INTER_LINEAR)
+
+        colors = (plt.get_cmap(colormap)(np.arange(256)) * 255).astype(np.uint8)
+        heatmap_image = colors[heatmap]
+        heatmap_image[:, :, 3] = heatmap
+
+        return heatmap_image
 
 
 class HeatmapVisualizer:
-    def __init__(self, data_path, screenshot_path):
+    # Draws heatmaps over the screenshots of `pl-web-aois-screenshots`. For a single
+    # recording `screenshot_path` is the capture of one URL and viewport, for a study
+    # the folder with the captures of every URL, of which `viewport` is used.
+
+    def __init__(
+        self,
+        data_path,
+        screenshot_path,
+        cell_size=DEFAULT_HEATMAP_CELL_SIZE,
+        sigma=DEFAULT_HEATMAP_SIGMA,
+        viewport=None,
+    ):
         self.data_path = Path(data_path)
         self.screenshot_path = Path(screenshot_path)
+        self.cell_size = cell_size
+        self.sigma = sigma
+        self.viewport = (
+            parse_viewport(DEFAULT_VIEWPORT) if viewport is None else viewport
+        )
 
-    def save_full_heatmap(self, scale=0.25, detail=0.005):
-        for gaze_data_file in self.data_path.glob('tab-*/gazes.csv'):
-            self._save_heatmap(
-                gaze_data_file,
-                self.screenshot_path / 'full-page.png',
-                scale, detail
-            )
+    def accumulate(self, data_paths, include, key):
+        # Accumulators of the gaze for which `include(name, url)` is true, per
+        # `key(name, tab_id, url)`
+        accumulators = {}
+        for data_path in data_paths:
+            for name, tab_id, url, x, y in iter_heatmap_gaze(data_path):
+                if not include(name, url):
+                    continue
 
-    def save_aoi_heatmaps(self, scale=0.25, detail=0.025):
-        for gaze_data_file in self.data_path.glob('tab-*/aoi-*.csv'):
-            self.save_aoi_heatmap(gaze_data_file, scale, detail)
+                accumulator_key = key(name, tab_id, url)
+                if accumulator_key not in accumulators:
+                    accumulators[accumulator_key] = HeatmapAccumulator(self.cell_size)
 
-    def save_aoi_heatmap(self, gaze_data_file, scale=0.25, detail=0.025):
-        self._save_heatmap(
-            gaze_data_file,
-            self.screenshot_path / gaze_data_file.with_suffix('.png').name,
-            scale, detail
-        )
+                accumulators[accumulator_key].add(x, y)
+
+        return accumulators
+
+    def screenshot_url(self):
+        # The URL of the screenshots in `screenshot_path`, if they list it
+        try:
+            capture = json.loads((self.screenshot_path / CAPTURE_FILE_NAME).read_text())
+        except (OSError, ValueError):
+            return None
 
-    def _save_heatmap(self, gaze_data_path, screenshot_path, scale=0.25, detail=0.01):
-        screenshot = cv2.imread(str(screenshot_path))
-        heatmap = np.zeros(screenshot.shape[:2])
+        return capture['url']
 
-        data = np.genfromtxt(gaze_data_path, delimiter=',', names=True)
+    def shows_url(self, screenshot_url, url):
+        # Gaze is only left out if both its page and the screenshot URL are known
+        return screenshot_url is None or url is None or url == screenshot_url
 
-        hist_dims = (
-            int(screenshot.shape[0]*scale),
-            int(screenshot.shape[1]*scale),
+    def save_full_heatmap(self):
+        screenshot_url = self.screenshot_url()
+        accumulators = self.accumulate(
+            [self.data_path],
+            lambda name, url: name == 'gazes' and self.shows_url(screenshot_url, url),
+            lambda name, tab_id, url: (tab_id, name),
         )
+        for (tab_id, name), accumulator in accumulators.items():
+            self.save_heatmap(
+                accumulator,
+                self.screenshot_path / 'full-page.png',
+                self.data_path / f'tab-{tab_id}' / name,
+            )
 
-        if 'page_x_px' in data.dtype.names:
-            xy_keys = ('page_x_px', 'page_y_px')
-        else:
-            xy_keys = ('x_px', 'y_px')
+    def save_aoi_heatmaps(self):
+        screenshot_url = self.screenshot_url()
+        accumulators = self.accumulate(
+            [self.data_path],
+            lambda name, url: (
+                name.startswith('aoi-') and self.shows_url(screenshot_url, url)
+            ),
+            lambda name, tab_id, url: (tab_id, name),
+        )
+        for (tab_id, name), accumulator in accumulators.items():
+            self.save_heatmap(
+                accumulator,
+                self.screenshot_path / f'{name}.png',
+                self.data_path / f'tab-{tab_id}' / name,
+            )
 
-        gaze_on_surf_x = data[xy_keys[0]] / (hist_dims[1] / scale)
-        gaze_on_surf_y = data[xy_keys[1]] / (hist_dims[0] / scale)
+    def save_aoi_heatmap(self, gaze_data_file):
+        accumulator = HeatmapAccumulator(self.cell_size)
+        for chunk in iter_csv_chunks(gaze_data_file):
+            accumulator.add(chunk['x_px'], chunk['y_px'])
 
-        # make the histogram
-        hist, _, _ = np.histogram2d(
-            gaze_on_surf_y,
-            gaze_on_surf_x,
-            range=[[0, 1.0], [0, 1.0]],
-            bins=hist_dims
+        self.save_heatmap(
+            accumulator,
+            self.screenshot_path / f'{gaze_data_file.stem}.png',
+            gaze_data_file.with_suffix(''),
         )
 
-        # apply gaussian blur
-        heatmap = gaussian_filter(hist, sigma=15, order=0)
+    def save_study_heatmaps(self):
+        # One heatmap per URL of the whole page and of each AOI, of all recordings
+        # processed into sub-folders of `data_path`. They are written to a folder per
+        # URL, named like the screenshot folders.
+        data_paths = []
+        for data_path in find_processed_recordings(self.data_path):
+            if read_pages(data_path) is None:
+                print(f'Skipping {data_path}, which has no {PAGES_FILE_NAME}')
+            else:
+                data_paths.append(data_path)
 
-        # normalize
-        heatmap /= np.max(heatmap)
+        print(f'Aggregating {len(data_paths)} recordings')
+        accumulators = self.accumulate(
+            data_paths,
+            lambda name, url: url is not None,
+            lambda name, tab_id, url: (url, name),
+        )
+        for (url, name), accumulator in accumulators.items():
+            screenshot_name = 'full-page' if name == 'gazes' else name
+            self.save_heatmap(
+                accumulator,
+                capture_path(self.screenshot_path, url, self.viewport)
+                / f'{screenshot_name}.png',
+                self.data_path / url_directory_name(url) / name,
+            )
 
-        # scale to image size
-        heatmap = cv2.resize(heatmap, (screenshot.shape[1], screenshot.shape[0]))
+    def save_heatmap(self, accumulator, screenshot_file, destination_stem):
+        # Heatmap images are named after `destination_stem`, a path without suffix
+        if accumulator.total == 0:
+            return
 
-        # apply heatmap colors
-        cmap_func = plt.get_cmap('jet')
-        heatmap_image = (cmap_func(heatmap) * 255).astype(np.uint8)
+        if not screenshot_file.exists():
+            print(
+                f'Skipping heatmap-{destination_stem.name}, '
+                f'could not read a screenshot at {screenshot_file}'
+            )
+            return
 
-        # add alpha channel
-        heatmap_image[:,:,3] = heatmap * 255
+        screenshot = read_png(screenshot_file)
+        heatmap_image = accumulator.render(
+            (screenshot.shape[1], screenshot.shape[0]), self.sigma
+        )
 
         # write images
-        destination = str(gaze_data_path.parent / f'heatmap-{gaze_data_path.stem}-transparent.png')
-        cv2.imwrite(destination, heatmap_image)
+        destination_stem.parent.mkdir(parents=True, exist_ok=True)
+        destination = (
+            destination_stem.parent / f'heatmap-{destination_stem.name}-transparent.png'
+        )
+        write_png(destination, heatmap_image)
         print('Saved', destination)
 
-        overlaid = add_overlay(screenshot, heatmap_image)
-        destination = str(gaze_data_path.parent / f'heatmap-{gaze_data_path.stem}-overlaid.png')
-        cv2.imwrite(destination, overlaid)
+        # Blended in strips, so tall full-page screenshots don't need several times
+        # their size in memory
+        for top in range(0, screenshot.shape[0], OVERLAY_STRIP_HEIGHT):
+            strip = slice(top, top + OVERLAY_STRIP_HEIGHT)
+            add_overlay(screenshot[strip], heatmap_image[strip])
+
+        overlaid = screenshot
+        destination = (
+            destination_stem.parent / f'heatmap-{destination_stem.name}-overlaid.png'
+        )
+        write_png(destination, overlaid)
         print('Saved', destination)
 
+
 def main():
-    import sys
-    visualizer = HeatmapVisualizer(sys.argv[1], sys.argv[2])
-    visualizer.save_full_heatmap(scale=1.0)
-    visualizer.save_aoi_heatmaps(scale=1.0)
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Draw gaze heatmaps over screenshots of the page and AOIs"
+    )
+    parser.add_argument(
+        "data_path",
+        help="output path of pl-web-aois-process, or of pl-web-aois-batch with --study",
+    )
+    parser.add_argument(
+        "screenshot_path",
+        help="folder of one URL and viewport in the output of pl-web-aois-screenshots, "
+        "or the whole output with --study",
+    )
+    parser.add_argument(
+        "--study",
+        action="store_true",
+        help="aggregate all recordings processed into sub-folders of data_path into "
+        "one heatmap per URL and AOI",
+    )
+    parser.add_argument(
+        "--viewport",
+        type=parse_viewport,
+        default=DEFAULT_VIEWPORT,
+        help="with --study, use the screenshots of this WIDTHxHEIGHT viewport "
+        f"(default: {DEFAULT_VIEWPORT})",
+    )
+    parser.add_argument(
+        "--cell-size", type=int, default=DEFAULT_HEATMAP_CELL_SIZE,
+        help="count gaze in square cells of this many pixels"
+    )
+    parser.add_argument(
+        "--sigma", type=float, default=DEFAULT_HEATMAP_SIGMA,
+        help="standard deviation of the heatmap blur in pixels"
+    )
+    args = parser.parse_args()
+
+    visualizer = HeatmapVisualizer(
+        args.data_path, args.screenshot_path, args.cell_size, args.sigma, args.viewport
+    )
+    if args.study:
+        visualizer.save_study_heatmaps()
+    else:
+        visualizer.save_full_heatmap()
+        visualizer.save_aoi_heatmaps()
+
 
 if __name__ == '__main__':
     main()
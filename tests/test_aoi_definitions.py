@@ -0,0 +1,130 @@
+import re
+
+from pupil_labs.web_aois.aoi_definitions import (
+    AoiDefinitionIndex,
+    UrlPatternIndex,
+    normalize_url,
+    parse_url_pattern,
+)
+
+
+def test_normalize_url():
+    assert normalize_url("HTTPS://Example.com:443/shop/?b=2&a=1#reviews") == (
+        "https://example.com/shop",
+        "a=1&b=2",
+    )
+    assert normalize_url("http://example.com:8080") == ("http://example.com:8080", "")
+    assert normalize_url("about:blank") == ("about:blank", "")
+
+
+def test_url_pattern_precedence():
+    index = UrlPatternIndex()
+    for pattern in [
+        "re:https://example\\.com/.*",
+        "https://*.example.com/**",
+        "https://example.com/users/*/cart",
+        "prefix:https://example.com/shop",
+        "prefix:https://example.com/shop/sale",
+        "https://example.com/search?q=shoes",
+        "https://example.com/shop/",
+        "https://example.com/users/bob/*",
+        "https://example.com/item-*",
+    ]:
+        index.add(pattern, pattern)
+
+    assert len(index) == 9
+    expected = {
+        "https://example.com/shop?utm_source=mail#top": "https://example.com/shop/",
+        "https://example.com/shop/42": "prefix:https://example.com/shop",
+        "https://example.com/shop/sale/42?page=2": (
+            "prefix:https://example.com/shop/sale"
+        ),
+        "https://example.com/search?q=shoes": "https://example.com/search?q=shoes",
+        "https://example.com/users/ab12/cart/": "https://example.com/users/*/cart",
+        "https://example.com/users/bob/cart": "https://example.com/users/*/cart",
+        "https://example.com/users/bob/lists": "https://example.com/users/bob/*",
+        "https://example.com/item-42?color=red": "https://example.com/item-*",
+        "https://cdn.example.com/img/1.png": "https://*.example.com/**",
+        "https://example.com/shopping": "re:https://example\\.com/.*",
+        "https://example.com/search?q=boots": "re:https://example\\.com/.*",
+        "https://example.org/shop": None,
+    }
+    for url, pattern in expected.items():
+        assert index.match(url) == pattern, url
+
+
+def test_wildcards_in_queries_are_literal():
+    assert parse_url_pattern("https://example.com/search?q=*") == (
+        'exact',
+        "https://example.com/search?q=*",
+    )
+    assert parse_url_pattern("https://example.com/a%2Ab") == (
+        'exact',
+        "https://example.com/a%2Ab",
+    )
+    assert parse_url_pattern("https://example.com/*?q=*") == (
+        'glob',
+        "https://example.com/*?q=*",
+    )
+
+    index = UrlPatternIndex()
+    for pattern in [
+        "https://example.com/search?q=*",
+        "glob:https://example.com/search?q=*",
+        "https://example.com/page#*",
+    ]:
+        index.add(pattern, pattern)
+
+    expected = {
+        "https://example.com/search?q=*": "https://example.com/search?q=*",
+        "https://example.com/search?q=shoes": "glob:https://example.com/search?q=*",
+        "https://example.com/page#top": "https://example.com/page#*",
+        "https://example.com/pages": None,
+    }
+    for url, pattern in expected.items():
+        assert index.match(url) == pattern, url
+
+
+class FakeLocator:
+    def __init__(self, calls, url=None):
+        self.calls = calls
+        self.url = url
+
+    def __getattr__(self, name):
+        if name in ('first', 'last'):
+            return FakeLocator(self.calls + [(name,)])
+
+        return lambda **args: FakeLocator(self.calls + [(name, args)])
+
+
+def test_aoi_definitions_compile_locators_once():
+    aoi_definitions = AoiDefinitionIndex(
+        {
+            "prefix:https://example.com/products": {
+                "price": [
+                    {
+                        "type": "test_id",
+                        "args": {"test_id": "product"},
+                        "next": {"type": "first"},
+                    },
+                    {"type": "filter", "args": {"has_text(re)": "^[0-9]+ EUR$"}},
+                ],
+                "broken": [{"type": "unknown"}],
+            },
+        }
+    )
+    page_definitions = aoi_definitions.match("https://example.com/products/1")
+    regex = page_definitions.locator_chains['price'][2][1]['has_text']
+    assert isinstance(regex, re.Pattern)
+
+    assert aoi_definitions.locators(FakeLocator([], "https://example.com/")) == {}
+
+    locators = aoi_definitions.locators(
+        FakeLocator([], "https://example.com/products/2?color=red")
+    )
+    assert list(locators) == ['price']
+    assert locators['price'].calls == [
+        ('get_by_test_id', {'test_id': "product"}),
+        ('first',),
+        ('filter', {'has_text': regex}),
+    ]
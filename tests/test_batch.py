@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+from pupil_labs.web_aois.batch import (
+    COMPLETION_MARKER,
+    INPUT_FILES,
+    find_recordings,
+    fingerprint_inputs,
+    is_up_to_date,
+    process_recordings,
+)
+from pupil_labs.web_aois.synthetic import synthesize_recording
+
+
+def _make_recording(path):
+    path.mkdir(parents=True)
+    for name in INPUT_FILES:
+        (path / name).write_bytes(b"\0")
+
+
+def test_find_recordings(tmp_path):
+    _make_recording(tmp_path / "study" / "a")
+    _make_recording(tmp_path / "study" / "group" / "b")
+    (tmp_path / "study" / "incomplete").mkdir()
+    (tmp_path / "study" / "incomplete" / "event.txt").write_text("")
+
+    recordings = find_recordings(tmp_path / "study")
+    assert [relative_path.as_posix() for _, relative_path in recordings] == [
+        "a",
+        "group/b",
+    ]
+
+    (tmp_path / "manifest.txt").write_text("# comment\nstudy/a\n\nstudy/group/b\n")
+    recordings = find_recordings(tmp_path / "manifest.txt")
+    assert [path for path, _ in recordings] == [
+        tmp_path / "study" / "a",
+        tmp_path / "study" / "group" / "b",
+    ]
+    assert [relative_path.as_posix() for _, relative_path in recordings] == [
+        "study/a",
+        "study/group/b",
+    ]
+
+    # Recordings outside the manifest's folder only keep their name, which must be
+    # unique
+    _make_recording(tmp_path / "other" / "a")
+    (tmp_path / "lists" / "manifest.txt").parent.mkdir()
+    (tmp_path / "lists" / "manifest.txt").write_text(
+        "../study/group/b\n../study/a\n../other/a\n"
+    )
+    with pytest.raises(ValueError):
+        find_recordings(tmp_path / "lists" / "manifest.txt")
+
+    (tmp_path / "lists" / "manifest.txt").write_text("../study/group/b\n")
+    recordings = find_recordings(tmp_path / "lists" / "manifest.txt")
+    assert [relative_path.as_posix() for _, relative_path in recordings] == ["b"]
+
+
+def test_missing_recordings_fail(tmp_path):
+    (tmp_path / "manifest.txt").write_text("missing\n")
+    assert process_recordings(tmp_path / "manifest.txt", tmp_path / "output") == [
+        tmp_path / "missing"
+    ]
+
+
+def test_completion_marker_tracks_inputs(tmp_path):
+    recording_path = tmp_path / "recording"
+    output_path = tmp_path / "output"
+    _make_recording(recording_path)
+    output_path.mkdir()
+
+    fingerprint = fingerprint_inputs(recording_path, {"batch": True})
+    assert not is_up_to_date(output_path, fingerprint)
+
+    (output_path / COMPLETION_MARKER).write_text(json.dumps(fingerprint))
+    assert is_up_to_date(output_path, fingerprint)
+    assert not is_up_to_date(
+        output_path, fingerprint_inputs(recording_path, {"batch": False})
+    )
+
+    (recording_path / "event.txt").write_bytes(b"changed")
+    assert not is_up_to_date(
+        output_path, fingerprint_inputs(recording_path, {"batch": True})
+    )
+
+
+def test_reprocessing_reuses_caches(tmp_path):
+    synthesize_recording(tmp_path / "study" / "a", seconds=1, aoi_count=2)
+
+    assert process_recordings(tmp_path / "study", tmp_path / "output") == []
+    cache_path = tmp_path / "output" / "a" / ".cache"
+    cache_files = {path.name: path.stat().st_mtime_ns for path in cache_path.iterdir()}
+    assert any(name.startswith("markers-") for name in cache_files)
+
+    # A different output format is processed again, from the cached detections
+    (cache_path / "sentinel").write_text("")
+    failures = process_recordings(
+        tmp_path / "study", tmp_path / "output", output_format='binary'
+    )
+    assert failures == []
+    assert (tmp_path / "output" / "a" / "gazes").is_dir()
+    assert (cache_path / "sentinel").exists()
+    for name, mtime_ns in cache_files.items():
+        if name.startswith("events-"):
+            assert (cache_path / name).stat().st_mtime_ns == mtime_ns
+    assert not (tmp_path / "output" / "a.partial").exists()
@@ -0,0 +1,83 @@
+import numpy as np
+
+from pupil_labs.web_aois import events
+
+
+def _write_recording(path, lines, timestamps):
+    path.mkdir(exist_ok=True)
+    (path / "event.txt").write_bytes("\n".join(lines).encode() + b"\n")
+    np.array(timestamps, dtype="<u8").tofile(path / "event.time")
+
+
+def test_compile_events(tmp_path):
+    _write_recording(tmp_path, [
+        "recording.begin",
+        "browser_size=1280,720\r",
+        "browser_url[0,1]=https://example.com/?a=[1]",
+        "marker[0,1,3]=1.5,2,3,4",
+        "aoi[0,1,header]=0,0,1280,120.25",
+        "browser_scroll[0,1]=0,50.5",
+        "marker[0,1]=broken",
+        "aoi[1,0,header]=1,2,3,4",
+    ], range(8))
+
+    compiled = events.load_events(tmp_path)
+    records = compiled.records
+
+    assert records['kind'].tolist() == [
+        events.OTHER, events.BROWSER_SIZE, events.BROWSER_URL, events.MARKER,
+        events.AOI, events.BROWSER_SCROLL, events.OTHER, events.AOI,
+    ]
+    assert records['timestamp'].tolist() == list(range(8))
+    assert records[1]['values'][:2].tolist() == [1280, 720]
+    assert compiled.names[records[2]['name_id']] == "https://example.com/?a=[1]"
+    assert records[3]['marker_id'] == 3
+    assert records[3]['values'].tolist() == [1.5, 2, 3, 4]
+    assert records[4]['load_id'] == 1
+    assert records[5]['values'][:2].tolist() == [0, 50.5]
+
+    # AOI names are interned
+    assert records[4]['name_id'] == records[7]['name_id']
+    assert compiled.names[records[7]['name_id']] == "header"
+
+
+def test_compiled_events_are_cached(tmp_path):
+    recording_path = tmp_path / "recording"
+    cache_path = tmp_path / "cache"
+    _write_recording(recording_path, ["browser_scroll[0,0]=0,1"], [5])
+
+    compiled = events.load_events(recording_path, cache_path)
+    cached = events.load_events(recording_path, cache_path)
+    assert np.array_equal(compiled.records, cached.records)
+    assert len(list(cache_path.glob("events-*.npz"))) == 1
+
+    # A changed input is compiled again and replaces the stale cache
+    _write_recording(recording_path, ["browser_scroll[0,0]=0,2"], [5])
+    recompiled = events.load_events(recording_path, cache_path)
+    assert recompiled.records[0]['values'][1] == 2
+    assert len(list(cache_path.glob("events-*.npz"))) == 1
+
+
+def test_event_journal_replaces_event_txt(tmp_path):
+    _write_recording(tmp_path, ["browser_scroll[0,0]=0,1"], [5])
+
+    journal = events.EventJournal(tmp_path / events.JOURNAL_FILE_NAME)
+    journal.append("browser_scroll[0,0]=0,2", 20)
+    journal.append("browser_url[0,1]=https://example.com/", 10)
+    journal.close()
+
+    # Appending to an existing journal, with the last record cut off mid-write
+    journal = events.EventJournal(tmp_path / events.JOURNAL_FILE_NAME)
+    journal.append("browser_size=800,600", 30)
+    journal.append("browser_size=1280,720", 40)
+    journal.close()
+    with (tmp_path / events.JOURNAL_FILE_NAME).open('r+b') as journal_file:
+        journal_file.truncate(journal_file.seek(0, 2) - 3)
+
+    compiled = events.load_events(tmp_path)
+    assert compiled.records['timestamp'].tolist() == [20, 10, 30]
+    assert compiled.records['kind'].tolist() == [
+        events.BROWSER_SCROLL,
+        events.BROWSER_URL,
+        events.BROWSER_SIZE,
+    ]
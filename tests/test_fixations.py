@@ -0,0 +1,118 @@
+import csv
+import json
+
+import numpy as np
+
+from pupil_labs.web_aois.events import read_table
+from pupil_labs.web_aois.fixations import FixationDetector
+from pupil_labs.web_aois.process import RecordingProcessor
+from pupil_labs.web_aois.synthetic import synthesize_recording
+
+
+def test_detector_across_chunks():
+    # 200 Hz gaze: a fixation, a saccade, a fixation drifting 1 px per sample, a
+    # fixation too short to count, a gap and a last fixation
+    timestamps = np.arange(200) * 5_000_000
+    x = np.zeros(200)
+    y = np.zeros(200)
+    x[40:42] = [100, 200]
+    x[42:100] = 300 + np.arange(58)
+    x[100:105] = 600
+    x[105:] = 900
+    timestamps[150:] += 500_000_000
+
+    whole = FixationDetector()
+    expected = [
+        np.concatenate(parts)
+        for parts in zip(whole.add(timestamps, x, y), whole.flush())
+    ]
+    assert expected[0].tolist() == [
+        0,
+        42 * 5_000_000,
+        105 * 5_000_000,
+        150 * 5_000_000 + 500_000_000,
+    ]
+    assert expected[1].tolist() == [
+        39 * 5_000_000,
+        99 * 5_000_000,
+        149 * 5_000_000,
+        199 * 5_000_000 + 500_000_000,
+    ]
+    assert np.allclose(expected[2], [0, 328.5, 900, 900])
+
+    chunked = FixationDetector()
+    results = [
+        chunked.add(timestamps[start:start + 7], x[start:start + 7], y[start:start + 7])
+        for start in range(0, 200, 7)
+    ]
+    results.append(chunked.flush())
+    for column, expected_column in zip(zip(*results), expected):
+        assert np.allclose(np.concatenate(column), expected_column)
+
+
+def test_fixations_follow_scrolled_pages(tmp_path):
+    truth = synthesize_recording(
+        tmp_path / "recording", seconds=4, aoi_count=20, scroll_rate=5, scanpath=True
+    )
+
+    RecordingProcessor(
+        tmp_path / "recording",
+        tmp_path / "binary",
+        batch=True,
+        show_progress=False,
+        output_format='binary',
+        fixations_only=True,
+    ).process()
+    RecordingProcessor(
+        tmp_path / "recording", tmp_path / "csv", show_progress=False, fixations=True
+    ).process()
+    assert not (tmp_path / "binary" / "gazes").exists()
+    assert (tmp_path / "csv" / "tab-0" / "gazes.csv").exists()
+
+    # Every fixation lies within one fixation of the scanpath, even while the page
+    # scrolls, and few are missed once the window is located
+    fixations = read_table(tmp_path / "binary" / "fixations")
+    timestamps = truth['timestamps'].astype(np.int64)
+    fixation_ids = []
+    columns = ('start_timestamp_ns', 'end_timestamp_ns', 'page_x_px', 'page_y_px')
+    for start, end, x, y in zip(*[fixations[name] for name in columns]):
+        samples = (timestamps >= start) & (timestamps <= end)
+        assert len(set(truth['fixation_ids'][samples].tolist())) == 1
+        fixation_ids.append(truth['fixation_ids'][samples][0])
+        assert np.hypot(*(truth['page'][samples].mean(axis=0) - [x, y])) < 3
+
+    assert min(fixation_ids) >= 0
+    assert len(set(fixation_ids)) == len(fixation_ids)
+    mapped_ids = set(
+        truth['fixation_ids'][timestamps > timestamps[0] + 600_000_000].tolist()
+    ) - {-1}
+    assert len(fixation_ids) >= 0.75 * len(mapped_ids)
+
+    # Both formats list the same fixations and AOIs
+    with (tmp_path / "csv" / "tab-0" / "fixations.csv").open() as fixations_file:
+        rows = list(csv.DictReader(fixations_file))
+
+    assert [int(row['start timestamp [ns]']) for row in rows] == fixations[
+        'start_timestamp_ns'
+    ].tolist()
+    assert np.allclose(
+        [float(row['page x [px]']) for row in rows], fixations['page_x_px']
+    )
+
+    aoi_names = [
+        aoi['name']
+        for aoi in json.loads((tmp_path / "binary" / "aois.json").read_text())
+    ]
+    fixation_aois = read_table(tmp_path / "binary" / "fixation_aois")
+    hits = {}
+    for start, aoi_id in zip(
+        fixation_aois['start_timestamp_ns'].tolist(), fixation_aois['aoi_id'].tolist()
+    ):
+        hits.setdefault(start, []).append(aoi_names[aoi_id])
+
+    assert len(hits) > 0
+    assert {
+        int(row['start timestamp [ns]']): row['aois'].split(';')
+        for row in rows
+        if row['aois'] != ''
+    } == hits
@@ -0,0 +1,16 @@
+import pytest
+
+from pupil_labs.web_aois import gaze_mapper
+
+
+@pytest.mark.parametrize("installed", ["1.1.2", "1.1.10", "1.1.3.post1"])
+def test_supported_gaze_mapper_versions(monkeypatch, installed):
+    monkeypatch.setattr(gaze_mapper, "version", lambda name: installed)
+    gaze_mapper.check_gaze_mapper_version()
+
+
+@pytest.mark.parametrize("installed", ["1.1.1", "1.2.0", "2.0"])
+def test_unsupported_gaze_mapper_versions(monkeypatch, installed):
+    monkeypatch.setattr(gaze_mapper, "version", lambda name: installed)
+    with pytest.raises(RuntimeError, match=installed):
+        gaze_mapper.check_gaze_mapper_version()
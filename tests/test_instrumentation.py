@@ -0,0 +1,70 @@
+from pupil_labs.web_aois.events import read_table
+from pupil_labs.web_aois.instrumentation import Instrumentation
+from pupil_labs.web_aois.process import RecordingProcessor
+from pupil_labs.web_aois.synthetic import synthesize_recording
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_nested_stages_are_exclusive():
+    clock = FakeClock()
+    instrumentation = Instrumentation(clock=clock)
+    clock.now += 1
+    with instrumentation.stage('outer'):
+        clock.now += 2
+        for _ in range(2):
+            with instrumentation.stage('inner'):
+                clock.now += 3
+
+        clock.now += 0.5
+
+    clock.now += 1
+    report = instrumentation.report()
+    assert report['stages']['inner'] == {'calls': 2, 'seconds': 6}
+    assert report['stages']['outer'] == {'calls': 1, 'seconds': 2.5}
+    assert report['wall_seconds'] == 10.5
+
+
+def test_processing_counters(tmp_path):
+    truth = synthesize_recording(tmp_path / "recording", seconds=2, aoi_count=10)
+
+    progress = []
+    instrumentation = Instrumentation(progress_interval=0, emit=progress.append)
+    RecordingProcessor(
+        tmp_path / "recording", tmp_path / "output", batch=True, show_progress=False,
+        output_format='binary', instrumentation=instrumentation,
+    ).process()
+
+    counters = instrumentation.report()['counters']
+    assert counters['frames'] == truth['frame_count']
+    assert (
+        counters['frames decoded'] + counters['frames skipped'] == truth['frame_count']
+    )
+    assert counters['gazes'] == len(truth['timestamps'])
+    assert counters['gazes mapped'] == len(
+        read_table(tmp_path / "output" / "gazes")['timestamp_ns']
+    )
+    assert counters['aoi hits'] == len(
+        read_table(tmp_path / "output" / "aoi_hits")['timestamp_ns']
+    )
+    assert counters['gazes mapped'] + counters['gazes off surface'] == counters['gazes']
+    assert counters['bytes written'] > 0
+    assert len(progress) == truth['frame_count']
+    assert progress[-1]['done'] == progress[-1]['total']
+
+    # Processing again reads all detections from the cache
+    instrumentation = Instrumentation()
+    RecordingProcessor(
+        tmp_path / "recording", tmp_path / "output", batch=True, show_progress=False,
+        output_format='binary', instrumentation=instrumentation,
+    ).process()
+
+    report = instrumentation.report()
+    assert report['counters']['frames from cache'] == counters['frames decoded']
+    assert 'decode' not in report['stages']
@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+
+from pupil_labs.web_aois.live import LatestFrameMailbox, LiveSession
+from pupil_labs.web_aois.process import CALIBRATION_DTYPE
+from pupil_labs.web_aois.synthetic import render_browser_window
+
+
+NOW = 1_700_000_000_000_000_000
+
+
+def test_mailbox_keeps_latest_frame():
+    mailbox = LatestFrameMailbox()
+    for frame in range(3):
+        mailbox.put(frame)
+
+    assert mailbox.get() == 2
+    assert mailbox.dropped == 2
+
+    mailbox.close()
+    assert mailbox.get() is None
+
+
+def _browser_frame(browser_size):
+    # Scene camera image of the browser window, seen straight on and scaled down by half
+    screen, marker_bounds = render_browser_window(browser_size)
+    width, height = browser_size
+
+    frame = np.full((height // 2 + 200, width // 2 + 200), 90, np.uint8)
+    frame[100:100 + height // 2, 100:100 + width // 2] = cv2.resize(
+        screen, (width // 2, height // 2)
+    )
+    marker_events = [
+        f"marker[0,0,{marker_id}]=" + ",".join(str(v) for v in bounds)
+        for marker_id, bounds in enumerate(marker_bounds)
+    ]
+
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR), marker_events
+
+
+def _start_session(published, clock):
+    image, marker_events = _browser_frame((1280, 720))
+    calibration = np.zeros(1, CALIBRATION_DTYPE)
+    calibration['scene_camera_matrix'] = [[600.0, 0, 420], [0, 600.0, 280], [0, 0, 1]]
+
+    session = LiveSession(calibration[0], [published.append], clock=clock)
+    session.start()
+
+    for event in [
+        "browser_size=1280,720",
+        "browser_url[0,0]=https://example.com/",
+        *marker_events,
+    ]:
+        session.append(event, NOW)
+
+    session.append("browser_scroll[0,0]=0,1000", NOW)
+    session.append("aoi[0,0,tile]=600,1300,100,100", NOW)
+
+    return session, image
+
+
+def test_live_session_maps_gaze():
+    # Mapping takes 5 ms, however slow the machine running the test is
+    clock_ns = iter([NOW + 10_000_000, NOW + 15_000_000])
+    published = []
+    session, image = _start_session(published, lambda: next(clock_ns))
+
+    # The page point (640, 1360) is at the window point (640, 360). The second
+    # sample shares its timestamp and is on the page, but outside the AOI.
+    session.add_gaze(NOW, 100 + 640 / 2, 100 + 360 / 2)
+    session.add_gaze(NOW, 100 + 100 / 2, 100 + 100 / 2)
+    session.add_gaze(NOW + 1, 10, 10)
+    session.add_frame(NOW, lambda: image)
+    session.close()
+
+    assert session.counters['published gazes'] == 2
+    assert session.latencies_ns == [15_000_000, 15_000_000]
+    assert session.mapping_durations_ns == [5_000_000]
+    message, other_message = published
+    assert message['timestamp_ns'] == NOW
+    assert np.allclose(message['page'], [640, 1360], atol=1)
+    assert list(message['aois']) == ['tile']
+    assert np.allclose(message['aois']['tile']['px'], [40, 60], atol=1)
+    assert other_message['timestamp_ns'] == NOW
+    assert np.allclose(other_message['page'], [100, 1100], atol=1)
+    assert other_message['aois'] == {}
+
+
+def test_live_session_drops_stale_frames():
+    published = []
+    session, image = _start_session(published, lambda: NOW + 300_000_000)
+
+    session.add_gaze(NOW, 100 + 640 / 2, 100 + 360 / 2)
+    session.add_frame(NOW, lambda: image)
+    session.close()
+
+    assert published == []
+    assert session.snapshot_counters() == {
+        'frames': 1,
+        'mapped frames': 0,
+        'stale frames': 1,
+        'gazes': 1,
+        'published gazes': 0,
+        'stale gazes': 0,
+        'overflowed gazes': 0,
+        'dropped frames': 0,
+    }
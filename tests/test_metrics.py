@@ -0,0 +1,159 @@
+import numpy as np
+import pytest
+
+from pupil_labs.web_aois import events
+from pupil_labs.web_aois.metrics import (
+    AOI_METRICS_FILE_NAME,
+    AoiMetrics,
+    compute_aoi_metrics,
+)
+from pupil_labs.web_aois.process import RecordingProcessor
+from pupil_labs.web_aois.synthetic import synthesize_recording
+
+
+def _event(kind, tab_id=0, load_id=0, name_id=0, values=(0, 0, 0, 0)):
+    record = np.zeros((), dtype=events.EVENT_DTYPE)
+    record['kind'] = kind
+    record['tab_id'] = tab_id
+    record['load_id'] = load_id
+    record['name_id'] = name_id
+    record['values'] = values
+
+    return record
+
+
+def test_visits_and_visible_time():
+    metrics = AoiMetrics(max_visit_gap_ms=20)
+    names = ["https://example.com/", "header", "footer", "https://example.com/next"]
+    metrics.process_event(
+        0, _event(events.BROWSER_SIZE, values=(1000, 500, 0, 0)), names
+    )
+    metrics.process_event(1_000_000, _event(events.BROWSER_URL, name_id=0), names)
+    metrics.process_event(
+        1_000_000, _event(events.AOI, name_id=1, values=(0, 0, 1000, 100)), names
+    )
+    metrics.process_event(
+        1_000_000, _event(events.AOI, name_id=2, values=(0, 900, 1000, 100)), names
+    )
+    metrics.process_event(
+        101_000_000, _event(events.BROWSER_SCROLL, values=(0, 600, 0, 0)), names
+    )
+    metrics.advance(201_000_000)
+
+    header = metrics.add_aoi(0, "header")
+    metrics.add_aoi(0, "footer")
+
+    # Samples every 5 ms, in two chunks. The header is hit by samples 0-2, 4-6 and 8,
+    # and by sample 9, which follows a gap of 30 ms.
+    timestamps = (
+        np.array([0, 5, 10, 15, 20, 25, 30, 35, 40, 70]) * 1_000_000 + 11_000_000
+    )
+    for chunk, hits in [(slice(0, 5), [0, 1, 2, 4]), (slice(5, 10), [5, 6, 8, 9])]:
+        metrics.write_gazes(0, 0, [timestamps[chunk]])
+        metrics.write_aoi_hits(0, 0, header, [timestamps[hits]])
+
+    assert metrics.rows() == [
+        [0, 0, "https://example.com/", "footer", 0, 0, 0, 0.0, '', 100.0],
+        [0, 0, "https://example.com/", "header", 8, 4, 3, 20.0, 10.0, 100.0],
+    ]
+
+    # The next page only has a header, in the viewport. The footer of the previous
+    # page would be too, but isn't on this page.
+    metrics.process_event(
+        201_000_000, _event(events.BROWSER_URL, load_id=1, name_id=3), names
+    )
+    metrics.process_event(
+        201_000_000,
+        _event(events.AOI, load_id=1, name_id=1, values=(0, 700, 1000, 100)),
+        names,
+    )
+    metrics.advance(301_000_000)
+
+    assert metrics.rows()[2:] == [
+        [0, 1, "https://example.com/next", "header", 0, 0, 0, 0.0, '', 100.0],
+    ]
+
+    # Nothing is visible once the browser was closed
+    metrics.process_event(301_000_000, _event(events.BROWSER_CLOSED), names)
+    metrics.advance(401_000_000)
+
+    assert metrics.rows()[2:] == [
+        [0, 1, "https://example.com/next", "header", 0, 0, 0, 0.0, '', 100.0],
+    ]
+
+
+def test_metrics_need_gaze_samples(tmp_path):
+    with pytest.raises(ValueError):
+        RecordingProcessor(
+            tmp_path, tmp_path / "output", aoi_metrics=True, fixations_only=True
+        )
+
+
+def test_metrics_match_backfill(tmp_path):
+    synthesize_recording(
+        tmp_path / "recording", seconds=3, aoi_count=10, tab_count=2, scroll_rate=5
+    )
+
+    for name, options in [
+        ("csv", {}),
+        ("binary", {'batch': True, 'output_format': 'binary'}),
+    ]:
+        RecordingProcessor(
+            tmp_path / "recording",
+            tmp_path / name,
+            show_progress=False,
+            aoi_metrics=True,
+            **options,
+        ).process()
+        compute_aoi_metrics(tmp_path / "recording", tmp_path / name).write(
+            tmp_path / f"{name}.csv"
+        )
+
+        summary = (tmp_path / name / AOI_METRICS_FILE_NAME).read_text()
+        assert (tmp_path / f"{name}.csv").read_text() == summary
+        assert len(summary.splitlines()) > 5
+
+    csv_summary, binary_summary = [
+        (tmp_path / name / AOI_METRICS_FILE_NAME).read_text()
+        for name in ("csv", "binary")
+    ]
+    assert csv_summary == binary_summary
+
+
+@pytest.mark.parametrize("gaze", ["none", "off-page"])
+def test_metrics_without_mapped_gaze(tmp_path, gaze):
+    recording_path = tmp_path / "recording"
+    synthesize_recording(recording_path, seconds=2, aoi_count=3, scroll_rate=5)
+    if gaze == "none":
+        (recording_path / "gaze ps1.raw").write_bytes(b"")
+        (recording_path / "gaze ps1.time").write_bytes(b"")
+    else:
+        gazes = np.fromfile(recording_path / "gaze ps1.raw", '<f4')
+        np.full_like(gazes, -1000).tofile(recording_path / "gaze ps1.raw")
+
+    for name, options in [
+        ("csv", {}),
+        ("binary", {'batch': True, 'output_format': 'binary'}),
+    ]:
+        RecordingProcessor(
+            recording_path,
+            tmp_path / name,
+            show_progress=False,
+            aoi_metrics=True,
+            **options,
+        ).process()
+        metrics = compute_aoi_metrics(recording_path, tmp_path / name)
+        metrics.write(tmp_path / f"{name}.csv")
+
+        summary = (tmp_path / name / AOI_METRICS_FILE_NAME).read_text()
+        assert (tmp_path / f"{name}.csv").read_text() == summary
+
+        # Without samples there is nothing to report. Samples off the page leave the
+        # AOIs that were visible without hits.
+        rows = metrics.rows()
+        if gaze == "none":
+            assert rows == []
+            assert len(summary.splitlines()) == 1
+        else:
+            assert len(rows) > 0
+            assert all(row[4:8] == [0, 0, 0, 0.0] for row in rows)
@@ -0,0 +1,388 @@
+import numpy as np
+
+from pupil_labs.real_time_screen_gaze.gaze_mapper import MarkerMappedGaze
+from surface_tracker import CornerId, Marker
+from pupil_labs.web_aois.events import read_table
+from pupil_labs.web_aois.process import (
+    AoiGridIndex,
+    BinaryOutputWriter,
+    BrowserTabState,
+    CsvOutputWriter,
+    interpolate_surface_transforms,
+    MarkerDetectionCache,
+    SceneMarkerSource,
+    Timeline,
+    merge_timelines,
+    merge_segment_outputs,
+    schedule_scene_frames,
+    split_scheduled_frames,
+)
+
+
+def _make_tab_state(writer, innermost_aoi=False):
+    tab = BrowserTabState(0, writer, innermost_aoi)
+    tab.add_history('https://example.com/', 0, 0)
+    tab.set_scroll_position(0.0, 50.5)
+    tab.set_aoi('header', 0.0, 0.0, 1280.0, 120.0)
+    tab.set_aoi('tile', 100.0, 400.0, 300.0, 250.0)
+    tab.set_aoi('nested', 150.0, 450.0, 120.0, 100.0)
+    tab.set_aoi('tile', 110.0, 410.0, 300.0, 250.0)
+    return tab
+
+
+def test_batched_gaze_matches_per_sample(tmp_path):
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(2000, dtype=np.uint64) * 5_000_000
+    surface_gazes = rng.uniform(-0.2, 1.2, size=(len(timestamps), 2))
+    browser_size = [1280, 720]
+
+    per_sample = _make_tab_state(CsvOutputWriter(tmp_path / "per-sample"))
+    for timestamp, (x, y) in zip(timestamps, surface_gazes.tolist()):
+        surface_gaze = MarkerMappedGaze.from_norm_pos('surface', (x, y), None)
+        per_sample.process_gaze(timestamp, surface_gaze, browser_size)
+
+    # Small chunks and few open files to exercise flushing and reopening files
+    batched = _make_tab_state(
+        CsvOutputWriter(tmp_path / "batched", chunk_size=7, max_open_files=2)
+    )
+    binary = _make_tab_state(
+        BinaryOutputWriter(tmp_path / "binary", chunk_size=7, max_open_files=2)
+    )
+    for batch_start in range(0, len(timestamps), 300):
+        batch = slice(batch_start, batch_start + 300)
+        batched.process_gazes(timestamps[batch], surface_gazes[batch], browser_size)
+        binary.process_gazes(timestamps[batch], surface_gazes[batch], browser_size)
+        assert len(batched.writer.files.open_files) <= 2
+
+    for tab in (per_sample, batched, binary):
+        tab.writer.close()
+
+    for name in ['gazes.csv', 'aoi-header.csv', 'aoi-tile.csv', 'aoi-nested.csv']:
+        expected = (tmp_path / "per-sample" / "tab-0" / name).read_text()
+        assert expected.count('\n') > 1
+        assert (tmp_path / "batched" / "tab-0" / name).read_text() == expected
+
+    expected = np.genfromtxt(
+        tmp_path / "per-sample" / "tab-0" / "gazes.csv", delimiter=',', names=True
+    )
+    gazes = read_table(tmp_path / "binary" / "gazes")
+    for name in expected.dtype.names:
+        assert np.array_equal(gazes[name], expected[name])
+
+    assert np.all(gazes['tab_id'] == 0)
+    assert np.all(gazes['load_id'] == 0)
+
+    expected = np.genfromtxt(
+        tmp_path / "per-sample" / "tab-0" / "aoi-tile.csv", delimiter=',', names=True
+    )
+    aoi_hits = read_table(tmp_path / "binary" / "aoi_hits")
+    tile_hits = aoi_hits['aoi_id'] == 1
+    for name in expected.dtype.names:
+        assert np.array_equal(aoi_hits[name][tile_hits], expected[name])
+
+
+def test_aoi_grid_index_matches_brute_force():
+    rng = np.random.default_rng(0)
+    index = AoiGridIndex(cell_size=100, max_cells=16)
+    bounds = np.column_stack([
+        rng.uniform(-50, 1000, 300),
+        rng.uniform(-50, 5000, 300),
+        rng.uniform(0, 300, 300),
+        rng.uniform(0, 300, 300),
+    ])
+    bounds[:10, 2:] = [1000, 2000]  # Spanning many cells
+    bounds[10, 2:] = 0
+    for aoi_idx, aoi_bounds in enumerate(bounds):
+        index.set(aoi_idx, aoi_bounds)
+
+    # Moving AOIs, including to and from the cells of large AOIs
+    for aoi_idx in [0, 20, 30, 40]:
+        bounds[aoi_idx] = [rng.uniform(0, 900), rng.uniform(0, 4900), 100, 100]
+        index.set(aoi_idx, bounds[aoi_idx])
+
+    bounds[50] = [0, 0, 1200, 5000]
+    index.set(50, bounds[50])
+
+    points = rng.uniform(-100, 5100, size=(5000, 2))
+    points[:100] = bounds[100:200, :2] + [0, 10]  # On the edges
+    relative = points[:, np.newaxis, :] - bounds[np.newaxis, :, :2]
+    inside = np.all((relative > 0) & (relative < bounds[np.newaxis, :, 2:]), axis=2)
+    expected_aois, expected_points = np.nonzero(inside.T)
+
+    point_indices, aoi_indices = index.query(points, min_aois=0)
+    assert np.array_equal(point_indices, expected_points)
+    assert np.array_equal(aoi_indices, expected_aois)
+
+    # Testing every AOI gives the same result
+    all_point_indices, all_aoi_indices = index.query(points, min_aois=len(bounds))
+    assert np.array_equal(all_point_indices, expected_points)
+    assert np.array_equal(all_aoi_indices, expected_aois)
+
+    for point_idx in range(50):
+        assert set(np.flatnonzero(inside[point_idx])) <= set(
+            index.candidates(points[point_idx])
+        )
+
+    point_indices, aoi_indices = index.innermost(point_indices, aoi_indices)
+    areas = np.where(inside, bounds[:, 2] * bounds[:, 3], np.inf)
+    assert np.array_equal(np.sort(point_indices), np.flatnonzero(inside.any(axis=1)))
+    assert np.array_equal(aoi_indices, np.argmin(areas, axis=1)[point_indices])
+    assert np.all(np.diff(aoi_indices) >= 0)
+
+
+def test_innermost_aoi_hits(tmp_path):
+    rng = np.random.default_rng(1)
+    timestamps = np.arange(2000, dtype=np.uint64) * 5_000_000
+    surface_gazes = rng.uniform(0, 1, size=(len(timestamps), 2))
+    browser_size = [1280, 720]
+
+    per_sample = _make_tab_state(
+        CsvOutputWriter(tmp_path / "per-sample"), innermost_aoi=True
+    )
+    for timestamp, (x, y) in zip(timestamps, surface_gazes.tolist()):
+        surface_gaze = MarkerMappedGaze.from_norm_pos('surface', (x, y), None)
+        per_sample.process_gaze(timestamp, surface_gaze, browser_size)
+
+    batched = _make_tab_state(CsvOutputWriter(tmp_path / "batched"), innermost_aoi=True)
+    batched.process_gazes(timestamps, surface_gazes, browser_size)
+    everything = _make_tab_state(CsvOutputWriter(tmp_path / "all"))
+    everything.process_gazes(timestamps, surface_gazes, browser_size)
+    for tab in (per_sample, batched, everything):
+        tab.writer.close()
+
+    for name in ['aoi-header.csv', 'aoi-tile.csv', 'aoi-nested.csv']:
+        expected = (tmp_path / "per-sample" / "tab-0" / name).read_text()
+        assert (tmp_path / "batched" / "tab-0" / name).read_text() == expected
+
+    # Hits on the nested AOI are no longer hits on the tile around it
+    def hit_timestamps(path, name):
+        return set(
+            np.genfromtxt(
+                path / "tab-0" / name, delimiter=',', skip_header=1, usecols=0
+            ).tolist()
+        )
+
+    nested = hit_timestamps(tmp_path / "all", "aoi-nested.csv")
+    tile = hit_timestamps(tmp_path / "all", "aoi-tile.csv")
+    assert len(nested) > 0 and nested <= tile
+    assert hit_timestamps(tmp_path / "per-sample", "aoi-nested.csv") == nested
+    assert hit_timestamps(tmp_path / "per-sample", "aoi-tile.csv") == tile - nested
+
+
+def test_schedule_scene_frames():
+    frame_timestamps = np.array([10, 20, 30, 40, 50, 60], dtype=np.uint64)
+    gaze_timestamps = np.array([5, 20, 21, 35, 36, 61], dtype=np.uint64)
+
+    scheduled = schedule_scene_frames(frame_timestamps, gaze_timestamps, 15)
+    # frame 10 is before surfaces exist, frames 40 and 50 aren't followed by gaze
+    assert scheduled.tolist() == [False, True, True, False, False, True]
+
+    # frames from 40 on are after the browser was closed
+    scheduled = schedule_scene_frames(frame_timestamps, gaze_timestamps, 15, 40)
+    assert scheduled.tolist() == [False, True, True, False, False, False]
+
+    scheduled = schedule_scene_frames(frame_timestamps, gaze_timestamps, None)
+    assert not scheduled.any()
+
+
+def _generator_order(frame_timestamps, event_timestamps, gaze_timestamps):
+    # Processing order of the former generator based implementation
+    order = []
+    event_idx = 0
+    gaze_idx = 0
+
+    def iterate_until(timestamp):
+        nonlocal event_idx, gaze_idx
+        while gaze_idx < len(gaze_timestamps) and (
+            timestamp is None or gaze_timestamps[gaze_idx] <= timestamp
+        ):
+            while (
+                event_idx < len(event_timestamps)
+                and event_timestamps[event_idx] <= gaze_timestamps[gaze_idx]
+            ):
+                order.append(('event', event_idx))
+                event_idx += 1
+
+            order.append(('gaze', gaze_idx))
+            gaze_idx += 1
+
+    for frame_idx, frame_timestamp in enumerate(frame_timestamps):
+        iterate_until(frame_timestamp)
+        order.append(('frame', frame_idx))
+
+    iterate_until(None)
+    return order
+
+
+def test_merge_timelines_matches_generator_order():
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        # Small value ranges to produce plenty of identical timestamps
+        frame_timestamps = np.sort(rng.integers(0, 60, 15)).astype(np.uint64)
+        event_timestamps = np.sort(rng.integers(0, 70, 10)).astype(np.uint64)
+        gaze_timestamps = np.sort(rng.integers(5, 60, 40)).astype(np.uint64)
+
+        order = []
+        gaze_position = 0
+        for gaze_index, is_event, index in zip(
+            *merge_timelines(frame_timestamps, event_timestamps, gaze_timestamps)
+        ):
+            order += [('gaze', idx) for idx in range(gaze_position, gaze_index)]
+            order.append(('event' if is_event else 'frame', index))
+            gaze_position = gaze_index
+
+        order += [('gaze', idx) for idx in range(gaze_position, len(gaze_timestamps))]
+
+        assert order == _generator_order(
+            frame_timestamps, event_timestamps, gaze_timestamps
+        )
+
+
+def test_split_scheduled_frames():
+    scheduled = np.zeros(100, dtype=bool)
+    scheduled[40:80] = True
+
+    frame_ranges = split_scheduled_frames(scheduled, 4)
+    assert frame_ranges == [(0, 50), (50, 60), (60, 70), (70, 100)]
+
+    # Segments start on every third scheduled frame
+    frame_ranges = split_scheduled_frames(scheduled, 4, stride=3)
+    assert frame_ranges == [(0, 49), (49, 61), (61, 70), (70, 100)]
+
+
+def test_merge_segment_outputs(tmp_path):
+    segment_paths = [tmp_path / "0", tmp_path / "1"]
+    for idx, segment_path in enumerate(segment_paths):
+        (segment_path / "tab-0").mkdir(parents=True)
+        (segment_path / "tab-0" / "gazes.csv").write_bytes(
+            f"header\r\n{idx}a\r\n{idx}b\r\n".encode()
+        )
+
+    (segment_paths[1] / "tab-1").mkdir()
+    (segment_paths[1] / "tab-1" / "aoi-x.csv").write_bytes(b"header\r\n1c\r\n")
+
+    merge_segment_outputs(segment_paths, tmp_path / "merged")
+
+    merged = (tmp_path / "merged" / "tab-0" / "gazes.csv").read_bytes()
+    assert merged == b"header\r\n0a\r\n0b\r\n1a\r\n1b\r\n"
+    assert (
+        tmp_path / "merged" / "tab-1" / "aoi-x.csv"
+    ).read_bytes() == b"header\r\n1c\r\n"
+
+
+def test_timeline_sorts_stably():
+    timeline = Timeline(
+        np.array([30, 10, 20, 10], dtype=np.uint64), np.array([0, 1, 2, 3, 4])
+    )
+
+    # Data without a timestamp is dropped
+    assert timeline.timestamps.tolist() == [10, 10, 20, 30]
+    assert timeline.data.tolist() == [1, 3, 2, 0]
+    assert timeline.index_range(15, 30) == (2, 4)
+
+
+def _make_markers(frame_index, tag_ids):
+    return [
+        Marker.from_vertices(
+            uid=f"tag36h11:{tag_id}",
+            undistorted_image_space_vertices=(
+                np.arange(8).reshape((4, 2)) * 1.5 + frame_index + tag_id
+            ).tolist(),
+            starting_with=CornerId.TOP_LEFT,
+            clockwise=True,
+        )
+        for tag_id in tag_ids
+    ]
+
+
+def _vertices(markers):
+    return [
+        (marker.uid, marker._vertices_in_order(order=CornerId.all_corners()))
+        for marker in markers
+    ]
+
+
+def test_marker_detection_cache(tmp_path):
+    # Two segments of a parallel run, one with an overlapping frame
+    for frame_indices in ([0, 2, 5], [5, 7]):
+        cache = MarkerDetectionCache(tmp_path, "key")
+        cache.frame_count = 10
+        for frame_index in frame_indices:
+            cache.add(
+                frame_index,
+                _make_markers(frame_index, [3, 1] if frame_index != 2 else []),
+            )
+
+        # Unsaved detections are kept as arrays, not as the added markers
+        assert len(cache.new_tag_ids) == 4
+        assert _vertices(cache.get(5)) == _vertices(_make_markers(5, [3, 1]))
+        cache.save_part()
+
+    (tmp_path / "markers-stale.npz").write_bytes(b"")
+    MarkerDetectionCache(tmp_path, "key").save()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["markers-key.npz"]
+
+    cache = MarkerDetectionCache(tmp_path, "key")
+    assert cache.frame_count == 10
+    assert 1 not in cache
+    for frame_index in [0, 2, 5, 7]:
+        assert frame_index in cache
+        expected = _make_markers(frame_index, [3, 1] if frame_index != 2 else [])
+        assert _vertices(cache.get(frame_index)) == _vertices(expected)
+
+
+def test_scene_marker_source_forgets_old_keyframes(tmp_path):
+    # Detections come from the cache, so no video is opened
+    cache = MarkerDetectionCache(tmp_path, "key")
+    for frame_index in range(100):
+        cache.add(frame_index, _make_markers(frame_index, [0, 1, 2, 3]))
+
+    for stride in (1, 3):
+        source = SceneMarkerSource(
+            None,
+            None,
+            np.arange(100),
+            np.arange(100, dtype=np.uint64) * 1000,
+            np.ones(100, dtype=bool),
+            stride,
+            cache,
+        )
+        for position in range(100):
+            assert len(source.markers(position)) == 4
+            assert len(source.detections) <= 2
+
+
+def test_interpolate_surface_transforms():
+    keyframe_timestamps = np.array([100, 200, 300, 400], dtype=np.uint64)
+    keyframe_transforms = [
+        np.eye(3),
+        None,
+        np.eye(3) * [3, 3, 1],
+        np.eye(3) * [5, 5, 1],
+    ]
+    timestamps = np.array([100, 150, 250, 350, 360, 450], dtype=np.uint64)
+
+    transforms, previous_idx = interpolate_surface_transforms(
+        timestamps, keyframe_timestamps, keyframe_transforms.__getitem__, linear=False
+    )
+    assert previous_idx.tolist() == [-1, 0, 1, 2, 2, 3]
+    # Nothing before the first keyframe, and the surface wasn't located on the second
+    assert np.isnan(transforms[[0, 2]]).all()
+    assert transforms[1:, 0, 0][[0, 2, 3, 4]].tolist() == [1, 3, 3, 5]
+
+    transforms, _ = interpolate_surface_transforms(
+        timestamps, keyframe_timestamps, keyframe_transforms.__getitem__, linear=True
+    )
+    # Keyframes next to an unlocated one are used alone
+    assert transforms[:, 0, 0].tolist() == [1, 1, 3, 4, 4.2, 5]
+    assert (transforms[:, 2, 2] == 1).all()
+
+    transforms, _ = interpolate_surface_transforms(
+        timestamps + np.uint64(20),
+        keyframe_timestamps,
+        keyframe_transforms.__getitem__,
+        linear=True,
+        max_age_ns=60,
+    )
+    assert np.isnan(transforms[[1, 5]]).all()
+    assert transforms[[0, 2, 3, 4], 0, 0].tolist() == [1, 3, 5, 5]
@@ -0,0 +1,170 @@
+import asyncio
+
+from pupil_labs.web_aois.events import EventJournal, read_journal
+from pupil_labs.web_aois.record import BrowserRelay, EventRelay
+
+
+class SlowDevice:
+    def __init__(self):
+        self.events = []
+
+    async def send_event(self, event, event_timestamp_unix_ns=None):
+        await asyncio.sleep(0.01)
+        self.events.append((event, event_timestamp_unix_ns))
+
+
+def test_event_relay_coalesces_scrolling(tmp_path):
+    device = SlowDevice()
+
+    async def record():
+        relay = EventRelay(device)
+        relay.journal = EventJournal(tmp_path / "events.journal")
+        relay.start()
+
+        await relay.send_event("browser_url[0,0]=https://example.com/", 1)
+        for y in range(100):
+            relay.send_scroll(0, f"browser_scroll[0,0]=0,{y}", 100 + y)
+            relay.send_scroll(1, f"browser_scroll[1,0]=0,{y}", 100 + y)
+            await asyncio.sleep(0.001)
+
+        await relay.send_event("aoi[0,0,header]=0,0,10,10", 500)
+        await relay.close()
+        return relay.counters
+
+    counters = asyncio.run(record())
+
+    # Events keep their capture timestamps, and the last positions are never lost
+    assert device.events[0] == ("browser_url[0,0]=https://example.com/", 1)
+    assert ("aoi[0,0,header]=0,0,10,10", 500) in device.events
+    assert ("browser_scroll[0,0]=0,99", 199) in device.events
+    assert ("browser_scroll[1,0]=0,99", 199) in device.events
+
+    assert counters['sent'] == len(device.events) < 100
+    assert counters['queued'] == 202
+    assert counters['coalesced'] == counters['queued'] - counters['sent']
+    assert counters['deferred'] == counters['failed'] == 0
+
+    # The journal has every event, including the coalesced ones
+    timestamps, events = read_journal(tmp_path / "events.journal")
+    assert len(events) == 202
+    assert events[-1] == "aoi[0,0,header]=0,0,10,10"
+
+
+def test_event_relay_keeps_scrolls_that_do_not_fit():
+    device = SlowDevice()
+
+    async def record():
+        relay = EventRelay(device, max_queued=2, batch_size=1)
+        relay.start()
+        for y in range(3):
+            for tab_id in range(6):
+                relay.send_scroll(
+                    tab_id, f"browser_scroll[{tab_id},0]=0,{y}", 100 * tab_id + y
+                )
+
+        # Sent once the queue drains, without waiting for the relay to close
+        await asyncio.sleep(0.5)
+        sent = list(device.events)
+        await relay.close()
+        return relay.counters, sent
+
+    counters, sent = asyncio.run(record())
+
+    assert counters['deferred'] > 0
+    for tab_id in range(6):
+        assert (f"browser_scroll[{tab_id},0]=0,2", 100 * tab_id + 2) in sent
+    assert counters['sent'] == len(device.events)
+
+
+class FakeLocator:
+    def __init__(self, page, bounds):
+        self.page = page
+        self.bounds = bounds
+
+    async def evaluate(self, expression, arg=None):
+        await asyncio.sleep(0.05)
+        if self.bounds is None:
+            raise TimeoutError("element not found")
+
+        # Bounds are measured with the page's clock, which is not the recorder's
+        self.page.clock_ms += 1.5
+        return [
+            [
+                self.bounds['x'],
+                self.bounds['y'],
+                self.bounds['width'],
+                self.bounds['height'],
+            ],
+            self.page.clock_ms,
+        ]
+
+
+class FakePage:
+    url = "https://example.com/"
+
+    def __init__(self):
+        self.clock_ms = 1_000.0
+
+    def locator(self, selector):
+        return FakeLocator(self, {'x': 0.0, 'y': 0.0, 'width': 100.0, 'height': 100.0})
+
+    def get_by_text(self, text):
+        return FakeLocator(
+            self,
+            None
+            if text == "missing"
+            else {'x': 1.0, 'y': 2.0, 'width': 3.0, 'height': 4.0}
+        )
+
+
+def test_send_elements_queries_concurrently():
+    device = SlowDevice()
+    page = FakePage()
+    aoi_definitions = {
+        page.url: {
+            f"aoi{idx}": [
+                {"type": "text", "args": {"text": "missing" if idx == 3 else "found"}}
+            ]
+            for idx in range(20)
+        }
+    }
+
+    async def record():
+        relay = BrowserRelay(None, device, aoi_definitions)
+        relay.tab_info[page] = {'id': 0, 'load_count': 0}
+        relay.event_relay.start()
+        await relay.send_elements(page)
+        await relay.event_relay.close()
+        return relay
+
+    relay = asyncio.run(record())
+
+    # 19 AOIs that could be found and 4 markers, measured concurrently. They are
+    # stamped with the page's time of the last measurement.
+    assert len(device.events) == 23
+    assert {t_ns for _, t_ns in device.events} == {int(page.clock_ms * 1e6)}
+    assert page.clock_ms == 1_000.0 + 23 * 1.5
+    assert ("aoi[0,0,aoi0]=1.0,2.0,3.0,4.0", device.events[0][1]) in device.events
+    assert ("marker[0,0,3]=10.0,10.0,80.0,80.0", device.events[0][1]) in device.events
+    assert relay.geometry_refresh_durations_ns[0] < 0.5e9
+    assert len(relay.event_relay.latencies_ns['aoi']) == 19
+
+
+def test_aoi_geometry_changes_are_relayed():
+    device = SlowDevice()
+    page = FakePage()
+
+    async def record():
+        relay = BrowserRelay(None, device, {})
+        relay.tab_info[page] = {'id': 1, 'load_count': 2}
+        relay.event_relay.start()
+        await relay.on_aoi_geometry_changed(
+            {'page': page}, [["header", 0, 10.5, 100, 20]], 1234.5
+        )
+        await relay.event_relay.close()
+        return relay
+
+    relay = asyncio.run(record())
+
+    assert device.events == [("aoi[1,2,header]=0,10.5,100,20", 1234500000)]
+    assert relay.geometry_updates == 1
@@ -0,0 +1,143 @@
+import asyncio
+import io
+import json
+
+import numpy as np
+
+from PIL import Image
+from pupil_labs.web_aois.aoi_definitions import AoiDefinitionIndex
+from pupil_labs.web_aois.screenshots import (
+    CAPTURE_FILE_NAME,
+    capture_all,
+    crop_aoi,
+    plan_captures,
+    url_directory_name,
+)
+
+
+class FakeLocator:
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+    async def evaluate(self, expression, timeout=None):
+        if self.bounds is None:
+            raise TimeoutError("not found")
+
+        return self.bounds
+
+
+class FakePage:
+    def __init__(self, context, viewport):
+        self.context = context
+        self.viewport = viewport
+        self.url = None
+
+    async def goto(self, url):
+        browser = self.context.browser
+        browser.loading += 1
+        browser.max_loading = max(browser.max_loading, browser.loading)
+        await asyncio.sleep(0.01)
+        browser.loading -= 1
+        self.url = url
+
+    async def screenshot(self, full_page=False):
+        image = np.zeros((3000, self.viewport['width'], 3), np.uint8)
+        image[:, :, 1] = np.arange(3000)[:, np.newaxis] % 256
+        png_file = io.BytesIO()
+        Image.fromarray(image).save(png_file, format='PNG')
+        self.context.browser.screenshots.append(png_file.getvalue())
+
+        return png_file.getvalue()
+
+    def get_by_text(self, text):
+        return FakeLocator(None if text == "missing" else [10.0, 1000.0, 100.0, 50.0])
+
+
+class FakeContext:
+    def __init__(self, browser, viewport):
+        self.browser = browser
+        self.viewport = viewport
+
+    async def new_page(self):
+        return FakePage(self, self.viewport)
+
+    async def close(self):
+        self.browser.closed += 1
+
+
+class FakeBrowser:
+    def __init__(self):
+        self.contexts = []
+        self.closed = 0
+        self.screenshots = []
+        self.loading = 0
+        self.max_loading = 0
+
+    async def new_context(self, viewport):
+        self.contexts.append(FakeContext(self, viewport))
+
+        return self.contexts[-1]
+
+
+def test_url_directory_name():
+    assert url_directory_name("https://example.com/products?page=2").startswith(
+        "example.com_products_page_2-"
+    )
+    assert url_directory_name("https://example.com/a b") != url_directory_name(
+        "https://example.com/a_b"
+    )
+
+
+def test_crop_aoi():
+    image = np.arange(100 * 50).reshape(100, 50)
+    assert np.array_equal(crop_aoi(image, (10.4, 20.6, 5, 10)), image[21:31, 10:15])
+    assert crop_aoi(image, (-5, 90, 10, 20)).shape == (10, 5)
+    assert crop_aoi(image, (60, 0, 10, 10)) is None
+
+
+def test_capture_all(tmp_path):
+    definitions = {
+        f"https://example.com/{idx}": {
+            "tile": [{"type": "text", "args": {"text": "tile"}}],
+            "gone": [{"type": "text", "args": {"text": "missing"}}],
+        }
+        for idx in range(6)
+    }
+    definitions["prefix:https://example.com/shop"] = {}
+    viewports = [(1280, 720), (800, 600)]
+
+    captures, fresh = plan_captures(
+        AoiDefinitionIndex(definitions), tmp_path, viewports
+    )
+    assert (len(captures), fresh) == (12, 0)
+
+    browser = FakeBrowser()
+    failures = asyncio.run(
+        capture_all(browser, captures, AoiDefinitionIndex(definitions), pages=4)
+    )
+    assert failures == []
+    assert browser.max_loading == 4
+    assert browser.closed == len(browser.contexts) <= 8
+
+    url, viewport, path = captures[0]
+    capture = json.loads((path / CAPTURE_FILE_NAME).read_text())
+    assert capture['url'] == url
+    assert capture['viewport'] == [viewport[0], 3000]
+    assert capture['files'] == ["full-page.png", "aoi-tile.png"]
+    assert (path / "full-page.png").read_bytes() in browser.screenshots
+
+    # AOIs are cropped out of the full page screenshot
+    tile = np.asarray(Image.open(path / "aoi-tile.png"))
+    assert tile.shape == (50, 100, 3)
+    assert np.array_equal(tile[:, 0, 1], np.arange(1000, 1050) % 256)
+
+    # Only captures with changed AOI definitions, or older than the maximum age, are
+    # redone
+    definitions["https://example.com/0"]["tile"][0]["args"]["text"] = "new tile"
+    aoi_definitions = AoiDefinitionIndex(definitions)
+    captures, fresh = plan_captures(aoi_definitions, tmp_path, viewports)
+    assert (len(captures), fresh) == (2, 10)
+    captures, fresh = plan_captures(aoi_definitions, tmp_path, viewports, max_age_s=0)
+    assert (len(captures), fresh) == (12, 0)
+    captures, fresh = plan_captures(aoi_definitions, tmp_path, viewports, force=True)
+    assert (len(captures), fresh) == (12, 0)
@@ -0,0 +1,137 @@
+import json
+
+import numpy as np
+
+from pupil_labs.web_aois.process import RecordingProcessor
+from pupil_labs.web_aois.store import STORE_TABLES, StudyStore, ingest_recordings
+from pupil_labs.web_aois.synthetic import synthesize_recording
+from pupil_labs.web_aois.events import read_table
+from pupil_labs.web_aois.visualize import read_csv
+
+
+def test_ingest_and_query(tmp_path):
+    source = tmp_path / "recordings"
+    processed = tmp_path / "processed"
+    synthesize_recording(
+        source / "a", seconds=2, aoi_count=10, tab_count=2, scroll_rate=10
+    )
+    synthesize_recording(
+        source / "b", seconds=2, aoi_count=10, tab_count=2, scroll_rate=10, seed=1
+    )
+
+    # Recordings are added as they are processed
+    RecordingProcessor(
+        source / "a", processed / "a", batch=True, show_progress=False
+    ).process()
+    assert ingest_recordings(source, processed, tmp_path / "store", block_size=4) == [
+        "a"
+    ]
+
+    RecordingProcessor(
+        source / "b",
+        processed / "b",
+        batch=True,
+        show_progress=False,
+        output_format='binary',
+    ).process()
+    assert ingest_recordings(source, processed, tmp_path / "store", block_size=4) == [
+        "b"
+    ]
+
+    store = StudyStore(tmp_path / "store")
+    assert store.recordings == ["a", "b"]
+    assert store.urls == ["https://example.com/0", "https://example.com/1"]
+
+    # Everything from a CSV output, with URLs by tab
+    gazes = store.gazes(recordings="a")
+    for tab_id in (0, 1):
+        expected = read_csv(processed / "a" / f"tab-{tab_id}" / "gazes.csv")
+        rows = gazes['tab_id'] == tab_id
+        assert np.allclose(gazes['page_x_px'][rows], expected['page_x_px'])
+        assert set(gazes['url_id'][rows].tolist()) == {tab_id}
+
+    # AOI hits on a URL within a time range, from a binary output
+    hits = read_table(processed / "b" / "aoi_hits")
+    aois = json.loads((processed / "b" / "aois.json").read_text())
+    aoi_id = np.bincount(hits['aoi_id'][hits['tab_id'] == 1]).argmax()
+    aoi_rows = hits['aoi_id'] == aoi_id
+    start_ns, end_ns = np.percentile(hits['timestamp_ns'][aoi_rows], [25, 75]).astype(
+        np.uint64
+    )
+    expected = (
+        aoi_rows & (hits['timestamp_ns'] >= start_ns) & (hits['timestamp_ns'] < end_ns)
+    )
+    assert np.count_nonzero(expected) > 0
+
+    store.blocks_read = 0
+    queried = store.aoi_hits(
+        recordings=["b"],
+        urls="https://example.com/1#ignored",
+        aois=aois[aoi_id]['name'],
+        start_ns=start_ns,
+        end_ns=end_ns,
+        columns=['timestamp_ns', 'x_px'],
+    )
+    assert queried['timestamp_ns'].tolist() == hits['timestamp_ns'][expected].tolist()
+    assert queried['x_px'].tolist() == hits['x_px'][expected].tolist()
+    assert store.blocks_read < len(store.indices['aoi_hits']['row_start']) / 2
+
+    # URL patterns, and filters without matches
+    assert len(
+        store.aoi_hits(urls="prefix:https://example.com")['timestamp_ns']
+    ) == sum(
+        len(store.aoi_hits(recordings=name)['timestamp_ns'])
+        for name in store.recordings
+    )
+    assert len(store.gazes(recordings="c")['timestamp_ns']) == 0
+
+
+def _recording_rows(seed, row_count=50):
+    rng = np.random.default_rng(seed)
+    gazes = {
+        'timestamp_ns': np.arange(row_count, dtype=np.uint64) * 5_000_000,
+        'tab_id': np.zeros(row_count, np.int32),
+        'load_id': np.zeros(row_count, np.int32),
+        'page_x_px': rng.uniform(0, 100, row_count),
+        'page_y_px': rng.uniform(0, 100, row_count),
+    }
+    aoi_hits = {
+        'timestamp_ns': gazes['timestamp_ns'][::2],
+        'tab_id': gazes['tab_id'][::2],
+        'load_id': gazes['load_id'][::2],
+        'aoi_id': np.zeros(row_count // 2, np.int32),
+        'x_px': gazes['page_x_px'][::2],
+        'y_px': gazes['page_y_px'][::2],
+    }
+    return gazes, aoi_hits, ["aoi"], {(0, 0): (0, "https://example.com/")}
+
+
+def test_interrupted_append(tmp_path):
+    store = StudyStore(tmp_path, block_size=8)
+    store.add_recording("a", *_recording_rows(0))
+
+    # Interrupted while appending the index columns of the next recording, after
+    # all rows but only some of the index columns were written
+    index_path = tmp_path / "gazes" / "index"
+    index_files = sorted(index_path.glob("*.bin"))
+    lengths = {path: path.stat().st_size for path in index_files}
+    store.add_recording("b", *_recording_rows(1))
+    for path in index_files[len(index_files) // 2:]:
+        with path.open('r+b') as index_file:
+            index_file.truncate(lengths[path])
+    (tmp_path / "recordings.json").write_text(json.dumps(["a"]))
+
+    store = StudyStore(tmp_path, block_size=8)
+    assert store.recordings == ["a"]
+    assert len(store.gazes()['timestamp_ns']) == 50
+
+    # Adding it again replaces the leftovers
+    store.add_recording("b", *_recording_rows(1))
+    store = StudyStore(tmp_path, block_size=8)
+    gazes = store.gazes()
+    assert len(gazes['timestamp_ns']) == 100
+    expected = _recording_rows(1)[0]['page_x_px']
+    assert np.allclose(gazes['page_x_px'][gazes['recording_id'] == 1], expected)
+    for name, dtype in STORE_TABLES['gazes']:
+        column_size = (tmp_path / "gazes" / f"{name}.bin").stat().st_size
+        assert column_size == 100 * np.dtype(dtype).itemsize
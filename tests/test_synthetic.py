@@ -0,0 +1,143 @@
+import json
+
+import numpy as np
+
+from pupil_labs.web_aois.aoi_definitions import AoiDefinitionIndex
+from pupil_labs.web_aois.events import read_table
+from pupil_labs.web_aois.process import (
+    PAGES_FILE_NAME,
+    RecordingProcessor,
+    process_in_parallel,
+)
+from pupil_labs.web_aois.synthetic import synthesize_recording
+from pupil_labs.web_aois.visualize import read_csv
+
+
+def test_processing_matches_ground_truth(tmp_path):
+    truth = synthesize_recording(
+        tmp_path / "recording", seconds=3, aoi_count=3, tab_count=2, scroll_rate=10
+    )
+
+    RecordingProcessor(
+        tmp_path / "recording", tmp_path / "csv", show_progress=False
+    ).process()
+    RecordingProcessor(
+        tmp_path / "recording", tmp_path / "batched", batch=True, show_progress=False
+    ).process()
+    aoi_definitions = AoiDefinitionIndex(
+        {"https://example.com/0": {}, "prefix:https://example.com": {}}
+    )
+    RecordingProcessor(
+        tmp_path / "recording",
+        tmp_path / "binary",
+        batch=True,
+        show_progress=False,
+        output_format='binary',
+        aoi_definitions=aoi_definitions,
+    ).process()
+    event_lines = (tmp_path / "recording" / "event.txt").read_text().splitlines()
+    event_timestamps = np.fromfile(tmp_path / "recording" / "event.time", '<u8')
+    pages = json.loads((tmp_path / "binary" / PAGES_FILE_NAME).read_text())
+    assert [page.pop('timestamp_ns') for page in pages] == [
+        timestamp
+        for timestamp, line in zip(event_timestamps.tolist(), event_lines)
+        if line.startswith("browser_url")
+    ]
+    assert pages == [
+        {
+            'tab_id': 0,
+            'load_id': 0,
+            'url': "https://example.com/0",
+            'aoi_definitions': "https://example.com/0",
+        },
+        {
+            'tab_id': 1,
+            'load_id': 0,
+            'url': "https://example.com/1",
+            'aoi_definitions': "prefix:https://example.com",
+        },
+    ]
+    csv_pages = json.loads((tmp_path / "csv" / PAGES_FILE_NAME).read_text())
+    assert [page['aoi_definitions'] for page in csv_pages] == [None, None]
+
+    for path in (tmp_path / "csv").glob("tab-*/*.csv"):
+        assert (
+            tmp_path / "batched" / path.relative_to(tmp_path / "csv")
+        ).read_text() == path.read_text()
+
+    gazes = read_table(tmp_path / "binary" / "gazes")
+    truth_idx = np.searchsorted(truth['timestamps'], gazes['timestamp_ns'])
+    assert np.array_equal(truth['timestamps'][truth_idx], gazes['timestamp_ns'])
+    assert np.array_equal(truth['tab_ids'][truth_idx], gazes['tab_id'])
+    assert set(gazes['tab_id'].tolist()) == {0, 1}
+
+    errors = np.hypot(
+        gazes['page_x_px'] - truth['page'][truth_idx, 0],
+        gazes['page_y_px'] - truth['page'][truth_idx, 1],
+    )
+    assert errors.max() < 3
+
+    # Samples well inside the window are all mapped once there are markers. The
+    # surface of a tab that was switched to is only located with the next frame.
+    window = truth['window']
+    inside = np.all((window > 20) & (window < [1260, 700]), axis=1)
+    inside &= (truth['timestamps'] > truth['timestamps'][0] + 600_000_000) & (
+        truth['tab_ids'] == 0
+    )
+    assert np.isin(truth['timestamps'][inside], gazes['timestamp_ns']).all()
+
+
+def test_segments_match_single_run(tmp_path):
+    synthesize_recording(tmp_path / "recording", seconds=3, aoi_count=3, scroll_rate=10)
+
+    options = {'frame_stride': 3, 'batch': True}
+    RecordingProcessor(
+        tmp_path / "recording", tmp_path / "single", show_progress=False, **options
+    ).process()
+    process_in_parallel(tmp_path / "recording", tmp_path / "segments", 2, **options)
+
+    # Segments locate the same keyframes, and only differ by rounding in the mapping
+    single_paths = sorted((tmp_path / "single").glob("tab-*/*.csv"))
+    assert len(single_paths) > 1
+    for path in single_paths:
+        expected = read_csv(path)
+        merged = read_csv(tmp_path / "segments" / path.relative_to(tmp_path / "single"))
+        assert np.array_equal(merged['timestamp_ns'], expected['timestamp_ns'])
+        for name, column in expected.items():
+            assert np.allclose(merged[name], column, atol=1e-3)
+
+
+def test_nothing_is_mapped_after_the_browser_closed(tmp_path):
+    synthesize_recording(tmp_path / "recording", seconds=3, aoi_count=3, scroll_rate=10)
+
+    options = {'batch': True, 'output_format': 'binary', 'show_progress': False}
+    RecordingProcessor(tmp_path / "recording", tmp_path / "open", **options).process()
+
+    # Close the browser half way through the recording
+    event_file = tmp_path / "recording" / "event.txt"
+    event_lines = event_file.read_text().splitlines()
+    event_timestamps = np.fromfile(event_file.with_suffix(".time"), '<u8')
+    closed_timestamp = (int(event_timestamps[0]) + int(event_timestamps[-1])) // 2
+    position = int(np.searchsorted(event_timestamps, closed_timestamp))
+    event_lines.insert(position, "browser_closed")
+    event_file.write_text("\n".join(event_lines) + "\n")
+    np.insert(event_timestamps, position, closed_timestamp).tofile(
+        event_file.with_suffix(".time")
+    )
+
+    processor = RecordingProcessor(
+        tmp_path / "recording", tmp_path / "closed", **options
+    )
+    processor.process()
+
+    scheduled_timestamps = processor.frame_timestamps[processor.scheduled_frames]
+    assert len(scheduled_timestamps) > 0
+    assert scheduled_timestamps.max() < closed_timestamp
+
+    open_gazes = read_table(tmp_path / "open" / "gazes")
+    closed_gazes = read_table(tmp_path / "closed" / "gazes")
+    assert open_gazes['timestamp_ns'].max() > closed_timestamp
+    assert np.array_equal(
+        closed_gazes['timestamp_ns'],
+        open_gazes['timestamp_ns'][open_gazes['timestamp_ns'] < closed_timestamp],
+    )
@@ -0,0 +1,148 @@
+import json
+
+import numpy as np
+
+from pupil_labs.web_aois.events import PAGES_FILE_NAME
+from pupil_labs.web_aois.process import BinaryOutputWriter, CsvOutputWriter
+from pupil_labs.web_aois.screenshots import (
+    capture_path,
+    read_png,
+    url_directory_name,
+    write_png,
+)
+from pupil_labs.web_aois.visualize import (
+    HeatmapAccumulator,
+    HeatmapVisualizer,
+    find_processed_recordings,
+)
+
+
+def test_heatmap_accumulator_counts_cells():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-10, 1000, 10000)
+    y = rng.uniform(-10, 5000, 10000)
+
+    accumulator = HeatmapAccumulator(cell_size=10)
+    for chunk in np.array_split(np.arange(len(x)), 7):
+        accumulator.add(x[chunk], y[chunk])
+
+    expected, _, _ = np.histogram2d(
+        y, x, bins=[np.arange(0, 5010, 10), np.arange(0, 1010, 10)]
+    )
+    assert accumulator.total == np.sum((x >= 0) & (y >= 0))
+    assert np.array_equal(accumulator.counts[:500, :100], expected)
+
+    other = HeatmapAccumulator(cell_size=10)
+    other.add([5, 2500], [9000, 5])
+    other.merge(accumulator)
+    assert other.counts[900, 0] == 1 and other.counts[0, 250] == 1
+    assert np.array_equal(other.counts[:500, :100], expected)
+
+    heatmap = accumulator.heatmap((1000, 2000), sigma=15)
+    assert heatmap.shape == (200, 100)
+    assert heatmap.max() == 1
+
+    image = accumulator.render((1000, 2000), sigma=15)
+    assert image.shape == (2000, 1000, 4)
+    assert image.dtype == np.uint8
+
+
+URL_A = "https://example.com/a"
+URL_B = "https://example.com/b"
+
+
+def _write_output(writer, gazes, aoi_hits):
+    # Tab 0 shows page A, tab 1 shows page B and then page A from timestamp 50
+    writer.add_tab(0)
+    writer.add_tab(1)
+    aoi_id = writer.add_aoi(1, 'button')
+    writer.write_gazes(0, 0, gazes[0])
+    writer.write_gazes(1, 0, [column[:50] for column in gazes[1]])
+    writer.write_gazes(1, 1, [column[50:] for column in gazes[1]])
+    writer.write_aoi_hits(1, 0, aoi_id, aoi_hits)
+    writer.close()
+
+    (writer.output_path / PAGES_FILE_NAME).write_text(json.dumps([
+        {'tab_id': 0, 'load_id': 0, 'timestamp_ns': 0, 'url': URL_A},
+        {'tab_id': 1, 'load_id': 0, 'timestamp_ns': 0, 'url': URL_B},
+        {'tab_id': 1, 'load_id': 1, 'timestamp_ns': 50, 'url': URL_A},
+    ]))
+
+
+def test_study_heatmaps_aggregate_recordings(tmp_path, capsys):
+    rng = np.random.default_rng(1)
+    gazes = [
+        [
+            np.arange(100, dtype=np.uint64),
+            *rng.uniform(0, 1, (2, 100)),
+            *rng.uniform(0, 500, (4, 100)),
+        ]
+        for _ in range(2)
+    ]
+    aoi_hits = [
+        np.arange(50, dtype=np.uint64),
+        *rng.uniform(0, 1, (2, 50)),
+        *rng.uniform(0, 100, (2, 50)),
+    ]
+
+    _write_output(CsvOutputWriter(tmp_path / "study" / "p1"), gazes, aoi_hits)
+    _write_output(
+        BinaryOutputWriter(tmp_path / "study" / "p2", chunk_size=30), gazes, aoi_hits
+    )
+    assert find_processed_recordings(tmp_path / "study") == [
+        tmp_path / "study" / "p1",
+        tmp_path / "study" / "p2",
+    ]
+
+    visualizer = HeatmapVisualizer(
+        tmp_path / "study", tmp_path / "screenshots", cell_size=5
+    )
+    study = visualizer.accumulate(
+        find_processed_recordings(tmp_path / "study"),
+        lambda name, url: True,
+        lambda name, tab_id, url: (url, name),
+    )
+    assert sorted(study) == [
+        (URL_A, 'gazes'),
+        (URL_B, 'aoi-button'),
+        (URL_B, 'gazes'),
+    ]
+    assert study[(URL_A, 'gazes')].total == 300
+    assert study[(URL_B, 'gazes')].total == 100
+    assert study[(URL_B, 'aoi-button')].total == 100
+
+    # Both output formats accumulate the same counts
+    csv_heatmaps, binary_heatmaps = [
+        visualizer.accumulate(
+            [tmp_path / "study" / name],
+            lambda name, url: True,
+            lambda name, tab_id, url: (tab_id, url, name),
+        )
+        for name in ("p1", "p2")
+    ]
+    assert sorted(csv_heatmaps) == [
+        (0, URL_A, 'gazes'),
+        (1, URL_A, 'gazes'),
+        (1, URL_B, 'aoi-button'),
+        (1, URL_B, 'gazes'),
+    ]
+    for key, accumulator in csv_heatmaps.items():
+        assert np.array_equal(accumulator.counts, binary_heatmaps[key].counts)
+
+    # Only page A has a screenshot, heatmaps without one are skipped. PNGs are
+    # written even though decord is loaded, which breaks OpenCV's PNG codec.
+    screenshot_path = capture_path(tmp_path / "screenshots", URL_A, (600, 800))
+    screenshot_path.mkdir(parents=True)
+    write_png(screenshot_path / "full-page.png", np.full((800, 600, 3), 255, np.uint8))
+    visualizer.viewport = (600, 800)
+    visualizer.save_study_heatmaps()
+    output = capsys.readouterr().out
+    assert "Aggregating 2 recordings" in output
+    assert output.count("could not read a screenshot") == 2
+
+    overlaid = read_png(
+        tmp_path / "study" / url_directory_name(URL_A) / "heatmap-gazes-overlaid.png"
+    )
+    assert overlaid.shape == (800, 600, 3)
+    assert (overlaid != 255).any()
+    assert not (tmp_path / "study" / url_directory_name(URL_B)).exists()